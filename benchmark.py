@@ -0,0 +1,808 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks de bot.py.
+Requieren las mismas variables de entorno que el bot (TELEGRAM_TOKEN, DB_NAME, DB_USER, ...).
+Los que usan la base de datos trabajan sobre tablas temporales, así que no modifican los datos reales.
+
+Uso:
+    python benchmark.py --list
+    python benchmark.py <nombre> [--n N]
+"""
+import argparse
+import asyncio
+import datetime
+import http.server
+import importlib.util
+import json
+import logging
+import os
+import random
+import re
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import psycopg2
+
+import bot
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Registra una función como benchmark con el nombre sin el prefijo 'bench_'."""
+    BENCHMARKS[func.__name__[len("bench_"):]] = func
+    return func
+
+
+def raw_connection():
+    """Conexión dedicada (fuera del pool) con los mismos parámetros que el bot."""
+    return psycopg2.connect(**bot.db_pool._connect_kwargs)
+
+
+def timed(func, n):
+    """Ejecuta func() n veces y retorna la lista de duraciones en microsegundos."""
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def report(label, samples):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{label:<45} media {statistics.mean(samples):9.1f} us   p50 {statistics.median(samples):9.1f} us   p95 {p95:9.1f} us")
+    return statistics.mean(samples)
+
+
+@benchmark
+def bench_prepared(args):
+    """Consultas frecuentes con SQL literal vs. PREPARE/EXECUTE (StatementRegistry)."""
+    conn = raw_connection()
+    cur = conn.cursor()
+    # Tablas temporales con los mismos nombres: ocultan a las reales en esta sesión
+    cur.execute("CREATE TEMP TABLE products (id SERIAL PRIMARY KEY, name TEXT, price NUMERIC, sale_type TEXT)")
+    cur.execute("CREATE TEMP TABLE cart_items (id SERIAL PRIMARY KEY, cart_id INTEGER, product_id INTEGER, quantity NUMERIC, subtotal NUMERIC)")
+    cur.execute("CREATE TEMP TABLE orders (id SERIAL PRIMARY KEY, cart_id INTEGER, telegram_id BIGINT, confirmation_code TEXT, "
+                "status TEXT, order_date TIMESTAMP DEFAULT NOW(), entrega_date TIMESTAMP, conjunto_id INTEGER)")
+    cur.execute("CREATE TEMP TABLE orders_archive (id INTEGER PRIMARY KEY, cart_id INTEGER, telegram_id BIGINT, confirmation_code TEXT, "
+                "status TEXT, order_date TIMESTAMP, entrega_date TIMESTAMP, conjunto_id INTEGER, archived_at TIMESTAMP DEFAULT NOW())")
+    cur.execute("INSERT INTO products (name, price, sale_type) SELECT 'producto ' || g, 100, 'unidad' FROM generate_series(1, 200) g")
+    cur.execute("INSERT INTO cart_items (cart_id, product_id, quantity, subtotal) "
+                "SELECT g / 5, 1 + g % 200, 1, 100 FROM generate_series(1, 50000) g")
+    cur.execute("INSERT INTO orders (cart_id, telegram_id, confirmation_code, status, conjunto_id) "
+                "SELECT g, g % 5000, g::text, CASE WHEN g % 10 = 0 THEN 'pendiente' ELSE 'entregado' END, g / 3 "
+                "FROM generate_series(1, 100000) g")
+    cur.execute("CREATE INDEX ON cart_items (cart_id)")
+    cur.execute("CREATE INDEX ON orders (conjunto_id)")
+    cur.execute("CREATE INDEX ON orders (telegram_id)")
+    cur.execute("ANALYZE")
+    conn.commit()
+
+    cases = [
+        ("cart_details", lambda: (random.randint(1, 9999),)),
+        ("pending_in_conjunto", lambda: (random.randint(1, 33000),)),
+        ("pending_orders", lambda: (random.randint(1, 4999), 20)),
+        ("delivered_orders", lambda: (lambda t: (t, 20, t, 20, 20))(random.randint(1, 4999))),
+    ]
+    registry = bot.StatementRegistry()
+    plain = bot.StatementRegistry(enabled=False)
+    for name in [c[0] for c in cases]:
+        sql = bot.statements._statements[name][0]
+        registry.register(name, sql)
+        plain.register(name, sql)
+
+    for name, make_params in cases:
+        def run_plain():
+            plain.execute(cur, name, make_params())
+            cur.fetchall()
+
+        def run_prepared():
+            registry.execute(cur, name, make_params())
+            cur.fetchall()
+
+        # Calentamiento (y PREPARE en la conexión)
+        timed(run_plain, 50)
+        timed(run_prepared, 50)
+        t_plain = report(f"{name} (SQL literal)", timed(run_plain, args.n))
+        t_prep = report(f"{name} (PREPARE/EXECUTE)", timed(run_prepared, args.n))
+        print(f"{'':<45} ahorro {100 * (t_plain - t_prep) / t_plain:5.1f}% por consulta\n")
+    conn.rollback()
+    conn.close()
+
+
+@benchmark
+def bench_router(args):
+    """Despacho de callback queries: regex por handler (estado CART_MENU) vs. CallbackRouter."""
+    # Patrones con los que estaba registrado el estado CART_MENU, en el mismo orden
+    legacy_patterns = [re.compile(p) for p in (
+        "^(cartmenu_.*|back_cart_.*)$", "^cart_details_.*", "^cart_add_.*", "^cart_remove_\\d+$",
+        "^cart_removeitem_.*", "^cart_delete_.*", "^cart_pay_.*", "^show_carts$", "^back_main$",
+    )]
+    legacy_data = ["cartmenu_12", "cart_details_12", "cart_add_12", "cart_remove_12", "cart_removeitem_12_345",
+                   "cart_delete_12", "cart_pay_12", "show_carts", "back_main"]
+
+    def legacy_dispatch(data):
+        # Lo que hacían CallbackQueryHandler.check_update y luego el handler con query.data
+        for pattern in legacy_patterns:
+            if pattern.match(data):
+                return [int(x) for x in data.split("_") if x.isdigit()]
+        return None
+
+    router = bot.CallbackRouter(bot.callbacks)
+    router.add_routes(bot.CART_MENU, {name: None for name in (
+        "cart_menu", "cart_details", "cart_add", "cart_remove", "cart_removeitem",
+        "cart_delete", "cart_pay", "show_carts", "back_main")})
+    new_data = [bot.cb("cart_menu", 12), bot.cb("cart_details", 12), bot.cb("cart_add", 12),
+                bot.cb("cart_remove", 12), bot.cb("cart_removeitem", 12, 345), bot.cb("cart_delete", 12),
+                bot.cb("cart_pay", 12), bot.cb("show_carts"), bot.cb("back_main")]
+    for label, items, func in [
+        ("regex por handler (callback_data viejo)", legacy_data, legacy_dispatch),
+        ("router, decode sin cache", new_data, bot.callbacks._decode),
+        ("router, decode con cache", new_data, lambda d: router.resolve(bot.CART_MENU, d)),
+    ]:
+        samples = []
+        for data in items:
+            samples.extend(timed(lambda: func(data), args.n))
+        report(label, samples)
+    # El peor caso del esquema viejo es la última acción del estado
+    report("regex, última acción (back_main)", timed(lambda: legacy_dispatch("back_main"), args.n))
+    back_main = bot.cb("back_main")
+    report("router, última acción (back_main)", timed(lambda: router.resolve(bot.CART_MENU, back_main), args.n))
+
+@benchmark
+def bench_codes(args):
+    """Búsqueda de pedidos por código con 1M de pedidos (sin índice vs. índice único parcial) y asignación de códigos."""
+    conn = raw_connection()
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE orders (id SERIAL PRIMARY KEY, cart_id INTEGER, telegram_id BIGINT, confirmation_code TEXT, "
+                "status TEXT, order_date TIMESTAMP DEFAULT NOW(), entrega_date TIMESTAMP, conjunto_id INTEGER)")
+    # 1M de pedidos, 1% pendientes; 7919 es coprimo con 10^6, así que los códigos no se repiten
+    cur.execute("INSERT INTO orders (cart_id, telegram_id, confirmation_code, status, conjunto_id) "
+                "SELECT g, g % 5000, lpad(((g::bigint * 7919) % 1000000)::text, 6, '0'), "
+                "CASE WHEN g % 100 = 0 THEN 'pendiente' ELSE 'entregado' END, g / 3 "
+                "FROM generate_series(1, 1000000) g")
+    cur.execute("ANALYZE orders")
+    conn.commit()
+
+    pending_codes = [f"{(g * 7919) % 1000000:06d}" for g in range(100, 1000001, 100)]
+    lookup = "SELECT id, telegram_id FROM orders WHERE confirmation_code = %s AND status = 'pendiente'"
+
+    def run_lookup():
+        cur.execute(lookup, (random.choice(pending_codes),))
+        cur.fetchall()
+
+    # Sin índice cada búsqueda recorre la tabla completa: alcanzan pocas iteraciones
+    t_scan = report("búsqueda sin índice (1M pedidos)", timed(run_lookup, min(args.n, 50)))
+    cur.execute("CREATE UNIQUE INDEX ON orders (confirmation_code) WHERE status = 'pendiente'")
+    cur.execute("ANALYZE orders")
+    timed(run_lookup, 50)
+    t_index = report("búsqueda con índice único parcial", timed(run_lookup, args.n))
+    print(f"{'':<45} {t_scan / t_index:8.1f}x más rápido\n")
+
+    stats_before = dict(bot.code_stats)
+    samples = timed(lambda: bot.insert_order_row(cur, 1, 1, 1), args.n)
+    report("asignación de código (INSERT con savepoint)", samples)
+    collisions = bot.code_stats["collisions"] - stats_before["collisions"]
+    print(f"{'':<45} {collisions} colisiones reintentadas en {args.n} pedidos nuevos")
+    conn.rollback()
+    conn.close()
+
+@benchmark
+def bench_batching(args):
+    """Armado de conjuntos por cercanía con 10k pedidos pendientes (grilla) vs. agrupación secuencial."""
+    rng = random.Random(36)
+    now = bot.datetime.datetime.now()
+    # Clientes repartidos en ~30x30 km alrededor de un centro, con pedidos de la última hora
+    orders = [(i, -34.60 + rng.uniform(-0.135, 0.135), -58.40 + rng.uniform(-0.165, 0.165),
+               now - bot.datetime.timedelta(seconds=rng.uniform(0, 3600))) for i in range(10000)]
+    by_id = {o[0]: o for o in orders}
+
+    def spread(batches):
+        # Distancia media de cada pedido al primero de su conjunto
+        distances = [bot.distance_km(by_id[b[0]][1], by_id[b[0]][2], by_id[k][1], by_id[k][2])
+                     for b in batches for k in b[1:]]
+        return statistics.mean(distances) if distances else 0.0
+
+    n = min(args.n, 20)
+    batches = []
+    samples = timed(lambda: batches.append(bot.build_proximity_batches(orders, now, size=3, radius_km=2, window=900)), n)
+    report("conjuntos por cercanía (10k pedidos)", samples)
+    proximity = batches[-1]
+    sequential = [[o[0] for o in sorted(orders, key=lambda o: o[3])[i:i + 3]] for i in range(0, len(orders), 3)]
+    print(f"{'':<45} {len(proximity)} conjuntos, {sum(map(len, proximity))} pedidos agrupados")
+    print(f"{'':<45} distancia media dentro del conjunto: {spread(proximity):.2f} km "
+          f"(secuencial: {spread(sequential):.2f} km)")
+
+@benchmark
+def bench_conjunto_numbers(args):
+    """Asignación del número de conjunto con 100k conjuntos: recorrido completo en Python vs. lista de libres."""
+    conn = raw_connection()
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE conjuntos (id SERIAL PRIMARY KEY, numero_conjunto INTEGER NOT NULL, equipo_id INTEGER)")
+    cur.execute("CREATE TEMP TABLE conjunto_numeros_libres (numero INTEGER PRIMARY KEY)")
+    # 100k números con ~1% de huecos (conjuntos finalizados)
+    cur.execute("INSERT INTO conjuntos (numero_conjunto) SELECT g FROM generate_series(1, 101000) g WHERE random() > 0.01")
+    cur.execute("CREATE UNIQUE INDEX ON conjuntos (numero_conjunto)")
+    cur.execute("ANALYZE conjuntos")
+    conn.commit()
+
+    def legacy():
+        # Lo que hacía get_next_available_conjunto_number
+        cur.execute("SELECT numero_conjunto FROM conjuntos ORDER BY numero_conjunto")
+        used_numbers = {row[0] for row in cur.fetchall()}
+        n = 1
+        while n in used_numbers:
+            n += 1
+        return n
+
+    def allocate():
+        # Cada asignación se deshace para medir siempre sobre el mismo estado
+        cur.execute("SAVEPOINT bench")
+        bot.allocate_conjunto_number(cur)
+        cur.execute("ROLLBACK TO SAVEPOINT bench")
+
+    report("recorrido completo (100k conjuntos)", timed(legacy, min(args.n, 50)))
+    report("sin números libres (MAX + 1)", timed(allocate, args.n))
+    start = time.perf_counter()
+    bot.sync_conjunto_numbers(cur)
+    print(f"{'':<45} sync_conjunto_numbers al iniciar: {(time.perf_counter() - start) * 1000:.1f} ms")
+    cur.execute("ANALYZE conjunto_numeros_libres")
+    report("menor número libre (lista de libres)", timed(allocate, args.n))
+    assert legacy() == (bot.allocate_conjunto_number(cur))
+    conn.rollback()
+    conn.close()
+
+
+@benchmark
+def bench_archive(args):
+    """Consultas de pedidos con 5 años de historial (1M pedidos): todo en 'orders' vs. archivo de entregados."""
+    conn = raw_connection()
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE conjuntos (id SERIAL PRIMARY KEY, numero_conjunto INTEGER NOT NULL, equipo_id INTEGER)")
+    cur.execute("CREATE TEMP TABLE orders (id SERIAL PRIMARY KEY, cart_id INTEGER NOT NULL, telegram_id BIGINT NOT NULL, confirmation_code TEXT, "
+                "status TEXT NOT NULL, order_date TIMESTAMP NOT NULL DEFAULT NOW(), entrega_date TIMESTAMP, conjunto_id INTEGER, payment_id TEXT)")
+    cur.execute("CREATE TEMP TABLE orders_archive (id INTEGER PRIMARY KEY, cart_id INTEGER, telegram_id BIGINT, confirmation_code TEXT, "
+                "status TEXT NOT NULL, order_date TIMESTAMP NOT NULL, entrega_date TIMESTAMP, conjunto_id INTEGER, archived_at TIMESTAMP NOT NULL DEFAULT NOW(), payment_id TEXT)")
+    # 5 años de pedidos entregados de 5000 clientes y 2000 pendientes recientes en 200 conjuntos
+    cur.execute("INSERT INTO conjuntos (numero_conjunto) SELECT g FROM generate_series(1, 200) g")
+    cur.execute("INSERT INTO orders (cart_id, telegram_id, confirmation_code, status, order_date, entrega_date) "
+                "SELECT g, 1 + g % 5000, 'E' || g, 'entregado', NOW() - random() * interval '1825 days', NULL "
+                "FROM generate_series(1, 1000000) g")
+    cur.execute("UPDATE orders SET entrega_date = order_date + interval '1 day'")
+    cur.execute("INSERT INTO orders (cart_id, telegram_id, confirmation_code, status, order_date, conjunto_id) "
+                "SELECT g, 1 + g % 5000, 'P' || g, 'pendiente', NOW() - random() * interval '1 day', 1 + g % 200 "
+                "FROM generate_series(1, 2000) g")
+    bot.create_orders_indexes(cur)
+    cur.execute("CREATE INDEX ON orders (telegram_id, order_date DESC)")
+    cur.execute("ANALYZE orders")
+    conn.commit()
+
+    def user():
+        return random.randint(1, 5000)
+
+    cases = [
+        # Sin índice: recorre la tabla entera, como cualquier consulta ad hoc sobre 'orders'
+        ("entregados del mes (recorrido)", lambda: cur.execute(
+            "SELECT COUNT(*) FROM orders WHERE status = 'entregado' AND entrega_date >= NOW() - interval '30 days'")),
+        ("pending_in_conjunto", lambda: bot.statements.execute(cur, "pending_in_conjunto", (random.randint(1, 200),))),
+        ("pending_orders", lambda: bot.statements.execute(cur, "pending_orders", (user(), 20))),
+        ("delivered_orders", lambda: (lambda t: bot.statements.execute(cur, "delivered_orders", (t, 20, t, 20, 20)))(user())),
+    ]
+
+    def run(tag):
+        cur.execute("SELECT pg_size_pretty(pg_total_relation_size('orders'))")
+        print(f"{tag}: orders ocupa {cur.fetchone()[0]}")
+        for label, func in cases:
+            n = min(args.n, 20) if "recorrido" in label else args.n
+            report(label, timed(lambda: (func(), cur.fetchall()), n))
+
+    run("sin archivo")
+    start = time.perf_counter()
+    archived = 0
+    while True:
+        moved = bot.archive_delivered_orders(cur, 30, 50000)
+        conn.commit()
+        archived += moved
+        if moved < 50000:
+            break
+    print(f"{'':<45} archivados {archived} pedidos en {time.perf_counter() - start:.1f} s")
+    # Como haría autovacuum luego del archivado
+    conn.autocommit = True
+    cur.execute("VACUUM FULL orders")
+    cur.execute("ANALYZE orders")
+    cur.execute("ANALYZE orders_archive")
+    conn.autocommit = False
+    run("con archivo")
+    conn.close()
+
+
+@benchmark
+def bench_stats(args):
+    """Estadísticas de 30 días con 1M de pedidos en 2 años: agregando orders/cart_items vs. resúmenes diarios."""
+    conn = raw_connection()
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE products (id SERIAL PRIMARY KEY, name TEXT, price NUMERIC, sale_type TEXT)")
+    cur.execute("CREATE TEMP TABLE conjuntos (id SERIAL PRIMARY KEY, numero_conjunto INTEGER NOT NULL, equipo_id INTEGER)")
+    cur.execute("CREATE TEMP TABLE orders (id SERIAL PRIMARY KEY, cart_id INTEGER NOT NULL, telegram_id BIGINT NOT NULL, confirmation_code TEXT, "
+                "status TEXT NOT NULL, order_date TIMESTAMP NOT NULL DEFAULT NOW(), entrega_date TIMESTAMP, conjunto_id INTEGER)")
+    cur.execute("CREATE TEMP TABLE orders_archive (LIKE orders)")
+    cur.execute("CREATE TEMP TABLE cart_items (id SERIAL PRIMARY KEY, cart_id INTEGER NOT NULL, product_id INTEGER NOT NULL, quantity NUMERIC NOT NULL, subtotal NUMERIC NOT NULL)")
+    cur.execute("CREATE TEMP TABLE ventas_diarias (dia DATE, product_id INTEGER, pedidos INTEGER NOT NULL DEFAULT 0, unidades NUMERIC NOT NULL DEFAULT 0, "
+                "gramos NUMERIC NOT NULL DEFAULT 0, ingresos NUMERIC NOT NULL DEFAULT 0, PRIMARY KEY (dia, product_id))")
+    cur.execute("CREATE TEMP TABLE pedidos_diarios (dia DATE, shard INTEGER, pedidos INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (dia, shard))")
+    cur.execute("CREATE TEMP TABLE entregas_diarias (dia DATE, equipo_id INTEGER, entregas INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (dia, equipo_id))")
+    cur.execute("INSERT INTO products (name, price, sale_type) SELECT 'producto ' || g, 100, CASE WHEN g % 2 = 0 THEN 'unidad' ELSE 'gramos' END "
+                "FROM generate_series(1, 200) g")
+    cur.execute("INSERT INTO orders (cart_id, telegram_id, confirmation_code, status, order_date) "
+                "SELECT g, 1 + g % 5000, 'E' || g, 'entregado', NOW() - random() * interval '730 days' FROM generate_series(1, 1000000) g")
+    cur.execute("UPDATE orders SET entrega_date = order_date + interval '1 day'")
+    cur.execute("INSERT INTO cart_items (cart_id, product_id, quantity, subtotal) "
+                "SELECT g, 1 + (g * 7 + k) % 200, 1 + k, 100 * (1 + k) FROM generate_series(1, 1000000) g, generate_series(0, 1) k")
+    cur.execute("CREATE INDEX ON cart_items (cart_id)")
+    cur.execute("ANALYZE")
+    conn.commit()
+    hasta = datetime.date.today()
+    desde = hasta - datetime.timedelta(days=29)
+
+    def raw():
+        # Lo que haría /stats sin resúmenes
+        cur.execute("SELECT COUNT(*), COALESCE(SUM(ci.subtotal), 0) FROM orders o LEFT JOIN cart_items ci ON ci.cart_id = o.cart_id "
+                    "WHERE o.order_date::date BETWEEN %s AND %s", (desde, hasta))
+        cur.execute("SELECT COUNT(*) FROM orders WHERE status = 'entregado' AND entrega_date::date BETWEEN %s AND %s", (desde, hasta))
+        cur.execute("SELECT p.name, COUNT(DISTINCT o.id), SUM(ci.quantity), SUM(ci.subtotal) FROM orders o "
+                    "JOIN cart_items ci ON ci.cart_id = o.cart_id JOIN products p ON p.id = ci.product_id "
+                    "WHERE o.order_date::date BETWEEN %s AND %s GROUP BY p.id, p.name ORDER BY 4 DESC LIMIT 10", (desde, hasta))
+        return cur.fetchall()
+
+    report("agregando orders/cart_items", timed(raw, min(args.n, 10)))
+    start = time.perf_counter()
+    bot.rebuild_sales_rollups(cur)
+    print(f"{'':<45} reconstrucción de resúmenes: {time.perf_counter() - start:.1f} s")
+    cur.execute("ANALYZE")
+    report("resúmenes diarios", timed(lambda: bot.query_sales_stats(cur, desde, hasta), args.n))
+    assert [row[3] for row in raw()] == [row[4] for row in bot.query_sales_stats(cur, desde, hasta)["productos"]]
+
+    cur.execute("INSERT INTO orders (cart_id, telegram_id, status) VALUES (1, 1, 'pendiente')")
+    report("costo por pedido (record_sale)", timed(lambda: bot.record_sale(cur, random.randint(1, 1000000)), args.n))
+    conn.rollback()
+    conn.close()
+
+
+@benchmark
+def bench_export(args):
+    """Exportación de 1M de líneas de pedidos a CSV y Parquet con cursor con nombre: filas/s y memoria máxima."""
+    conn = raw_connection()
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE products (id SERIAL PRIMARY KEY, name TEXT, price NUMERIC, sale_type TEXT)")
+    cur.execute("CREATE TEMP TABLE users (telegram_id BIGINT PRIMARY KEY, name TEXT, address TEXT)")
+    cur.execute("CREATE TEMP TABLE orders (id SERIAL PRIMARY KEY, cart_id INTEGER NOT NULL, telegram_id BIGINT NOT NULL, confirmation_code TEXT, "
+                "status TEXT NOT NULL, order_date TIMESTAMP NOT NULL DEFAULT NOW(), entrega_date TIMESTAMP, conjunto_id INTEGER)")
+    cur.execute("CREATE TEMP TABLE orders_archive (LIKE orders)")
+    cur.execute("CREATE TEMP TABLE cart_items (id SERIAL PRIMARY KEY, cart_id INTEGER NOT NULL, product_id INTEGER NOT NULL, quantity NUMERIC NOT NULL, subtotal NUMERIC NOT NULL)")
+    cur.execute("INSERT INTO products (name, price, sale_type) SELECT 'producto ' || g, 100, 'gramos' FROM generate_series(1, 200) g")
+    cur.execute("INSERT INTO users SELECT g, 'cliente ' || g, 'calle ' || g FROM generate_series(1, 5000) g")
+    cur.execute("INSERT INTO orders (cart_id, telegram_id, confirmation_code, status, order_date, entrega_date) "
+                "SELECT g, 1 + g % 5000, 'E' || g, 'entregado', NOW() - random() * interval '365 days', NOW() FROM generate_series(1, 500000) g")
+    cur.execute("INSERT INTO cart_items (cart_id, product_id, quantity, subtotal) "
+                "SELECT g, 1 + (g * 7 + k) % 200, 250 * (1 + k), 100 * (1 + k) FROM generate_series(1, 500000) g, generate_series(0, 1) k")
+    cur.execute("CREATE INDEX ON cart_items (cart_id)")
+    cur.execute("ANALYZE")
+    conn.commit()
+    hasta = datetime.date.today()
+    desde = hasta - datetime.timedelta(days=365)
+
+    def rss_mb():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def write_csv(chunks, path):
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            return bot.write_orders_csv(chunks, f)
+
+    writers = [("csv", write_csv)]
+    if importlib.util.find_spec("pyarrow"):
+        writers.append(("parquet", bot.write_orders_parquet))
+    else:
+        print("pyarrow no está instalado: se omite parquet")
+    print(f"{'':<45} memoria máxima antes de exportar: {rss_mb():.0f} MB")
+    for fmt, write in writers:
+        with tempfile.NamedTemporaryFile(suffix=f".{fmt}") as f:
+            start = time.perf_counter()
+            rows = write(bot.iter_export_rows(conn, desde, hasta), f.name)
+            elapsed = time.perf_counter() - start
+            conn.commit()
+            size = os.path.getsize(f.name) / 1024 / 1024
+        print(f"{fmt:<45} {rows} filas en {elapsed:.1f} s ({rows / elapsed:,.0f} filas/s), "
+              f"{size:.0f} MB, memoria máxima {rss_mb():.0f} MB")
+    # Referencia: traer todo con fetchall (lo que hace una consulta manual)
+    start = time.perf_counter()
+    cur.execute("SELECT o.id, ci.quantity FROM orders o JOIN cart_items ci ON ci.cart_id = o.cart_id")
+    rows = cur.fetchall()
+    print(f"{'fetchall (referencia, 2 columnas)':<45} {len(rows)} filas en {time.perf_counter() - start:.1f} s, "
+          f"memoria máxima {rss_mb():.0f} MB")
+    conn.rollback()
+    conn.close()
+
+
+@benchmark
+def bench_reconcile(args):
+    """Conciliación de 20k pagos aprobados contra un servidor local que imita la búsqueda de MercadoPago."""
+    total, missing_every = 20000, 100
+    now = datetime.datetime.now(datetime.timezone.utc)
+    payments = [{
+        "id": 5000000 + i,
+        "external_reference": str(i + 1),
+        "date_created": (now - datetime.timedelta(seconds=(total - i) * 8)).isoformat(),
+        "date_approved": (now - datetime.timedelta(seconds=(total - i) * 8 - 5)).isoformat(),
+    } for i in range(total)]
+
+    class SearchStub(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            offset, limit = int(query["offset"][0]), int(query["limit"][0])
+            body = json.dumps({"paging": {"total": total, "offset": offset, "limit": limit},
+                               "results": payments[offset:offset + limit]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SearchStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    bot.MP_API_BASE_URL = f"http://127.0.0.1:{server.server_port}"
+
+    conn = raw_connection()
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE carts (id SERIAL PRIMARY KEY, telegram_id BIGINT NOT NULL, name TEXT NOT NULL, total NUMERIC NOT NULL DEFAULT 0)")
+    cur.execute("CREATE TEMP TABLE orders (id SERIAL PRIMARY KEY, cart_id INTEGER NOT NULL, telegram_id BIGINT NOT NULL, confirmation_code TEXT, "
+                "status TEXT NOT NULL, order_date TIMESTAMP NOT NULL DEFAULT NOW(), entrega_date TIMESTAMP, conjunto_id INTEGER, payment_id TEXT)")
+    cur.execute("CREATE TEMP TABLE orders_archive (LIKE orders)")
+    cur.execute("INSERT INTO carts (telegram_id, name) SELECT g, 'c' FROM generate_series(1, %s) g", (total,))
+    # Todos los pagos tienen pedido salvo uno de cada 'missing_every' (webhook perdido)
+    cur.execute("INSERT INTO orders (cart_id, telegram_id, status, payment_id) "
+                "SELECT g, g, 'pendiente', (5000000 + g - 1)::text FROM generate_series(1, %s) g WHERE g %% %s <> 0",
+                (total, missing_every))
+    cur.execute("CREATE UNIQUE INDEX ON orders (payment_id)")
+    cur.execute("CREATE INDEX ON orders (cart_id)")
+    cur.execute("ANALYZE")
+    conn.commit()
+
+    async def reconcile():
+        found, first_found = [], None
+        start = time.perf_counter()
+        async with bot.httpx.AsyncClient(timeout=30) as client:
+            async for page in bot.iter_approved_payments(client, now - datetime.timedelta(days=3), now):
+                found.extend(bot.find_missing_payments(cur, page))
+                if found and first_found is None:
+                    first_found = time.perf_counter() - start
+        return found, time.perf_counter() - start, first_found
+
+    for page_size in (50, 100):
+        bot.RECONCILE_PAGE_SIZE = page_size
+        found, elapsed, first_found = asyncio.run(reconcile())
+        assert len(found) == total // missing_every
+        print(f"{'páginas de ' + str(page_size):<45} {total} pagos en {elapsed:.2f} s ({total / elapsed:,.0f} pagos/s), "
+              f"{len(found)} sin pedido, primero detectado a los {first_found * 1000:.0f} ms")
+    print(f"{'':<45} un pago perdido se detecta a lo sumo RECONCILE_GRACE + RECONCILE_INTERVAL = "
+          f"{bot.RECONCILE_GRACE + bot.RECONCILE_INTERVAL} s después de aprobado")
+    server.shutdown()
+    conn.rollback()
+    conn.close()
+
+
+@benchmark
+def bench_logging(args):
+    """Costo de logging por update en el hilo que atiende: handler síncrono + print vs. cola con JSON y muestreo."""
+    update = {
+        "update_id": 123456789,
+        "callback_query": {
+            "id": "4382bfdwdsb323b2d9", "chat_instance": "-1234567890", "data": "cm:12",
+            "from": {"id": 987654321, "is_bot": False, "first_name": "Cliente", "language_code": "es"},
+            "message": {"message_id": 4321, "date": 1700000000, "chat": {"id": 987654321, "type": "private"},
+                        "text": "Carrito 'semana'\n" + "Producto: 250 = 500.00\n" * 20},
+        },
+    }
+    carts = [{"id": i, "name": f"carrito {i}", "total": 1234.5} for i in range(20)]
+    with tempfile.TemporaryDirectory() as tmp:
+        # Como antes: StreamHandler a archivo, print + flush del update y f-strings siempre evaluadas
+        legacy = logging.getLogger("bench.legacy")
+        legacy.propagate = False
+        legacy.setLevel(logging.INFO)
+        legacy_handler = logging.FileHandler(os.path.join(tmp, "legacy.log"))
+        legacy_handler.setFormatter(logging.Formatter(bot.TEXT_LOG_FORMAT))
+        legacy.addHandler(legacy_handler)
+        stdout = open(os.path.join(tmp, "stdout.log"), "w")
+
+        def legacy_update():
+            legacy.info("Webhook triggered. Data received: %s", update)
+            print("Webhook triggered. Data received:", update, file=stdout)
+            stdout.flush()
+            legacy.info("Update object creado correctamente")
+            legacy.debug(f"Carritos del usuario: {carts}")
+            legacy.info(f"cart_menu_handler invocado para el carrito {12}")
+            legacy.info("Update procesado correctamente")
+
+        # Ahora: cola + hilo escritor con JSON, payload muestreado y formateo diferido
+        current = logging.getLogger("bench.queue")
+        current.propagate = False
+        current.setLevel(logging.INFO)
+        target = logging.FileHandler(os.path.join(tmp, "json.log"))
+        target.setFormatter(bot.JsonFormatter())
+        queue_handler, listener = bot.build_queue_logging(target, queue_size=1000000)
+        current.addHandler(queue_handler)
+        listener.start()
+
+        def queued_update():
+            bot.set_log_context(update_id=update["update_id"], chat_id=987654321, user_id=987654321, handler="cart_menu_handler")
+            bot.log_payload(current, logging.INFO, "Webhook triggered (update %s)", update, update["update_id"])
+            current.debug("Carritos del usuario: %s", carts)
+            current.debug("cart_menu_handler invocado para el carrito %s", 12)
+            current.debug("Update %s procesado correctamente", update["update_id"])
+
+        report("handler síncrono + print (antes)", timed(legacy_update, args.n))
+        report(f"cola + JSON, payload al {bot.LOG_PAYLOAD_SAMPLE:.0%}", timed(queued_update, args.n))
+        start = time.perf_counter()
+        listener.stop()
+        print(f"{'':<45} vaciado de la cola en el hilo escritor: {(time.perf_counter() - start) * 1000:.1f} ms")
+        for name in ("legacy.log", "stdout.log", "json.log"):
+            print(f"{'':<45} {name}: {os.path.getsize(os.path.join(tmp, name)) / 1024:.0f} KB")
+        stdout.close()
+        legacy_handler.close()
+        target.close()
+
+
+@benchmark
+def bench_ingest(args):
+    """Costo de ingreso por update en /webhook2: Update.de_json de todo vs. filtro sobre el JSON crudo."""
+    from telegram import Update
+
+    now = int(time.time())
+    user = {"id": 987654321, "is_bot": False, "first_name": "Cliente", "language_code": "es"}
+    chat = {"id": 987654321, "type": "private", "first_name": "Cliente"}
+    message = {"message_id": 10, "date": now, "chat": chat, "from": user, "text": "/start",
+               "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}
+    kinds = [
+        (40, lambda uid: {"update_id": uid, "message": message}),
+        (30, lambda uid: {"update_id": uid, "callback_query": {
+            "id": str(uid), "chat_instance": "-1", "from": user, "data": "cm:12",
+            "message": {**message, "text": "Menú principal", "from": {**user, "is_bot": True}}}}),
+        (10, lambda uid: {"update_id": uid, "edited_message": {**message, "edit_date": now}}),
+        (5, lambda uid: {"update_id": uid, "my_chat_member": {
+            "chat": chat, "from": user, "date": now,
+            "old_chat_member": {"status": "member", "user": user},
+            "new_chat_member": {"status": "kicked", "user": user, "until_date": 0}}}),
+        (5, lambda uid: {"update_id": uid, "message": {**message, "date": now - 86400}}),
+    ]
+    # Mezcla de updates con un 10% de reintentos de Telegram (update_id repetido)
+    updates = []
+    uid = 1
+    for _ in range(args.n):
+        roll = random.randint(1, 100)
+        if roll > 90 and updates:
+            updates.append(random.choice(updates[-50:]))
+            continue
+        for weight, make in kinds:
+            roll -= weight
+            if roll <= 0:
+                break
+        updates.append(make(uid))
+        uid += 1
+    bodies = [json.dumps(update) for update in updates]
+
+    def legacy():
+        for body in bodies:
+            Update.de_json(json.loads(body), bot.TELEGRAM_BOT)
+
+    def filtered():
+        ingest = bot.UpdateIngestFilter(bot.ALLOWED_UPDATES)
+        passed = 0
+        for body in bodies:
+            data = json.loads(body)
+            action, _ = ingest.check(data)
+            if action == "procesar":
+                Update.de_json(data, bot.TELEGRAM_BOT)
+                passed += 1
+        return passed, ingest.get_stats()
+
+    for label, func in (("de_json de todos (antes)", legacy), ("filtro + de_json de los útiles", filtered)):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        print(f"{label:<45} {elapsed / len(bodies) * 1e6:8.1f} us por update")
+    passed, stats = result
+    print(f"{'':<45} {passed} de {len(bodies)} llegan a la aplicación: {stats}")
+
+
+
+@benchmark
+def bench_search(args):
+    """Búsqueda de productos: escaneo con ILIKE en la base vs. índice en memoria del catálogo."""
+    words = ["Limón", "Tomate", "Lechuga", "Papa", "Batata", "Zanahoria", "Cebolla", "Manzana",
+             "Pera", "Naranja", "Mandarina", "Zapallo", "Acelga", "Espinaca", "Pimiento", "Ajo"]
+    variants = ["", "roja", "verde", "orgánica", "criolla", "x kg", "especial", "premium"]
+    products = [{"id": i, "name": " ".join(filter(None, (words[i % len(words)], variants[i // len(words) % len(variants)], str(i)))),
+                 "price": 100, "sale_type": "unidad"} for i in range(1, 2001)]
+    queries = ["limon", "toma", "zanahoria org", "mandarna", "pimiento verde", "ajo", "cebol", "manzana roja 1"]
+
+    conn = raw_connection()
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE bench_products (id int PRIMARY KEY, name text NOT NULL)")
+    cur.executemany("INSERT INTO bench_products VALUES (%s, %s)", [(p["id"], p["name"]) for p in products])
+    conn.commit()
+
+    def ilike():
+        cur.execute("SELECT id, name FROM bench_products WHERE name ILIKE %s ORDER BY id LIMIT 50",
+                    (f"%{random.choice(queries)}%",))
+        cur.fetchall()
+
+    start = time.perf_counter()
+    index = bot.ProductIndex(products)
+    print(f"{'construcción del índice (2000 productos)':<45} {(time.perf_counter() - start) * 1e3:8.1f} ms")
+    report("ILIKE en Postgres (antes, sin tildes ni errores)", timed(ilike, args.n))
+    report("ProductIndex.search", timed(lambda: index.search(random.choice(queries), 50), args.n))
+    for query in queries:
+        print(f"  {query!r:<20} -> {[p['name'] for p in index.search(query, 3)]}")
+    conn.close()
+
+
+
+@benchmark
+def bench_stock(args):
+    """Checkouts concurrentes del mismo producto: leer-verificar-escribir vs. reserva con UPDATE condicional."""
+    threads, stock, per_cart = 16, 10000, 300  # el último kilo se lo disputan todos
+    carts = args.n
+    # Las reservas compiten entre conexiones, así que no alcanza con tablas temporales:
+    # se usa un esquema propio que se borra al terminar
+    setup = raw_connection()
+    cur = setup.cursor()
+    cur.execute("DROP SCHEMA IF EXISTS bench_stock CASCADE")
+    cur.execute("CREATE SCHEMA bench_stock")
+    cur.execute("SET search_path TO bench_stock")
+    cur.execute("CREATE TABLE products (id SERIAL PRIMARY KEY, name TEXT NOT NULL, price NUMERIC NOT NULL, sale_type TEXT NOT NULL)")
+    cur.execute("CREATE TABLE cart_items (id SERIAL PRIMARY KEY, cart_id INTEGER NOT NULL, product_id INTEGER NOT NULL, "
+                "quantity NUMERIC NOT NULL, subtotal NUMERIC NOT NULL)")
+    cur.execute("CREATE INDEX ON cart_items (cart_id)")
+    bot.init_stock(cur)
+    cur.execute("INSERT INTO products (name, price, sale_type) VALUES ('Limón', 100, 'gramos')")
+    cur.execute("INSERT INTO cart_items (cart_id, product_id, quantity, subtotal) "
+                "SELECT g, 1, %s, 1 FROM generate_series(1, %s) g", (per_cart, carts))
+    setup.commit()
+
+    def run(label, checkout):
+        cur.execute("UPDATE products SET stock = %s", (stock,))
+        cur.execute("TRUNCATE stock_reservations")
+        setup.commit()
+        pending = list(range(1, carts + 1))
+        lock = threading.Lock()
+        results = {"ok": 0, "sin_stock": 0, "error": 0}
+        samples = []
+
+        def worker():
+            conn = raw_connection()
+            wcur = conn.cursor()
+            wcur.execute("SET search_path TO bench_stock")
+            conn.commit()
+            while True:
+                with lock:
+                    if not pending:
+                        break
+                    cart_id = pending.pop()
+                start = time.perf_counter()
+                try:
+                    checkout(wcur, cart_id)
+                    conn.commit()
+                    outcome = "ok"
+                except bot.OutOfStockError:
+                    conn.rollback()
+                    outcome = "sin_stock"
+                except psycopg2.Error:
+                    conn.rollback()
+                    outcome = "error"
+                with lock:
+                    results[outcome] += 1
+                    samples.append((time.perf_counter() - start) * 1e6)
+            conn.close()
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        cur.execute("SELECT stock FROM products WHERE id = 1")
+        final = cur.fetchone()[0]
+        setup.commit()
+        report(label, samples)
+        sold = results["ok"] * per_cart
+        print(f"{'':<45} {carts / elapsed:,.0f} checkouts/s, {results}, vendido {sold} g de {stock} g "
+              f"(stock final {final}{', SOBREVENTA' if sold > stock else ''})")
+
+    def read_modify_write(wcur, cart_id):
+        wcur.execute("SELECT product_id, SUM(quantity) FROM cart_items WHERE cart_id = %s GROUP BY product_id", (cart_id,))
+        for product_id, quantity in wcur.fetchall():
+            wcur.execute("SELECT stock FROM products WHERE id = %s", (product_id,))
+            available = wcur.fetchone()[0]
+            if available < quantity:
+                raise bot.OutOfStockError([("Limón", "gramos", available, quantity)])
+            wcur.execute("UPDATE products SET stock = %s WHERE id = %s", (available - quantity, product_id))
+
+    run("leer, verificar y escribir (sin reserva)", read_modify_write)
+    run("reserve_stock (UPDATE condicional)", bot.reserve_stock)
+    cur.execute("DROP SCHEMA bench_stock CASCADE")
+    setup.commit()
+    setup.close()
+
+
+
+@benchmark
+def bench_conjunto_pdf(args):
+    """Descarga del PDF de un conjunto: generarlo en el callback vs. enviar el pre-generado."""
+    conjuntos, items = 200, 4
+    # Todo corre en una unidad de trabajo: las tablas temporales (que tapan a las reales) las
+    # ven todos los helpers que usan la conexión de la unidad, y se borran en su commit
+    with bot.unit_of_work():
+        with bot.db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("CREATE TEMP TABLE users (telegram_id BIGINT PRIMARY KEY, name TEXT NOT NULL, address TEXT NOT NULL) ON COMMIT DROP")
+            cur.execute("CREATE TEMP TABLE products (id SERIAL PRIMARY KEY, name TEXT NOT NULL, price NUMERIC NOT NULL, sale_type TEXT NOT NULL) ON COMMIT DROP")
+            cur.execute("CREATE TEMP TABLE cart_items (id SERIAL PRIMARY KEY, cart_id INTEGER NOT NULL, product_id INTEGER NOT NULL, "
+                        "quantity NUMERIC NOT NULL, subtotal NUMERIC NOT NULL) ON COMMIT DROP")
+            cur.execute("CREATE TEMP TABLE orders (id SERIAL PRIMARY KEY, cart_id INTEGER NOT NULL, telegram_id BIGINT NOT NULL, "
+                        "confirmation_code TEXT, status TEXT NOT NULL, order_date TIMESTAMP NOT NULL DEFAULT NOW(), "
+                        "entrega_date TIMESTAMP, conjunto_id INTEGER) ON COMMIT DROP")
+            orders = conjuntos * bot.CONJUNTO_SIZE
+            cur.execute("INSERT INTO users SELECT g, 'Cliente ' || g, 'Calle ' || g FROM generate_series(1, %s) g", (orders,))
+            cur.execute("INSERT INTO products (name, price, sale_type) SELECT 'Producto ' || g, 100, 'unidad' FROM generate_series(1, 50) g")
+            cur.execute("INSERT INTO cart_items (cart_id, product_id, quantity, subtotal) "
+                        "SELECT c, 1 + (c * 7 + i) %% 50, i, 100 * i FROM generate_series(1, %s) c, generate_series(1, %s) i",
+                        (orders, items))
+            cur.execute("INSERT INTO orders (cart_id, telegram_id, confirmation_code, status, conjunto_id) "
+                        "SELECT g, g, lpad(g::text, 6, '0'), 'pendiente', 1 + (g - 1) / %s FROM generate_series(1, %s) g",
+                        (bot.CONJUNTO_SIZE, orders))
+            cur.execute("CREATE INDEX ON cart_items (cart_id)")
+            cur.execute("CREATE INDEX ON orders (conjunto_id)")
+            cur.execute("ANALYZE")
+            cur.close()
+
+        documents = bot.ConjuntoDocuments(1, conjuntos, conjuntos * bot.CONJUNTO_SIZE)
+        start = time.perf_counter()
+        for conjunto_id in range(1, conjuntos + 1):
+            # Lo que hace cada hilo del pool (los hilos no verían las tablas temporales)
+            documents._prerender(conjunto_id)
+        print(f"{'pre-generación (pool en segundo plano)':<45} {(time.perf_counter() - start) / conjuntos * 1e3:8.2f} ms por conjunto")
+
+        pick = lambda: random.randint(1, conjuntos)
+        report("generate_conjunto_pdf en el callback (antes)", timed(lambda: bot.generate_conjunto_pdf(pick(), False), args.n))
+        report("PDF pre-generado", timed(lambda: documents.get(pick(), False), args.n))
+
+        def changed():
+            # Cambió el estado de un pedido: el conjunto se regenera con los bloques guardados
+            conjunto_id = pick()
+            documents.discard([conjunto_id])
+            documents.get(conjunto_id, False)
+        report("regeneración incremental tras un cambio", timed(changed, args.n))
+        print(f"{'':<45} {documents.get_stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks de bot.py")
+    parser.add_argument("name", nargs="?", help="benchmark a ejecutar")
+    parser.add_argument("--n", type=int, default=2000, help="iteraciones por caso")
+    parser.add_argument("--list", action="store_true", help="lista los benchmarks disponibles")
+    args = parser.parse_args()
+    if args.list or not args.name:
+        for name, func in BENCHMARKS.items():
+            print(f"{name:<20} {func.__doc__.strip()}")
+    else:
+        BENCHMARKS[args.name](args)
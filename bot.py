@@ -22,27 +22,62 @@ AsyncIOScheduler._configure = patched_configure
 
 
 import logging
+import logging.handlers
 import psycopg2
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import (
+    Update,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    KeyboardButton,
+    ReplyKeyboardMarkup,
+    ReplyKeyboardRemove,
+)
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ConversationHandler,
     ContextTypes,
+    InlineQueryHandler,
     filters
 )
-import sys  # Asegúrate de importarlo para forzar el vaciado del buffer de stdout
-from cachetools import cached, TTLCache
+from cachetools import cached, TTLCache, LRUCache
+from cachetools.keys import hashkey
 import mercadopago
 import datetime
 import random
+import secrets
+import csv
+import io
+import tempfile
+import unicodedata
+import decimal
+import re
+import functools
+import hashlib
+import hmac
+import json
+import httpx
+import heapq
+import itertools
+import concurrent.futures
+import math
+import atexit
+import copy
+import queue
 import os
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, send_file
 import threading
+import time
+import contextvars
+import traceback
+from contextlib import contextmanager
 from psycopg2 import pool
-from telegram.error import BadRequest
+from telegram.error import BadRequest, Forbidden, RetryAfter
 
 
 app = Flask(__name__)
@@ -58,7 +93,7 @@ allowed_ids = [ADMIN_CHAT_ID, PROVIDER_CHAT_ID]  # Puedes agregar los IDs del pe
 
 
 def admin_only(func):
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
         user_id = update.effective_user.id
         if user_id not in allowed_ids:
             # Si viene por mensaje
@@ -68,14 +103,147 @@ def admin_only(func):
             elif update.callback_query:
                 await update.callback_query.answer("No tienes permisos para usar esta función.", show_alert=True)
             return ConversationHandler.END
-        return await func(update, context)
+        return await func(update, context, *args)
     return wrapper
 
 
-# Configuración de logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
-)
+#########################################
+# LOGGING ESTRUCTURADO Y ASÍNCRONO
+#########################################
+
+# Los handlers de la aplicación solo encolan el registro (QueueHandler); un hilo aparte
+# (QueueListener) lo formatea y lo escribe, así la E/S de logs no suma al tiempo de cada
+# update. Cada registro lleva los campos del update en curso (update_id, chat_id, user_id,
+# handler), tomados de una ContextVar. Por defecto (LOG_FORMAT=text) se mantiene el formato
+# de texto de siempre; con LOG_FORMAT=json se escribe un JSON por línea con esos campos.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Los payloads (updates, pagos) se registran en una fracción de las llamadas y recortados
+LOG_PAYLOAD_SAMPLE = float(os.getenv("LOG_PAYLOAD_SAMPLE", "0.1"))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000"))
+LOG_CONTEXT_FIELDS = ("update_id", "chat_id", "user_id", "handler")
+TEXT_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_log_context = contextvars.ContextVar("log_context", default={})
+log_stats = {"dropped": 0, "payloads_logged": 0, "payloads_skipped": 0}
+
+
+def set_log_context(**fields):
+    """Agrega campos al contexto de logging de la tarea actual (no modifica el de otras)."""
+    _log_context.set({**_log_context.get(), **fields})
+
+
+class LogContextFilter(logging.Filter):
+    """Copia al registro los campos del contexto (se ejecuta en el hilo que loguea)."""
+
+    def filter(self, record):
+        context = _log_context.get()
+        for field in LOG_CONTEXT_FIELDS:
+            setattr(record, field, context.get(field))
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Un objeto JSON por registro, con los campos de contexto que no sean None."""
+
+    def format(self, record):
+        data = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in LOG_CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler con cola acotada: si se llena, descarta el registro y lo cuenta."""
+
+    def prepare(self, record):
+        # Como QueueHandler.prepare, pero deja la excepción aparte del mensaje (campo "exc")
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_stats["dropped"] += 1
+
+
+_exception_formatter = logging.Formatter()
+
+
+def build_queue_logging(target, queue_size=LOG_QUEUE_SIZE):
+    """Retorna (queue_handler, listener) que escriben en 'target' desde un hilo aparte."""
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    queue_handler.addFilter(LogContextFilter())
+    listener = logging.handlers.QueueListener(queue_handler.queue, target, respect_handler_level=True)
+    return queue_handler, listener
+
+
+def setup_logging():
+    """Configura el logger raíz con la cola y arranca el hilo que escribe en stderr."""
+    target = logging.StreamHandler()
+    target.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_LOG_FORMAT))
+    queue_handler, listener = build_queue_logging(target)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class PayloadSample:
+    """Payload que se serializa (recortado) solo si el registro llega a formatearse."""
+    __slots__ = ("payload",)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        try:
+            text = json.dumps(self.payload, ensure_ascii=False, default=str)
+        except (TypeError, ValueError):
+            text = repr(self.payload)
+        if len(text) > LOG_PAYLOAD_MAX_CHARS:
+            text = f"{text[:LOG_PAYLOAD_MAX_CHARS]}... ({len(text)} caracteres)"
+        return text
+
+
+def log_payload(logger, level, msg, payload, *args):
+    """
+    Registra 'msg' y, en una fracción LOG_PAYLOAD_SAMPLE de las llamadas, también el payload
+    recortado a LOG_PAYLOAD_MAX_CHARS. No hace nada si el nivel está deshabilitado.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if random.random() < LOG_PAYLOAD_SAMPLE:
+        log_stats["payloads_logged"] += 1
+        logger.log(level, msg + ": %s", *args, PayloadSample(payload))
+    else:
+        log_stats["payloads_skipped"] += 1
+        logger.log(level, msg, *args)
+
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 # Nuevos estados (asegúrate de que no colisionen con los existentes)
@@ -102,16 +270,540 @@ logger = logging.getLogger(__name__)
     CREAR_NUEVO_EQUIPO,
     CAMBIAR_DIRECCION
 ) = range(18)
+
+#########################################
+# CALLBACK DATA: CODIFICACIÓN Y ENRUTADO
+#########################################
+
+class CallbackCodec:
+    """
+    Codificación compacta y versionada del callback_data de los botones inline.
+    Formato: "<versión>:<código de acción>:<arg1>:<arg2>..." (por ejemplo "1:cm:12").
+    Cada acción se registra con un código corto y los tipos de sus argumentos, de modo que
+    decode() retorna (acción, args) con los argumentos ya convertidos, o None si no es válido.
+    Los botones viejos que siguen en los chats ("cartmenu_12", "back_main", ...) se
+    decodifican con la tabla de formatos legacy.
+    """
+    VERSION = "1"
+    SEP = ":"
+    MAX_BYTES = 64  # Límite de Telegram para callback_data
+
+    def __init__(self, cache_size=4096):
+        self._by_name = {}   # acción -> (código, tipos)
+        self._by_code = {}   # código -> (acción, tipos)
+        self._legacy_exact = {}
+        self._legacy_patterns = []
+        self.decode = functools.lru_cache(maxsize=cache_size)(self._decode)
+
+    def action(self, name, code, *arg_types):
+        """Registra una acción con su código corto y los tipos de sus argumentos."""
+        if code in self._by_code or self.SEP in code:
+            raise ValueError(f"Código de acción inválido o repetido: {code}")
+        self._by_name[name] = (code, arg_types)
+        self._by_code[code] = (name, arg_types)
+
+    def legacy(self, pattern, name, *fixed_args):
+        """
+        Registra un formato viejo de callback_data: una cadena exacta, o una regex compilada
+        cuyos grupos son los argumentos de la acción (a continuación de fixed_args).
+        """
+        if isinstance(pattern, str):
+            self._legacy_exact[pattern] = (name, fixed_args)
+        else:
+            self._legacy_patterns.append((pattern, name, fixed_args))
+
+    def encode(self, name, *args):
+        code, arg_types = self._by_name[name]
+        if len(args) != len(arg_types):
+            raise ValueError(f"La acción {name} espera {len(arg_types)} argumentos")
+        values = [str(a) for a in args]
+        if any(self.SEP in v for v in values):
+            raise ValueError(f"Argumento con '{self.SEP}' en la acción {name}")
+        data = self.SEP.join([self.VERSION, code] + values)
+        if len(data.encode("utf-8")) > self.MAX_BYTES:
+            raise ValueError(f"callback_data demasiado largo: {data}")
+        return data
+
+    def _convert(self, name, raw_args):
+        arg_types = self._by_name[name][1]
+        if len(raw_args) != len(arg_types):
+            return None
+        try:
+            return name, tuple(t(v) for t, v in zip(arg_types, raw_args))
+        except (TypeError, ValueError):
+            return None
+
+    def _decode(self, data):
+        parts = data.split(self.SEP)
+        if parts[0] == self.VERSION and len(parts) > 1:
+            entry = self._by_code.get(parts[1])
+            if entry is None:
+                return None
+            return self._convert(entry[0], parts[2:])
+        return self._decode_legacy(data)
+
+    def _decode_legacy(self, data):
+        if data in self._legacy_exact:
+            name, fixed_args = self._legacy_exact[data]
+            return self._convert(name, fixed_args)
+        for pattern, name, fixed_args in self._legacy_patterns:
+            m = pattern.match(data)
+            if m:
+                return self._convert(name, fixed_args + m.groups())
+        return None
+
+
+class CallbackRouter:
+    """
+    Enrutado de callback queries por estado de la conversación: cada estado tiene una tabla
+    acción -> handler, así que la búsqueda es un acceso a diccionario en lugar de probar
+    una regex por handler. Los handlers reciben los argumentos ya decodificados:
+    handler(update, context, *args).
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self._tables = {}
+
+    def add_routes(self, state, routes):
+        self._tables.setdefault(state, {}).update(routes)
+
+    def resolve(self, state, data):
+        """Retorna (handler, args) para el callback_data en el estado dado, o None."""
+        decoded = self.codec.decode(data) if isinstance(data, str) else None
+        if decoded is None:
+            return None
+        handler = self._tables.get(state, {}).get(decoded[0])
+        if handler is None:
+            return None
+        return handler, decoded[1]
+
+    def handler(self, state):
+        """CallbackQueryHandler único para el estado; deja pasar las acciones que no enruta."""
+        def matches(data):
+            return self.resolve(state, data) is not None
+
+        async def dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            handler, args = self.resolve(state, update.callback_query.data)
+            set_log_context(handler=handler.__name__)
+            return await handler(update, context, *args)
+
+        return CallbackQueryHandler(dispatch, pattern=matches)
+
+
+def with_handler_log_context(callback):
+    """Envuelve un callback para que sus registros lleven su nombre en el campo 'handler'."""
+    name = getattr(callback, "__name__", None)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        set_log_context(handler=name)
+        return await callback(update, context)
+
+    wrapper.logs_handler_name = True
+    return wrapper
+
+
+def log_handler_names(handlers):
+    """
+    Envuelve (una sola vez, al registrar) los callbacks de los handlers con
+    with_handler_log_context, entrando en las conversaciones. Los callback queries enrutados
+    por CallbackRouter ponen el nombre del handler final al despachar.
+    """
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            log_handler_names(handler.entry_points)
+            for state_handlers in handler.states.values():
+                log_handler_names(state_handlers)
+            log_handler_names(handler.fallbacks)
+        elif not getattr(handler.callback, "logs_handler_name", False):
+            handler.callback = with_handler_log_context(handler.callback)
+
+
+callbacks = CallbackCodec()
+cb = callbacks.encode
+
+# Acciones: nombre, código corto y tipos de los argumentos
+callbacks.action("menu", "m", str)
+callbacks.action("back_main", "bm")
+callbacks.action("gestion", "g")
+callbacks.action("gestion_personal", "gp")
+callbacks.action("cancelar_direccion", "cd")
+callbacks.action("product", "p", int)
+callbacks.action("new_cart", "nc")
+callbacks.action("show_carts", "sc")
+callbacks.action("cart_menu", "cm", int)
+callbacks.action("cart_details", "cv", int)
+callbacks.action("cart_add", "ca", int)
+callbacks.action("cart_remove", "cr", int)
+callbacks.action("cart_removeitem", "ci", int, int)
+callbacks.action("cart_delete", "cx", int)
+callbacks.action("cart_pay", "cp", int)
+callbacks.action("select_cart", "sl", int)
+callbacks.action("back_quantity", "bq")
+callbacks.action("add_more", "am")
+callbacks.action("pay_cart", "pc")
+callbacks.action("descargar_pdf", "dp", int)
+callbacks.action("asignar_conjuntos", "ac")
+callbacks.action("revocar_conjuntos", "rc")
+callbacks.action("ver_equipos", "ve")
+callbacks.action("crear_equipo", "ne")
+callbacks.action("eliminar_equipos", "ee")
+callbacks.action("ver_no_terminados", "nt")
+callbacks.action("select_conjunto", "sj", int)
+callbacks.action("asignar", "a", int, int)
+callbacks.action("descargar_conjunto", "dc", int)
+callbacks.action("revocar_equipo", "re", int)
+callbacks.action("revocar_conjunto", "rj", int)
+callbacks.action("ver_equipo", "vq", int)
+callbacks.action("multiselect", "ms")
+callbacks.action("toggle_conjunto", "tj", int)
+callbacks.action("assign_selected", "as")
+callbacks.action("asignar_seleccion", "ax", int)
+callbacks.action("revocar_equipo_todos", "rt", int)
+callbacks.action("products_page", "pg", int, int, int, int)
+
+# Formatos viejos (botones enviados antes de la versión 1 del callback_data)
+for _legacy, _name in [
+    ("back_main", "back_main"), ("menu", "back_main"), ("gestion_pedidos", "gestion"),
+    ("gestion_pedidos_personal", "gestion_personal"), ("cancelar_direccion", "cancelar_direccion"),
+    ("new_cart", "new_cart"), ("show_carts", "show_carts"), ("back_quantity", "back_quantity"),
+    ("add_more", "add_more"), ("pay_cart", "pay_cart"), ("asignar_conjuntos", "asignar_conjuntos"),
+    ("revocar_conjuntos", "revocar_conjuntos"), ("ver_equipos", "ver_equipos"),
+    ("crear_nuevo_equipo", "crear_equipo"), ("eliminar_equipos", "eliminar_equipos"),
+    ("ver_conjuntos_no_terminados", "ver_no_terminados"),
+]:
+    callbacks.legacy(_legacy, _name)
+for _regex, _name in [
+    (r"menu_([a-z]+)", "menu"), (r"product_(\d+)", "product"), (r"cartmenu_(\d+)", "cart_menu"),
+    (r"back_cart_(\d+)", "cart_menu"), (r"cart_details_(\d+)", "cart_details"),
+    (r"cart_add_(\d+)", "cart_add"), (r"cart_remove_(\d+)", "cart_remove"),
+    (r"cart_removeitem_(\d+)_(\d+)", "cart_removeitem"), (r"cart_delete_(\d+)", "cart_delete"),
+    (r"cart_pay_(\d+)", "cart_pay"), (r"select_cart_(\d+)", "select_cart"),
+    (r"descargarpdf_(\d+)", "descargar_pdf"), (r"select_conjunto_(\d+)", "select_conjunto"),
+    (r"asignar_(\d+)_equipo_(\d+)", "asignar"), (r"descargar_conjunto_(\d+)", "descargar_conjunto"),
+    (r"revocar_equipo_(\d+)", "revocar_equipo"), (r"revocar_conjunto_(\d+)", "revocar_conjunto"),
+    (r"ver_equipo_(\d+)", "ver_equipo"),
+]:
+    callbacks.legacy(re.compile(_regex + "$"), _name)
  
 
 # Crea un cache con un tiempo de vida de 300 segundos (5 minutos)
 user_info_cache = TTLCache(maxsize=1000, ttl=300)
 
-# Nota: Los estados CARTS_LIST y CART_MENU ya están definidos anteriormente (ej. 8 y 9).
-# Configura el pool (ajusta los parámetros según tu entorno)
-db_pool = pool.ThreadedConnectionPool(
-    minconn=1,
-    maxconn=20,
+#########################################
+# POOL DE CONEXIONES A LA BASE DE DATOS
+#########################################
+
+class PoolTimeoutError(pool.PoolError):
+    """Se lanza cuando no se libera ninguna conexión del pool dentro del tiempo de espera."""
+
+
+class ResilientConnectionPool:
+    """
+    Pool de conexiones a PostgreSQL seguro para hilos (reemplaza a ThreadedConnectionPool).
+
+    - getconn() espera hasta 'timeout' segundos cuando todas las conexiones están en uso,
+      en lugar de fallar de inmediato. Si ya hay 'max_waiting' hilos esperando, falla enseguida.
+    - Las conexiones que estuvieron inactivas más de 'ping_after' segundos se validan con
+      un SELECT 1 antes de entregarlas (pre-ping); si fallan se reemplazan por una nueva.
+    - Las conexiones con más de 'max_lifetime' segundos de vida se cierran y se reabren.
+    - Un hilo de fondo registra en el log el stack de quien retiene una conexión más de
+      'leak_threshold' segundos (detección de fugas).
+    - stats() devuelve las métricas de saturación del pool.
+    """
+
+    def __init__(self, minconn, maxconn, timeout=10.0, max_waiting=100, max_lifetime=1800.0,
+                 ping_after=30.0, leak_threshold=60.0, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_waiting = max_waiting
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+        self.leak_threshold = leak_threshold
+        self._connect_kwargs = connect_kwargs
+        self._cond = threading.Condition()
+        self._idle = []        # Conexiones libres (se reutiliza la última devuelta)
+        self._info = {}        # id(conn) -> {"conn", "created", "last_used", "checked_out_at", "stack", ...}
+        self._size = 0         # Conexiones abiertas (o abriéndose)
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+        self._close_listeners = []
+        self._leak_thread = None
+        self._counters = {
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "total_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+            "peak_in_use": 0,
+            "recycled": 0,
+            "ping_failures": 0,
+            "leaks_detected": 0,
+        }
+
+    # --- Apertura y cierre de conexiones físicas ---
+
+    def _open(self):
+        conn = psycopg2.connect(**self._connect_kwargs)
+        now = time.monotonic()
+        with self._cond:
+            self._info[id(conn)] = {
+                "conn": conn,
+                "created": now,
+                "last_used": now,
+                "checked_out_at": None,
+                "stack": None,
+                "thread": None,
+                "leak_reported": False,
+            }
+        return conn
+
+    def _discard(self, conn):
+        """Cierra la conexión y olvida sus datos. No modifica el tamaño del pool."""
+        with self._cond:
+            self._info.pop(id(conn), None)
+        for listener in self._close_listeners:
+            try:
+                listener(conn)
+            except Exception as e:
+                logger.error(f"Error en listener de cierre del pool: {e}")
+        try:
+            if not conn.closed:
+                conn.close()
+        except Exception:
+            pass
+
+    def dedicated(self):
+        """
+        Abre una conexión fuera del pool (no cuenta para maxconn ni para la detección de
+        fugas) para trabajos largos, como recorrer una tabla con un cursor con nombre.
+        Quien la pide debe cerrarla.
+        """
+        return psycopg2.connect(**self._connect_kwargs)
+
+    def add_close_listener(self, listener):
+        """Registra una función que se llama con cada conexión que el pool cierra."""
+        self._close_listeners.append(listener)
+
+    def warm(self):
+        """Abre conexiones hasta alcanzar 'minconn'."""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.minconn:
+                    return
+                self._size += 1
+            try:
+                conn = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append(conn)
+                self._cond.notify()
+
+    def _validate(self, conn):
+        """Aplica reciclado por tiempo de vida y pre-ping. Retorna una conexión utilizable."""
+        info = self._info.get(id(conn))
+        now = time.monotonic()
+        if conn.closed or info is None or now - info["created"] > self.max_lifetime:
+            self._counters["recycled"] += 1
+            self._discard(conn)
+            return self._open()
+        if now - info["last_used"] > self.ping_after:
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                cur.close()
+                conn.rollback()
+            except Exception as e:
+                logger.warning(f"Conexión inactiva descartada por pre-ping fallido: {e}")
+                self._counters["ping_failures"] += 1
+                self._discard(conn)
+                return self._open()
+        return conn
+
+    # --- Préstamo y devolución ---
+
+    def getconn(self, timeout=None):
+        """
+        Obtiene una conexión del pool. Si no hay conexiones libres y el pool está lleno,
+        espera hasta 'timeout' segundos (por defecto self.timeout) y lanza PoolTimeoutError.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        self._ensure_leak_detector()
+        with self._cond:
+            waited = False
+            while True:
+                if self._closed:
+                    raise pool.PoolError("El pool de conexiones está cerrado")
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (not waited and self._waiting >= self.max_waiting):
+                    self._counters["timeouts"] += 1
+                    raise PoolTimeoutError(
+                        f"No hay conexiones libres ({self._in_use}/{self.maxconn} en uso, "
+                        f"{self._waiting} esperando) tras {time.monotonic() - start:.2f}s"
+                    )
+                if not waited:
+                    self._counters["waits"] += 1
+                    waited = True
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+        try:
+            conn = self._open() if conn is None else self._validate(conn)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        wait_ms = (time.monotonic() - start) * 1000
+        with self._cond:
+            info = self._info[id(conn)]
+            info["checked_out_at"] = time.monotonic()
+            info["stack"] = traceback.extract_stack(limit=16)[:-1]
+            info["thread"] = threading.current_thread().name
+            info["leak_reported"] = False
+            self._in_use += 1
+            self._counters["checkouts"] += 1
+            self._counters["total_wait_ms"] += wait_ms
+            self._counters["max_wait_ms"] = max(self._counters["max_wait_ms"], wait_ms)
+            self._counters["peak_in_use"] = max(self._counters["peak_in_use"], self._in_use)
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Devuelve la conexión al pool (deshace cualquier transacción abierta)."""
+        info = self._info.get(id(conn))
+        if info is None or info["checked_out_at"] is None:
+            logger.warning("Se intentó devolver al pool una conexión que no estaba prestada")
+            return
+        if not conn.closed and not close:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    close = True
+        now = time.monotonic()
+        with self._cond:
+            info["checked_out_at"] = None
+            info["stack"] = None
+            info["thread"] = None
+            info["last_used"] = now
+            self._in_use -= 1
+            expired = now - info["created"] > self.max_lifetime
+            keep = not (close or conn.closed or self._closed or expired)
+            if keep:
+                self._idle.append(conn)
+            else:
+                self._size -= 1
+                if expired:
+                    self._counters["recycled"] += 1
+            self._cond.notify()
+        if not keep:
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Préstamo con 'with': la conexión se devuelve siempre, incluso si hay excepciones."""
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+    # --- Detección de fugas y métricas ---
+
+    def _ensure_leak_detector(self):
+        if self._leak_thread is not None or not self.leak_threshold:
+            return
+        with self._cond:
+            if self._leak_thread is not None:
+                return
+            self._leak_thread = threading.Thread(target=self._leak_loop, name="db-pool-leaks", daemon=True)
+        self._leak_thread.start()
+
+    def _leak_loop(self):
+        interval = max(1.0, self.leak_threshold / 2)
+        while not self._closed:
+            time.sleep(interval)
+            self.check_leaks()
+
+    def check_leaks(self):
+        """Registra (una vez por préstamo) las conexiones retenidas más de leak_threshold segundos."""
+        now = time.monotonic()
+        leaks = []
+        with self._cond:
+            for info in self._info.values():
+                held_at = info["checked_out_at"]
+                if held_at is None or info["leak_reported"] or now - held_at <= self.leak_threshold:
+                    continue
+                info["leak_reported"] = True
+                self._counters["leaks_detected"] += 1
+                leaks.append((now - held_at, info["thread"], info["stack"]))
+        for held, thread_name, stack in leaks:
+            logger.warning(
+                "Posible fuga de conexión: retenida %.1fs por el hilo %s. Obtenida en:\n%s",
+                held, thread_name, "".join(traceback.format_list(stack or []))
+            )
+        return len(leaks)
+
+    def stats(self):
+        """Métricas de saturación del pool."""
+        with self._cond:
+            checkouts = self._counters["checkouts"]
+            data = dict(self._counters)
+            data.update({
+                "maxconn": self.maxconn,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "saturation": self._in_use / self.maxconn if self.maxconn else 0.0,
+                "avg_wait_ms": self._counters["total_wait_ms"] / checkouts if checkouts else 0.0,
+            })
+        return data
+
+
+# Configura el pool (ajusta los parámetros con variables de entorno según tu entorno)
+db_pool = ResilientConnectionPool(
+    minconn=int(os.getenv('DB_POOL_MIN', 1)),
+    maxconn=int(os.getenv('DB_POOL_MAX', 20)),
+    timeout=float(os.getenv('DB_POOL_TIMEOUT', 10)),
+    max_lifetime=float(os.getenv('DB_POOL_MAX_LIFETIME', 1800)),
+    ping_after=float(os.getenv('DB_POOL_PING_AFTER', 30)),
+    leak_threshold=float(os.getenv('DB_POOL_LEAK_THRESHOLD', 60)),
     dbname=os.getenv('DB_NAME'),
     user=os.getenv('DB_USER'),
     password=os.getenv('DB_PASSWORD'),
@@ -119,6 +811,26 @@ db_pool = pool.ThreadedConnectionPool(
     port=os.getenv('DB_PORT')
 )
 
+# Proveedores de métricas expuestos en la ruta /metrics (nombre -> función sin argumentos)
+METRICS_PROVIDERS = {}
+# La ruta /metrics exige METRICS_TOKEN (encabezado 'Authorization: Bearer <token>');
+# sin token configurado queda deshabilitada.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+def register_metrics(name, provider):
+    """Registra una función que devuelve un diccionario de métricas para /metrics."""
+    METRICS_PROVIDERS[name] = provider
+
+def bearer_token_valid(expected):
+    """True si la petición trae 'Authorization: Bearer <expected>' (y expected está configurado)."""
+    header = request.headers.get("Authorization", "")
+    if not expected or not header.startswith("Bearer "):
+        return False
+    return hmac.compare_digest(header[len("Bearer "):].strip(), expected)
+
+register_metrics("db_pool", db_pool.stats)
+register_metrics("logging", lambda: {**log_stats, "queued": log_listener.queue.qsize()})
+
 #DB_NAME = ""
 #DB_USER = ""
 #DB_PASSWORD = ""
@@ -133,10 +845,285 @@ if not TOKEN:
 
 MP_SDK = os.getenv('MP_SDK')
 #MP_SDK = ""
-# Conjunto para registrar los IDs de pago ya procesados
-processed_payment_ids = set()
+# IDs de pago ya procesados (con pedido registrado); acotado en tamaño y tiempo
+processed_payment_ids = TTLCache(maxsize=int(os.getenv("PROCESSED_PAYMENTS_CACHE", "10000")), ttl=3600)
+processed_payment_lock = threading.Lock()
+
+#########################################
+# PLANIFICADOR DE ENVÍOS A TELEGRAM
+#########################################
+
+# Prioridades de envío (menor = antes). Se pasan con rate_limit_args en los métodos del bot.
+PRIORITY_INTERACTIVE = 0   # Respuestas a lo que el usuario acaba de pedir (valor por defecto)
+PRIORITY_NOTIFICATION = 1  # Avisos de pedidos a clientes, administrador y proveedor
+PRIORITY_BULK = 2          # Envíos masivos (difusiones)
+
 
-application = Application.builder().token(TOKEN).build()
+class TokenBucket:
+    """Balde de tokens: `rate` envíos por segundo con ráfagas de hasta `capacity`."""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, now):
+        self._refill(now)
+        return now >= self.paused_until and self.tokens >= 1
+
+    def consume(self):
+        self.tokens -= 1
+
+    def wait_time(self, now):
+        self._refill(now)
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.0)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class _CoalescedMessage:
+    """sendMessage en espera al que se le pueden agregar otros textos para el mismo chat."""
+    __slots__ = ("data", "result", "followers")
+
+    def __init__(self, data, loop):
+        self.data = data
+        self.result = loop.create_future()
+        self.followers = 0
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """
+    Planificador central de todo lo que el bot envía a Telegram (se engancha como rate limiter
+    de PTB, así que corre en el loop del bot).
+      - Un balde global (30 msg/s) y uno por chat (~1 msg/s en privados, 20/min en grupos).
+      - Cola de prioridad: las respuestas interactivas salen antes que las notificaciones y
+        los envíos masivos; dentro de una prioridad, en orden de llegada. Un chat sin tokens
+        no bloquea a los demás.
+      - Los 429 (RetryAfter) pausan el chat (o todo, si no hay chat) y se reintentan.
+      - Los sendMessage de texto de prioridad notificación o masiva que esperan turno para
+        el mismo chat se combinan en un solo mensaje.
+    """
+    SCAN_LIMIT = 200
+    MAX_TEXT = 4096
+
+    def __init__(self, global_rate=30.0, chat_rate=1.0, chat_burst=3, group_rate=20 / 60, max_retries=3):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        # Un balde que no se usa en 2 minutos ya está lleno: se puede descartar
+        self._chats = TTLCache(maxsize=100000, ttl=120)
+        self._heap = []
+        self._seq = itertools.count()
+        self._open_messages = {}
+        self._loop = None
+        self._task = None
+        self._wakeup = None
+        self._stats = {"requests": 0, "sent": 0, "failed": 0, "retry_after": 0, "coalesced": 0,
+                       "max_queue": 0, "wait_ms_total": 0.0}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _chat_bucket(self, chat_id):
+        if chat_id is None:
+            return None
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            if is_group:
+                bucket = TokenBucket(self.group_rate, 1)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _ensure_dispatcher(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._heap = []
+            self._task = loop.create_task(self._dispatch())
+
+    async def _acquire(self, priority, chat_id):
+        self._ensure_dispatcher()
+        future = self._loop.create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), chat_id, future))
+        self._stats["max_queue"] = max(self._stats["max_queue"], len(self._heap))
+        self._wakeup.set()
+        start = time.monotonic()
+        await future
+        self._stats["wait_ms_total"] += (time.monotonic() - start) * 1000
+
+    async def _dispatch(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            granted = False
+            wait = 1.0
+            if self._global.available(now):
+                for entry in heapq.nsmallest(self.SCAN_LIMIT, self._heap):
+                    future, chat_id = entry[3], entry[2]
+                    if future.done():
+                        # El que esperaba fue cancelado
+                        self._heap.remove(entry)
+                        heapq.heapify(self._heap)
+                        granted = True
+                        break
+                    bucket = self._chat_bucket(chat_id)
+                    if bucket is None or bucket.available(now):
+                        if bucket is not None:
+                            bucket.consume()
+                        self._global.consume()
+                        self._heap.remove(entry)
+                        heapq.heapify(self._heap)
+                        future.set_result(None)
+                        granted = True
+                        break
+                    wait = min(wait, bucket.wait_time(now))
+            else:
+                wait = self._global.wait_time(now)
+            if not granted:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(wait, 0.005))
+                except asyncio.TimeoutError:
+                    pass
+
+    def _priority(self, rate_limit_args):
+        if isinstance(rate_limit_args, int):
+            return rate_limit_args
+        if isinstance(rate_limit_args, dict):
+            return rate_limit_args.get("priority", PRIORITY_INTERACTIVE)
+        return PRIORITY_INTERACTIVE
+
+    def _join_open_message(self, endpoint, data, priority):
+        """Si hay un sendMessage combinable esperando para el chat, le agrega el texto."""
+        if endpoint != "sendMessage" or priority < PRIORITY_NOTIFICATION:
+            return None
+        if data.get("reply_markup") is not None or not isinstance(data.get("text"), str):
+            return None
+        entry = self._open_messages.get(data.get("chat_id"))
+        if entry is None or entry.data.get("parse_mode") != data.get("parse_mode"):
+            return None
+        text = entry.data["text"] + "\n\n" + data["text"]
+        if len(text) > self.MAX_TEXT:
+            return None
+        entry.data["text"] = text
+        entry.followers += 1
+        self._stats["coalesced"] += 1
+        return entry
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        self._stats["requests"] += 1
+        priority = self._priority(rate_limit_args)
+        chat_id = data.get("chat_id")
+        joined = self._join_open_message(endpoint, data, priority)
+        if joined is not None:
+            return await asyncio.shield(joined.result)
+        entry = None
+        if (endpoint == "sendMessage" and priority >= PRIORITY_NOTIFICATION and chat_id is not None
+                and data.get("reply_markup") is None and chat_id not in self._open_messages):
+            entry = _CoalescedMessage(data, asyncio.get_running_loop())
+            self._open_messages[chat_id] = entry
+        try:
+            for attempt in range(self.max_retries + 1):
+                await self._acquire(priority, chat_id)
+                if entry is not None and self._open_messages.get(chat_id) is entry:
+                    # A partir de acá el texto ya no cambia
+                    del self._open_messages[chat_id]
+                try:
+                    result = await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    self._stats["retry_after"] += 1
+                    logger.warning(f"Telegram pidió esperar {e.retry_after}s ({endpoint}, chat {chat_id})")
+                    bucket = self._chat_bucket(chat_id) or self._global
+                    bucket.pause(float(e.retry_after))
+                    if attempt == self.max_retries:
+                        raise
+                    continue
+                self._stats["sent"] += 1
+                if entry is not None:
+                    entry.result.set_result(result)
+                return result
+        except BaseException as e:
+            self._stats["failed"] += 1
+            if entry is not None:
+                if self._open_messages.get(chat_id) is entry:
+                    del self._open_messages[chat_id]
+                if not entry.result.done():
+                    entry.result.set_exception(e)
+                    if entry.followers == 0:
+                        entry.result.exception()  # Nadie más lo espera: marcarlo como leído
+            raise
+
+    def get_stats(self):
+        data = dict(self._stats)
+        data["queued"] = len(self._heap)
+        by_priority = {}
+        for priority, _, _, _ in list(self._heap):
+            by_priority[priority] = by_priority.get(priority, 0) + 1
+        data["queued_by_priority"] = by_priority
+        data["chats_tracked"] = len(self._chats)
+        granted = data["sent"] + data["retry_after"]
+        data["avg_wait_ms"] = round(data.pop("wait_ms_total") / granted, 2) if granted else 0.0
+        return data
+
+
+outbound = OutboundScheduler(
+    global_rate=float(os.getenv("TG_GLOBAL_RATE", "30")),
+    chat_rate=float(os.getenv("TG_CHAT_RATE", "1")),
+    chat_burst=int(os.getenv("TG_CHAT_BURST", "3")),
+    max_retries=int(os.getenv("TG_MAX_RETRIES", "3")),
+)
+register_metrics("outbound", outbound.get_stats)
+
+
+class UnitOfWorkApplication(Application):
+    """Application que procesa cada update dentro de su propia unidad de trabajo."""
+
+    async def process_update(self, update):
+        if isinstance(update, Update):
+            set_log_context(
+                update_id=update.update_id,
+                chat_id=update.effective_chat.id if update.effective_chat else None,
+                user_id=update.effective_user.id if update.effective_user else None,
+            )
+        try:
+            with unit_of_work():
+                await super().process_update(update)
+        except Exception as e:
+            # Lo que quedaba sin confirmar no se guardó (el handler ya había terminado)
+            logger.error(f"Error al confirmar la unidad de trabajo del update: {e}")
+            raise
+
+
+application = (
+    Application.builder()
+    .token(TOKEN)
+    .application_class(UnitOfWorkApplication)
+    .rate_limiter(outbound)
+    .build()
+)
 TELEGRAM_BOT = application.bot
 
 #def set_telegram_webhook():
@@ -152,7 +1139,7 @@ def get_user_info_cached(telegram_id):
     conn = connect_db()
     try:
         cur = conn.cursor()
-        cur.execute("SELECT name, address FROM users WHERE telegram_id = %s", (telegram_id,))
+        statements.execute(cur, "user_info", (telegram_id,))
         row = cur.fetchone()
         return {'name': row[0], 'address': row[1]} if row else None
     except Exception as e:
@@ -172,6 +1159,13 @@ def start_bot_loop(loop):
     loop.run_forever()
 
 
+# Tareas periódicas del bot; corre en BOT_LOOP
+scheduler = AsyncIOScheduler()
+
+async def start_scheduler():
+    if not scheduler.running:
+        scheduler.start()
+
 def ensure_bot_loop():
     """Se asegura de que BOT_LOOP esté inicializado y corriendo.
     Si no está creado, lo crea, inicia el hilo y ejecuta la inicialización de la aplicación.
@@ -184,10 +1178,30 @@ def ensure_bot_loop():
         # Inicializa la aplicación en ese bucle
         future = asyncio.run_coroutine_threadsafe(application.initialize(), BOT_LOOP)
         future.result()  # Espera a que se inicialice
+        asyncio.run_coroutine_threadsafe(start_scheduler(), BOT_LOOP).result()
+        # Retoma las difusiones que quedaron a medias por un reinicio
+        asyncio.run_coroutine_threadsafe(resume_broadcasts(application.bot), BOT_LOOP)
     return BOT_LOOP
 
+def run_on_bot_loop(coro):
+    """
+    Programa una corrutina en el loop del bot sin esperarla: directamente si ya se está
+    en un loop, o desde otro hilo (p. ej. el webhook de Flask).
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run_coroutine_threadsafe(coro, ensure_bot_loop())
+    return loop.create_task(coro)
+
 def connect_db():
-    """Obtiene una conexión del pool."""
+    """
+    Obtiene una conexión del pool (espera hasta DB_POOL_TIMEOUT si está saturado).
+    Dentro de una unidad de trabajo se reutiliza la conexión de la unidad.
+    """
+    uow = _current_uow.get()
+    if uow is not None and uow.active:
+        return uow.connection()
     try:
         conn = db_pool.getconn()
         if conn:
@@ -206,14 +1220,755 @@ def connect_db():
 
 
 def release_db(conn):
-    """Devuelve la conexión al pool."""
+    """Devuelve la conexión al pool (las de una unidad de trabajo se devuelven al cerrarla)."""
+    if isinstance(conn, UnitOfWorkConnection):
+        conn.release()
+        return
     try:
         db_pool.putconn(conn)
     except Exception as e:
         logger.error(f"Error devolviendo conexión al pool: {e}")
 
+
+@contextmanager
+def db_connection():
+    """
+    Préstamo de una conexión con 'with'. Si el bloque lanza una excepción se hace rollback,
+    y la conexión se devuelve al pool en todos los casos:
+
+        with db_connection() as conn:
+            cur = conn.cursor()
+            ...
+    """
+    conn = connect_db()
+    try:
+        yield conn
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        release_db(conn)
+
+#########################################
+# UNIDAD DE TRABAJO (UNA CONEXIÓN Y UNA TRANSACCIÓN POR UPDATE)
+#########################################
+
+_current_uow = contextvars.ContextVar("current_uow", default=None)
+
+uow_stats = {"units": 0, "connections": 0, "checkouts": 0, "commits": 0, "rollbacks": 0}
+
+
+class UnitOfWorkAborted(Exception):
+    """Se pidió la base de datos en una unidad de trabajo cuya transacción ya se deshizo."""
+
+
+class UnitOfWorkConnection:
+    """
+    Envoltorio de la conexión de una unidad de trabajo que se entrega a los helpers.
+    commit() se difiere hasta que se confirma la unidad (ver UnitOfWork.commit); rollback()
+    deshace la transacción y marca la unidad para que los helpers siguientes fallen en lugar
+    de escribir cosas que se van a descartar.
+    """
+
+    def __init__(self, uow, conn):
+        self._uow = uow
+        self._conn = conn
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self._uow.mark_rollback()
+
+    def release(self):
+        # Si un helper atrapó un error de SQL sin hacer rollback, la transacción quedó abortada.
+        if self._conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            self._uow.mark_rollback()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class UnitOfWork:
+    """
+    Unidad de trabajo asociada a un update de Telegram o a una petición del webhook.
+    La conexión se pide al pool recién cuando un helper la necesita; a partir de ahí
+    todos los helpers (connect_db/db_connection) reutilizan esa conexión y la transacción
+    se confirma una sola vez al cerrar la unidad. Lo que tiene que pasar recién después
+    del commit (avisos a clientes, caches) se encola con on_commit.
+    """
+
+    def __init__(self):
+        self._conn = None
+        self.active = True
+        self.rollback_only = False
+        self._after_commit = []
+
+    def connection(self):
+        if self.failed():
+            raise UnitOfWorkAborted("La transacción de la unidad de trabajo se deshizo")
+        if self._conn is None:
+            self._conn = db_pool.getconn()
+            uow_stats["connections"] += 1
+        uow_stats["checkouts"] += 1
+        return UnitOfWorkConnection(self, self._conn)
+
+    def mark_rollback(self):
+        self.rollback_only = True
+        if self._conn is not None:
+            try:
+                self._conn.rollback()
+            except Exception as e:
+                logger.error(f"Error al hacer rollback de la unidad de trabajo: {e}")
+
+    def after_commit(self, func):
+        """Registra una función a ejecutar cuando la transacción se confirme (se descarta si se deshace)."""
+        self._after_commit.append(func)
+
+    def failed(self):
+        """True si la transacción ya se deshizo o quedó abortada por un error de SQL."""
+        if self._conn is not None and \
+                self._conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            self.rollback_only = True
+        return self.rollback_only
+
+    def close(self, error=False):
+        """
+        Confirma (o deshace, si hubo errores o un helper hizo rollback) la transacción y
+        devuelve la conexión. Si el commit falla se deshace todo y se lanza el error, así
+        quien abrió la unidad se entera de que no se guardó nada.
+        """
+        self.active = False
+        rollback = error or self.failed()
+        conn, self._conn = self._conn, None
+        pending, self._after_commit = self._after_commit, []
+        if conn is not None:
+            try:
+                if rollback:
+                    conn.rollback()
+                    uow_stats["rollbacks"] += 1
+                else:
+                    conn.commit()
+                    uow_stats["commits"] += 1
+            except Exception as e:
+                if rollback:
+                    logger.error(f"Error al deshacer la unidad de trabajo: {e}")
+                else:
+                    uow_stats["rollbacks"] += 1
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        pass
+                    raise
+            finally:
+                db_pool.putconn(conn)
+        if not rollback:
+            for func in pending:
+                try:
+                    func()
+                except Exception as e:
+                    logger.error(f"Error en callback posterior al commit: {e}")
+
+
+@contextmanager
+def unit_of_work():
+    """
+    Abre una unidad de trabajo para el bloque. Si ya hay una activa en el contexto
+    actual, el bloque se une a ella (la transacción la cierra quien la abrió).
+    """
+    current = _current_uow.get()
+    if current is not None and current.active:
+        yield current
+        return
+    uow = UnitOfWork()
+    uow_stats["units"] += 1
+    token = _current_uow.set(uow)
+    try:
+        yield uow
+    except BaseException:
+        uow.close(error=True)
+        raise
+    else:
+        uow.close()
+    finally:
+        _current_uow.reset(token)
+
+
+def on_commit(func):
+    """
+    Ejecuta func cuando los cambios hechos hasta ahora queden confirmados: al cerrar la
+    unidad de trabajo activa, o de inmediato si no hay ninguna (el helper ya hizo commit).
+    """
+    current = _current_uow.get()
+    if current is not None and current.active:
+        current.after_commit(func)
+    else:
+        func()
+
+
+def get_uow_stats():
+    data = dict(uow_stats)
+    data["checkouts_saved"] = data["checkouts"] - data["connections"]
+    return data
+
+register_metrics("unit_of_work", get_uow_stats)
+
+#########################################
+# SENTENCIAS PREPARADAS
+#########################################
+
+class StatementRegistry:
+    """
+    Registro de las consultas frecuentes de bot.py.
+    Cada consulta se registra una sola vez con un nombre y se prepara (PREPARE) en cada
+    conexión la primera vez que se usa en ella; a partir de ahí se ejecuta con EXECUTE y
+    Postgres ya no vuelve a parsear ni planificar el SQL.
+    Las sentencias preparadas de una conexión se olvidan cuando el pool la cierra o recicla.
+    Con DB_PREPARED_STATEMENTS=0 (por ejemplo detrás de pgbouncer en modo transacción)
+    se ejecuta el SQL original.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._statements = {}   # nombre -> (sql original, sql con $n, cantidad de parámetros)
+        self._prepared = {}     # id(conexión) -> nombres preparados en esa conexión
+        self._lock = threading.Lock()
+        self.stats = {"prepares": 0, "executes": 0, "plain": 0}
+
+    def register(self, name, sql):
+        """Registra 'sql' (con parámetros %s) bajo 'name'. Retorna el nombre."""
+        parts = sql.split("%s")
+        pg_sql = parts[0] + "".join(f"${i}{part}" for i, part in enumerate(parts[1:], start=1))
+        self._statements[name] = (sql, pg_sql, len(parts) - 1)
+        return name
+
+    def execute(self, cur, name, params=()):
+        """Ejecuta la consulta registrada 'name' con 'params' en el cursor dado."""
+        sql, pg_sql, nparams = self._statements[name]
+        if not self.enabled:
+            self.stats["plain"] += 1
+            cur.execute(sql, params)
+            return
+        key = id(cur.connection)
+        prepared = self._prepared.get(key)
+        if prepared is None:
+            with self._lock:
+                prepared = self._prepared.setdefault(key, set())
+        if name not in prepared:
+            cur.execute(f"PREPARE {name} AS {pg_sql}")
+            prepared.add(name)
+            self.stats["prepares"] += 1
+        self.stats["executes"] += 1
+        try:
+            if nparams:
+                cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * nparams)})", params)
+            else:
+                cur.execute(f"EXECUTE {name}")
+        except psycopg2.errors.InvalidSqlStatementName:
+            # La sesión perdió la sentencia (p. ej. DISCARD ALL): se volverá a preparar
+            prepared.discard(name)
+            raise
+
+    def forget_connection(self, conn):
+        """Olvida las sentencias preparadas de una conexión cerrada."""
+        with self._lock:
+            self._prepared.pop(id(conn), None)
+
+    def get_stats(self):
+        data = dict(self.stats)
+        data["registered"] = len(self._statements)
+        data["connections"] = len(self._prepared)
+        return data
+
+
+statements = StatementRegistry(enabled=os.getenv("DB_PREPARED_STATEMENTS", "1") != "0")
+db_pool.add_close_listener(statements.forget_connection)
+register_metrics("prepared_statements", statements.get_stats)
+
+statements.register("user_info", "SELECT name, address FROM users WHERE telegram_id = %s")
+statements.register("user_exists", "SELECT 1 FROM users WHERE telegram_id = %s")
+statements.register("user_unblock", "UPDATE users SET blocked_at = NULL WHERE telegram_id = %s AND blocked_at IS NOT NULL")
+statements.register("es_trabajador", "SELECT 1 FROM trabajadores WHERE telegram_id = %s")
+statements.register("nombre_trabajador", "SELECT nombre FROM trabajadores WHERE telegram_id = %s")
+statements.register("equipo_del_trabajador", "SELECT id, trabajador1, trabajador2 FROM equipos WHERE trabajador1 = %s OR trabajador2 = %s")
+statements.register("products", "SELECT id, name, price, sale_type FROM products ORDER BY id")
+statements.register("product", "SELECT id, name, price, sale_type FROM products WHERE id = %s")
+statements.register("user_carts", "SELECT id, name, total FROM carts WHERE telegram_id = %s")
+statements.register("cart_total", "SELECT total FROM carts WHERE id = %s")
+statements.register("cart_owner", "SELECT telegram_id FROM carts WHERE id = %s")
+statements.register("cart_details", """
+    SELECT p.id, p.name, ci.quantity, ci.subtotal
+    FROM cart_items ci
+    JOIN products p ON ci.product_id = p.id
+    WHERE ci.cart_id = %s
+""")
+statements.register("pending_orders", "SELECT id, cart_id, confirmation_code, order_date FROM orders WHERE telegram_id = %s AND status = 'pendiente' ORDER BY order_date DESC LIMIT %s")
+statements.register("delivered_orders", """
+    (SELECT id, cart_id, confirmation_code, order_date FROM orders
+     WHERE telegram_id = %s AND status = 'entregado' ORDER BY order_date DESC LIMIT %s)
+    UNION ALL
+    (SELECT id, cart_id, confirmation_code, order_date FROM orders_archive
+     WHERE telegram_id = %s ORDER BY order_date DESC LIMIT %s)
+    ORDER BY order_date DESC LIMIT %s
+""")
+statements.register("conjunto_orders", "SELECT id, cart_id, confirmation_code, order_date, telegram_id FROM orders WHERE conjunto_id = %s ORDER BY order_date")
+statements.register("pending_in_conjunto", "SELECT COUNT(*) FROM orders WHERE conjunto_id = %s AND status = 'pendiente'")
+statements.register("orders_in_conjunto", "SELECT COUNT(*) FROM orders WHERE conjunto_id = %s")
+statements.register("last_conjunto", "SELECT id, numero_conjunto FROM conjuntos ORDER BY id DESC LIMIT 1")
+statements.register("conjuntos_por_equipo", "SELECT id, numero_conjunto FROM conjuntos WHERE equipo_id = %s")
+
+#########################################
+# PLANTILLAS DE TECLADOS
+#########################################
+
+def keyboard_markup(*rows):
+    """
+    Arma un InlineKeyboardMarkup a partir de filas de tuplas (texto, callback_data); en lugar
+    del callback_data puede ir un dict con otros parámetros del botón (p. ej. inline mode).
+    """
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(text, **data) if isinstance(data, dict) else InlineKeyboardButton(text, callback_data=data)
+        for text, data in row
+    ] for row in rows])
+
+
+def _build_main_menu(is_admin, is_worker):
+    rows = [
+        [("Ordenar", cb("menu", "ordenar"))],
+        [("Historial", cb("menu", "historial"))],
+        [("Pedidos Pendientes", cb("menu", "pedidos"))],
+        [("Carritos", cb("menu", "carritos"))],
+        [("Cambiar Dirección", cb("menu", "cambiar"))],
+        [("Contacto", cb("menu", "contacto"))],
+        [("Ayuda", cb("menu", "ayuda"))],
+    ]
+    if is_admin:
+        rows.append([("Gestión de Pedidos y Equipos", cb("gestion"))])
+    if is_worker:
+        rows.append([("Gestión de Pedidos", cb("gestion_personal"))])
+    return keyboard_markup(*rows)
+
+
+# Teclados estáticos: se construyen una sola vez al iniciar y se comparten entre todos
+# los usuarios (InlineKeyboardMarkup es inmutable).
+# Menú principal según el rol: (es administrador, es trabajador)
+MAIN_MENU_MARKUPS = {(a, w): _build_main_menu(a, w) for a in (False, True) for w in (False, True)}
+GESTION_MENU_MARKUP = keyboard_markup(
+    [("Asignar Conjuntos", cb("asignar_conjuntos"))],
+    [("Revocar Conjuntos", cb("revocar_conjuntos"))],
+    [("Ver Equipos", cb("ver_equipos"))],
+    [("Crear Nuevo Equipo", cb("crear_equipo"))],
+    [("Eliminar Equipos", cb("eliminar_equipos"))],
+    [("Ver Conjuntos No Terminados", cb("ver_no_terminados"))],
+)
+BACK_MAIN_MARKUP = keyboard_markup([("Volver al Menú Principal", cb("back_main"))])
+ACEPTAR_MARKUP = keyboard_markup([("Aceptar", cb("back_main"))])
+CANCELAR_DIRECCION_MARKUP = keyboard_markup([("Cancelar", cb("cancelar_direccion"))])
+BACK_GESTION_MARKUP = keyboard_markup([("Volver a Gestión de Pedidos y Equipos", cb("gestion"))])
+BACK_GESTION_PERSONAL_MARKUP = keyboard_markup([("Volver a Gestión de Pedidos", cb("gestion_personal"))])
+
+# Rol de cada usuario (administrador / trabajador) para elegir la variante del menú principal.
+# Los cambios de equipos olvidan el rol de sus integrantes; el TTL cubre los trabajadores
+# cargados a mano en la base.
+user_role_cache = TTLCache(maxsize=1000, ttl=300)
+
+
+@cached(cache=user_role_cache)
+def get_user_role(telegram_id):
+    return telegram_id in allowed_ids, es_trabajador(telegram_id)
+
+
+def forget_user_roles_on_commit(*telegram_ids):
+    """Quita del cache el rol de esos usuarios cuando se confirme la transacción."""
+    def forget():
+        for telegram_id in telegram_ids:
+            user_role_cache.pop(hashkey(telegram_id), None)
+    on_commit(forget)
+
+
+def main_menu_markup(telegram_id):
+    return MAIN_MENU_MARKUPS[get_user_role(telegram_id)]
+
+
+def back_button_row(cart_id=None, main_label="Volver al Menú Principal"):
+    """Fila 'Volver': al menú del carrito si se indica cart_id, o al menú principal."""
+    if cart_id is not None:
+        return [("Volver al menú del carrito", cb("cart_menu", cart_id))]
+    return [(main_label, cb("back_main"))]
+
+
+@functools.lru_cache(maxsize=1024)
+def cart_back_markup(cart_id):
+    return keyboard_markup(back_button_row(cart_id))
+
+
+@functools.lru_cache(maxsize=1024)
+def cart_menu_markup(cart_id):
+    return keyboard_markup(
+        [("Ver detalles del carrito", cb("cart_details", cart_id))],
+        [("Agregar productos", cb("cart_add", cart_id))],
+        [("Quitar productos", cb("cart_remove", cart_id))],
+        [("Eliminar carrito", cb("cart_delete", cart_id))],
+        [("Pagar carrito", cb("cart_pay", cart_id))],
+        [("Volver a la lista de carritos", cb("show_carts"))],
+        [("Volver al Menú Principal", cb("back_main"))],
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def post_adhesion_markup(back_cart_id=None):
+    """Opciones después de agregar un producto; back_cart_id es el carrito al que vuelve 'Volver'."""
+    return keyboard_markup(
+        [("Agregar más productos", cb("add_more"))],
+        [("Pagar Carrito", cb("pay_cart"))],
+        back_button_row(back_cart_id),
+    )
+
+
+class KeyboardCache:
+    """
+    Cache de los teclados dinámicos (productos, carritos, conjuntos) por tipo, versión de
+    los datos y clave. Las escrituras llaman a bump(tipo) después del commit y las entradas
+    de versiones anteriores dejan de usarse. El TTL acota lo que cambie por fuera del bot
+    (por ejemplo, productos cargados a mano en la base).
+    """
+    _MISSING = object()
+
+    def __init__(self, maxsize=2048, ttl=120):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "bumps": 0}
+
+    def bump(self, *kinds):
+        with self._lock:
+            for kind in kinds:
+                self._versions[kind] = self._versions.get(kind, 0) + 1
+                self._stats["bumps"] += 1
+
+    def bump_on_commit(self, *kinds):
+        on_commit(lambda: self.bump(*kinds))
+
+    def version(self, kind):
+        with self._lock:
+            return self._versions.get(kind, 0)
+
+    def get(self, kind, key, builder):
+        """Retorna el valor cacheado para (kind, key) o lo construye con builder()."""
+        with self._lock:
+            cache_key = (kind, self._versions.get(kind, 0), key)
+            value = self._cache.get(cache_key, self._MISSING)
+            if value is not self._MISSING:
+                self._stats["hits"] += 1
+                return value
+            self._stats["misses"] += 1
+        value = builder()
+        with self._lock:
+            self._cache[cache_key] = value
+        return value
+
+    def get_stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["size"] = len(self._cache)
+            data["versions"] = dict(self._versions)
+        return data
+
+
+keyboards = KeyboardCache(
+    maxsize=int(os.getenv("KEYBOARD_CACHE_SIZE", "2048")),
+    ttl=float(os.getenv("KEYBOARD_CACHE_TTL", "120")),
+)
+register_metrics("keyboards", keyboards.get_stats)
+
+
+#########################################
+# CATÁLOGO Y BÚSQUEDA DE PRODUCTOS
+#########################################
+
+# Índice en memoria de los nombres de productos: prefijos de cada palabra (búsqueda mientras
+# se escribe) y trigramas (tolera errores de tipeo), sin tildes ni mayúsculas ("limon" ->
+# "Limón"). Se reconstruye cuando cambia la versión "products" del cache de teclados o
+# vence PRODUCT_INDEX_TTL (los productos se cargan por fuera del bot).
+PRODUCT_INDEX_TTL = int(os.getenv("PRODUCT_INDEX_TTL", "300"))
+PRODUCTS_PAGE_SIZE = int(os.getenv("PRODUCTS_PAGE_SIZE", "8"))
+PRODUCT_SEARCH_MIN_SIMILARITY = 0.3
+# Textos de la fila "Volver" al menú principal (el índice viaja en el callback_data)
+PRODUCT_BACK_LABELS = ("Volver al Menú Principal", "Volver")
+
+
+def normalize_text(text):
+    """Minúsculas, sin tildes ni signos: "Limón  Tahití!" -> "limon tahiti"."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.findall(r"[0-9a-z]+", text))
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ProductIndex:
+    """Índice inmutable de un catálogo de productos (lista de dicts con id y name)."""
+
+    def __init__(self, products):
+        self.products = list(products)
+        self._by_id = {p['id']: p for p in self.products}
+        self._names = {p['id']: normalize_text(p['name']) for p in self.products}
+        self._prefixes = {}
+        self._trigrams = {}
+        for product_id, name in self._names.items():
+            for word in name.split():
+                for end in range(1, len(word) + 1):
+                    self._prefixes.setdefault(word[:end], set()).add(product_id)
+            for gram in trigrams(name):
+                self._trigrams.setdefault(gram, set()).add(product_id)
+
+    def search(self, text, limit=None):
+        """
+        Productos cuyo nombre tiene, para cada palabra buscada, una palabra que empieza así;
+        si no hay ninguno, los más parecidos por trigramas. Ordenados por relevancia.
+        """
+        query = normalize_text(text)
+        if not query:
+            return []
+        candidates = None
+        for word in query.split():
+            ids = self._prefixes.get(word, set())
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                break
+        if candidates:
+            ranked = sorted(candidates, key=lambda i: (
+                self._names[i] != query, not self._names[i].startswith(query), self._names[i]))
+        else:
+            query_grams = trigrams(query)
+            shared = {}
+            for gram in query_grams:
+                for product_id in self._trigrams.get(gram, ()):
+                    shared[product_id] = shared.get(product_id, 0) + 1
+            scores = {i: n / len(query_grams) for i, n in shared.items() if n / len(query_grams) >= PRODUCT_SEARCH_MIN_SIMILARITY}
+            ranked = sorted(scores, key=lambda i: (-scores[i], self._names[i]))
+        results = [self._by_id[i] for i in ranked]
+        return results[:limit] if limit else results
+
+
+class ProductCatalog:
+    """Catálogo con su índice y un cache de búsquedas, compartidos por teclados e inline mode."""
+
+    def __init__(self, ttl, cache_size=1024):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._index = None
+        self._version = None
+        self._built_at = 0.0
+        self._cache = LRUCache(maxsize=cache_size)
+        self._stats = {"rebuilds": 0, "searches": 0, "cache_hits": 0}
+
+    def index(self):
+        """Índice actual; lo reconstruye si cambió la versión de productos o venció el TTL."""
+        with self._lock:
+            version = keyboards.version("products")
+            if self._index is not None and self._version == version and time.monotonic() - self._built_at < self.ttl:
+                return self._index
+            products = get_products()
+            changed = self._index is not None and [tuple(p.values()) for p in products] != \
+                [tuple(p.values()) for p in self._index.products]
+            if changed:
+                # El catálogo cambió por fuera del bot: los teclados de productos se rearman
+                keyboards.bump("products")
+                version = keyboards.version("products")
+            self._index = ProductIndex(products)
+            self._version = version
+            self._built_at = time.monotonic()
+            self._cache.clear()
+            self._stats["rebuilds"] += 1
+            return self._index
+
+    def cached(self, key, builder):
+        """Valor cacheado para 'key' mientras no cambie el índice (builder recibe el índice)."""
+        index = self.index()
+        with self._lock:
+            value = self._cache.get(key)
+            if value is not None:
+                self._stats["cache_hits"] += 1
+                return value
+        value = builder(index)
+        with self._lock:
+            if self._index is index:
+                self._cache[key] = value
+        return value
+
+    def search(self, text):
+        self._stats["searches"] += 1
+        return self.cached(("search", normalize_text(text)), lambda index: index.search(text))
+
+    def get_stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["products"] = len(self._index.products) if self._index else 0
+            data["cached"] = len(self._cache)
+        return data
+
+
+product_catalog = ProductCatalog(PRODUCT_INDEX_TTL)
+register_metrics("products", product_catalog.get_stats)
+
+
+def product_price_text(product):
+    if product['sale_type'] == 'unidad':
+        return f"Precio por unidad: {product['price']}"
+    return f"Precio por 100 gramos: {product['price']}"
+
+
+def products_markup(back_cart_id=None, main_label=PRODUCT_BACK_LABELS[0], page=0, search=None):
+    """
+    Página 'page' de la lista de productos (o de los resultados de 'search') con la fila
+    'Volver' indicada, o None si no hay productos.
+    """
+    def build():
+        products = product_catalog.search(search) if search else product_catalog.index().products
+        if not products:
+            return None
+        pages = max(1, math.ceil(len(products) / PRODUCTS_PAGE_SIZE))
+        current = min(max(page, 0), pages - 1)
+        rows = [[(product['name'], cb("product", product['id']))]
+                for product in products[current * PRODUCTS_PAGE_SIZE:(current + 1) * PRODUCTS_PAGE_SIZE]]
+        label = PRODUCT_BACK_LABELS.index(main_label) if main_label in PRODUCT_BACK_LABELS else 0
+        nav = []
+        if current > 0:
+            nav.append(("« Anterior", cb("products_page", current - 1, back_cart_id or 0, label, int(bool(search)))))
+        if current < pages - 1:
+            nav.append((f"Siguiente » ({current + 2}/{pages})",
+                        cb("products_page", current + 1, back_cart_id or 0, label, int(bool(search)))))
+        if nav:
+            rows.append(nav)
+        if search:
+            rows.append([("Ver todos los productos", cb("products_page", 0, back_cart_id or 0, label, 0))])
+        elif pages > 1:
+            rows.append([("🔍 Buscar", {"switch_inline_query_current_chat": ""})])
+        rows.append(back_button_row(back_cart_id, main_label))
+        return keyboard_markup(*rows)
+    # Reconstruir antes el índice si hace falta: si el catálogo cambió se invalida el cache
+    product_catalog.index()
+    return keyboards.get("products", (back_cart_id, main_label, page, normalize_text(search or "")), build)
+
+
+#########################################
+# VISTAS: EDICIÓN DE MENSAJES SIN LLAMADAS REDUNDANTES
+#########################################
+
+class ViewCache:
+    """
+    Recuerda un hash del último texto + teclado mostrado en cada mensaje (chat_id, message_id),
+    en un LRU acotado, para no volver a editar un mensaje con el mismo contenido (Telegram
+    responde "message is not modified" y se pierde un viaje a la API).
+    Si llegan varias ediciones seguidas para el mismo mensaje mientras una está en curso,
+    solo se envía la última (las intermedias quedan reemplazadas).
+    """
+
+    def __init__(self, maxsize=10000):
+        self._last = LRUCache(maxsize=maxsize)
+        self._inflight = {}
+        self._stats = {"requested": 0, "api_calls": 0, "skipped": 0, "coalesced": 0, "not_modified": 0}
+
+    @staticmethod
+    def fingerprint(text, reply_markup=None, **kwargs):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update((text or "").encode("utf-8"))
+        if reply_markup is not None:
+            digest.update(reply_markup.to_json().encode("utf-8"))
+        for key in sorted(kwargs):
+            digest.update(f"|{key}={kwargs[key]}".encode("utf-8"))
+        return digest.digest()
+
+    def forget(self, key):
+        self._last.pop(key, None)
+
+    async def _send(self, key, fingerprint, send):
+        self._stats["api_calls"] += 1
+        try:
+            result = await send()
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                self.forget(key)
+                raise
+            # El mensaje ya tenía ese contenido (por ejemplo, tras un reinicio del bot)
+            self._stats["not_modified"] += 1
+            result = True
+        except Exception:
+            self.forget(key)
+            raise
+        self._last[key] = fingerprint
+        return result
+
+    async def edit(self, key, fingerprint, send):
+        """Ejecuta send() (la edición real) salvo que el mensaje ya muestre ese contenido."""
+        self._stats["requested"] += 1
+        state = self._inflight.get(key)
+        if state is not None:
+            # Hay una edición en curso para este mensaje: esta reemplaza a la que estaba esperando
+            if state["pending"] is not None:
+                state["pending"][2].set_result(True)
+                self._stats["coalesced"] += 1
+            future = asyncio.get_running_loop().create_future()
+            state["pending"] = (fingerprint, send, future)
+            return await future
+        if self._last.get(key) == fingerprint:
+            self._stats["skipped"] += 1
+            return True
+        state = {"pending": None}
+        self._inflight[key] = state
+        try:
+            return await self._send(key, fingerprint, send)
+        finally:
+            # Enviar (solo) la última edición que llegó mientras tanto
+            while state["pending"] is not None:
+                pending_fp, pending_send, future = state["pending"]
+                state["pending"] = None
+                if self._last.get(key) == pending_fp:
+                    self._stats["skipped"] += 1
+                    future.set_result(True)
+                    continue
+                try:
+                    future.set_result(await self._send(key, pending_fp, pending_send))
+                except Exception as e:
+                    future.set_exception(e)
+            del self._inflight[key]
+
+    def get_stats(self):
+        data = dict(self._stats)
+        data["api_calls_saved"] = data["skipped"] + data["coalesced"]
+        data["size"] = len(self._last)
+        return data
+
+
+views = ViewCache(maxsize=int(os.getenv("VIEW_CACHE_SIZE", "10000")))
+register_metrics("views", views.get_stats)
+
+
+async def edit_view(query, text, reply_markup=None, **kwargs):
+    """
+    Reemplazo de query.edit_message_text que omite la llamada si el mensaje ya muestra
+    el mismo texto y teclado. Todas las ediciones de mensajes deben pasar por acá para
+    que el hash guardado refleje lo que el usuario ve.
+    """
+    message = query.message
+    if message is None:
+        # Mensajes de modo inline: no tenemos chat_id/message_id para identificarlos
+        return await query.edit_message_text(text, reply_markup=reply_markup, **kwargs)
+    key = (message.chat_id, message.message_id)
+    fingerprint = ViewCache.fingerprint(text, reply_markup, **kwargs)
+    return await views.edit(key, fingerprint, lambda: query.edit_message_text(text, reply_markup=reply_markup, **kwargs))
+
+
 def init_db():
     """Crea la tabla 'users' si no existe."""
+    db_pool.warm()
     conn = connect_db()
     cur = None
     try:
@@ -235,8 +1990,71 @@ def init_db():
                 equipo_id INTEGER  -- Puede ser NULL si no se ha asignado un equipo
             );
         """)
+        # Ubicación compartida por el usuario (para agrupar pedidos por cercanía)
+        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS latitude DOUBLE PRECISION")
+        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS longitude DOUBLE PRECISION")
+        # Usuarios que bloquearon el bot (las difusiones los saltean)
+        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP")
+        # Difusiones con su checkpoint (último telegram_id confirmado) y estadísticas
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id SERIAL PRIMARY KEY,
+                text TEXT NOT NULL,
+                created_by BIGINT,
+                status TEXT NOT NULL DEFAULT 'running',
+                last_telegram_id BIGINT NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                finished_at TIMESTAMP
+            );
+        """)
+        # Búsqueda de pedidos por código (entregas) y unicidad del código entre los pendientes
+        cur.execute("CREATE INDEX IF NOT EXISTS orders_code_idx ON orders (confirmation_code)")
+        renumbered = ensure_pending_code_index(cur)
+        # Pago de MercadoPago que originó el pedido (un pedido por pago, ver process_approved_payment)
+        cur.execute("ALTER TABLE orders ADD COLUMN IF NOT EXISTS payment_id TEXT")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS orders_payment_uidx ON orders (payment_id) WHERE payment_id IS NOT NULL")
+        # Pedidos entregados archivados (ver archive_delivered_orders)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS orders_archive (
+                id INTEGER PRIMARY KEY,
+                cart_id INTEGER,
+                telegram_id BIGINT,
+                confirmation_code TEXT,
+                status TEXT NOT NULL,
+                order_date TIMESTAMP NOT NULL,
+                entrega_date TIMESTAMP,
+                conjunto_id INTEGER,
+                archived_at TIMESTAMP NOT NULL DEFAULT NOW()
+            );
+        """)
+        cur.execute("ALTER TABLE orders_archive ADD COLUMN IF NOT EXISTS payment_id TEXT")
+        create_orders_indexes(cur)
+        # Resúmenes diarios de ventas (ver record_sale)
+        init_sales_rollups(cur)
+        # Stock de productos y reservas de los carritos en pago (ver reserve_stock)
+        init_stock(cur)
+        # Números de conjunto liberados (ver allocate_conjunto_number)
+        cur.execute("CREATE TABLE IF NOT EXISTS conjunto_numeros_libres (numero INTEGER PRIMARY KEY)")
+        cur.execute("SAVEPOINT conjunto_index")
+        try:
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS conjuntos_numero_uidx ON conjuntos (numero_conjunto)")
+        except psycopg2.errors.UniqueViolation as e:
+            cur.execute("ROLLBACK TO SAVEPOINT conjunto_index")
+            logger.error(f"Hay conjuntos con números repetidos; no se creó el índice único: {e}")
+        sync_conjunto_numbers(cur)
         # Aquí podrías agregar también las tablas de trabajadores y equipos si aún no existen.
         conn.commit()
+        if renumbered:
+            try:
+                run_on_bot_loop(notify_renumbered_codes(renumbered))
+            except Exception as e:
+                logger.error(f"Error al avisar los códigos nuevos a los clientes: {e}")
+    except ConfirmationCodeIndexError:
+        # Sin el índice un mismo código podría entregar dos pedidos: no se arranca
+        raise
     except Exception as e:
         logger.error(f"Error al inicializar la base de datos: {e}")
     finally:
@@ -250,70 +2068,188 @@ async def show_carts_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     telegram_id = query.from_user.id
-    carts = get_user_carts(telegram_id)
-    logger.info(f"Mostrando carritos para usuario {telegram_id}: {carts}")
-    keyboard = []
-    if not carts:
-        # Si no hay carritos, mostramos botón para crear uno nuevo y volver al menú principal
-        keyboard.append([InlineKeyboardButton("Nuevo Carrito", callback_data="new_cart")])
-        keyboard.append([InlineKeyboardButton("Volver al Menú Principal", callback_data="back_main")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("No tienes carritos creados.", reply_markup=reply_markup)
-        return CARTS_LIST
-    else:
-        for cart in carts:
-            # Se crea el callback data con el formato "cartmenu_{cart_id}"
-            keyboard.append([InlineKeyboardButton(f"{cart['name']} (Total: {cart['total']:.2f})", callback_data=f"cartmenu_{cart['id']}")])
-        # Botón para crear un nuevo carrito
-        keyboard.append([InlineKeyboardButton("Nuevo Carrito", callback_data="new_cart")])
-        # Botón para volver al menú principal
-        keyboard.append([InlineKeyboardButton("Volver al Menú Principal", callback_data="back_main")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Tus carritos:", reply_markup=reply_markup)
-        return CARTS_LIST
+
+    def build():
+        carts = get_user_carts(telegram_id)
+        logger.debug("Mostrando carritos para usuario %s: %s", telegram_id, carts)
+        rows = [[(f"{cart['name']} (Total: {cart['total']:.2f})", cb("cart_menu", cart['id']))] for cart in carts]
+        # Botones para crear un nuevo carrito y volver al menú principal
+        rows.append([("Nuevo Carrito", cb("new_cart"))])
+        rows.append([("Volver al Menú Principal", cb("back_main"))])
+        text = "Tus carritos:" if carts else "No tienes carritos creados."
+        return text, keyboard_markup(*rows)
+
+    text, reply_markup = keyboards.get("carts", telegram_id, build)
+    await edit_view(query, text, reply_markup=reply_markup)
+    return CARTS_LIST
+
+def mark_orders_delivered(codes):
+    """
+    Marca como entregados todos los pedidos pendientes cuyos códigos de confirmación estén
+    en 'codes', con un solo UPDATE ... RETURNING, y finaliza en la misma transacción los
+    conjuntos que quedaron sin pedidos pendientes.
+    Retorna (resultados, entregados):
+      - resultados: {código: 'entregado' | 'ya_entregado' | 'no_encontrado'} en el orden recibido
+      - entregados: lista de (código, telegram_id) de los pedidos actualizados
+    """
+    codes = list(dict.fromkeys(code for code in codes if code))
+    results = {code: "no_encontrado" for code in codes}
+    if not codes:
+        return results, []
+    with unit_of_work():
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "UPDATE orders SET status = 'entregado', entrega_date = NOW() "
+                "WHERE confirmation_code = ANY(%s) AND status = 'pendiente' "
+                "RETURNING confirmation_code, telegram_id, conjunto_id",
+                (codes,)
+            )
+            updated = cur.fetchall()
+            record_deliveries(cur, [row[2] for row in updated])
+            delivered = []
+            conjunto_ids = set()
+            for code, telegram_id, conjunto_id in updated:
+                results[code] = "entregado"
+                delivered.append((code, telegram_id))
+                if conjunto_id is not None:
+                    conjunto_ids.add(conjunto_id)
+            missing = [code for code in codes if results[code] != "entregado"]
+            if missing:
+                cur.execute(
+                    "SELECT confirmation_code FROM orders WHERE confirmation_code = ANY(%s) "
+                    "UNION SELECT confirmation_code FROM orders_archive WHERE confirmation_code = ANY(%s)",
+                    (missing, missing)
+                )
+                for (code,) in cur.fetchall():
+                    results[code] = "ya_entregado"
+            if conjunto_ids:
+                cur.execute(
+                    "DELETE FROM conjuntos c WHERE c.id = ANY(%s) AND NOT EXISTS "
+                    "(SELECT 1 FROM orders o WHERE o.conjunto_id = c.id AND o.status = 'pendiente') "
+                    "RETURNING c.id, c.numero_conjunto",
+                    (list(conjunto_ids),)
+                )
+                finalized = cur.fetchall()
+                release_conjunto_numbers(cur, [row[1] for row in finalized])
+                # Los PDF de los conjuntos que siguen se regeneran con los pendientes actualizados
+                conjunto_documents.discard_on_commit([row[0] for row in finalized])
+                conjunto_documents.refresh_on_commit(list(conjunto_ids - {row[0] for row in finalized}))
+            conn.commit()
+            cur.close()
+        if delivered:
+            keyboards.bump_on_commit("conjuntos")
+    return results, delivered
 
 def update_order_status(confirmation_code):
     """Busca un pedido pendiente con el código dado y lo actualiza a 'entregado'.
-       Retorna el telegram_id del usuario si se actualizó correctamente, o None si no se encontró."""
-    conn = connect_db()
-    cur = None
+       Retorna el telegram_id del usuario si se actualizó correctamente, o None si no se encontró.
+       Los errores de la base de datos se propagan."""
+    _, delivered = mark_orders_delivered([confirmation_code])
+    return delivered[0][1] if delivered else None
+
+async def notify_delivered_orders(bot, delivered):
+    """Avisa a los clientes, en paralelo, que sus pedidos fueron entregados."""
+    results = await asyncio.gather(
+        *(bot.send_message(chat_id=telegram_id, text=f"Su pedido (código {code}) ha sido marcado como entregado.",
+                           rate_limit_args=PRIORITY_NOTIFICATION)
+          for code, telegram_id in delivered),
+        return_exceptions=True
+    )
+    for (code, telegram_id), result in zip(delivered, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error al notificar al usuario {telegram_id} (pedido {code}): {result}")
+
+def notify_delivered_orders_on_commit(bot, delivered):
+    """Avisa a los clientes recién cuando la entrega quede confirmada (ver notify_delivered_orders)."""
+    if delivered:
+        on_commit(lambda: run_on_bot_loop(notify_delivered_orders(bot, delivered)))
+
+DELIVERY_RESULT_LABELS = (
+    ("entregado", "Entregados"),
+    ("ya_entregado", "Ya estaban entregados"),
+    ("no_encontrado", "No encontrados"),
+)
+
+def delivery_summary(results):
+    """Resumen por código del resultado de una entrega masiva."""
+    lines = [f"Códigos procesados: {len(results)}"]
+    for status, label in DELIVERY_RESULT_LABELS:
+        codes = [code for code, result in results.items() if result == status]
+        if codes:
+            lines.append(f"\n{label} ({len(codes)}):\n" + ", ".join(codes))
+    text = "\n".join(lines)
+    if len(text) > 4000:
+        text = text[:4000] + "\n..."
+    return text
+
+def parse_confirmation_codes(text):
+    """Extrae los códigos de un texto separado por espacios, comas, punto y coma o renglones."""
+    return [code for code in re.split(r"[\s,;]+", text or "") if code]
+
+async def deliver_codes(update: Update, context: ContextTypes.DEFAULT_TYPE, codes) -> None:
     try:
-    # ... usar conn
-        cur = conn.cursor()
-        # Se busca el pedido pendiente con el código dado
-        cur.execute("SELECT id, telegram_id FROM orders WHERE confirmation_code = %s AND status = 'pendiente'", (confirmation_code,))
-        row = cur.fetchone()
-        if not row:
-            return None
-        order_id, telegram_id = row
-        # Actualizar el estado a 'entregado'
-        cur.execute("UPDATE orders SET status = 'entregado', order_date = NOW() WHERE id = %s", (order_id,))
-        conn.commit()
-        return telegram_id
+        results, delivered = mark_orders_delivered(codes)
     except Exception as e:
-        logger.error(f"Error al actualizar el estado del pedido: {e}")
-        if conn:
-            conn.rollback()
-        return None
-    finally:
-        release_db(conn)
+        logger.error(f"Error en la entrega masiva: {e}")
+        await update.message.reply_text("Error al actualizar los pedidos.")
+        return
+    notify_delivered_orders_on_commit(context.bot, delivered)
+    await update.message.reply_text(delivery_summary(results))
 
 async def change_status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Maneja la entrada del código de confirmación para cambiar el estado de un pedido."""
+    """
+    Maneja la entrada del código de confirmación para cambiar el estado de un pedido.
+    Si el mensaje trae varios códigos, los marca a todos juntos y responde con un resumen.
+    """
+    codes = parse_confirmation_codes(update.message.text)
+    if len(codes) > 1:
+        await deliver_codes(update, context, codes)
+        return MAIN_MENU
     code = update.message.text.strip()
-    user_id = update_order_status(code)
+    try:
+        user_id = update_order_status(code)
+    except Exception as e:
+        logger.error(f"Error al actualizar el estado del pedido: {e}")
+        await update.message.reply_text("Error al actualizar el pedido.")
+        return MAIN_MENU
     if user_id is None:
         await update.message.reply_text("Código inválido. Por favor, ingrese un código válido:")
         return CHANGE_STATUS  # Permite reintentar
     else:
-        # Notificar al usuario cuyo pedido se actualizó
-        try:
-            await context.bot.send_message(chat_id=user_id, text="Su pedido ha sido marcado como entregado.")
-        except Exception as e:
-            logger.error(f"Error al notificar al usuario: {e}")
+        # Notificar al usuario cuyo pedido se actualizó, una vez confirmado el cambio
+        notify_delivered_orders_on_commit(context.bot, [(code, user_id)])
         await update.message.reply_text("Cambio de estado exitoso.")
         return MAIN_MENU
 
+MAX_CODES_FILE_BYTES = 100 * 1024
+
+async def entregados_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Marca como entregados varios pedidos de una vez (para el personal de reparto).
+    Uso: /entregados <código1> <código2> ...
+    También acepta un archivo .txt con los códigos y el texto /entregados como descripción.
+    """
+    user_id = update.effective_user.id
+    if user_id not in allowed_ids and not es_trabajador(user_id):
+        await update.message.reply_text("No tienes permisos para usar esta función.")
+        return
+    message = update.message
+    if message.document:
+        if message.document.file_size and message.document.file_size > MAX_CODES_FILE_BYTES:
+            await message.reply_text("El archivo es demasiado grande.")
+            return
+        file = await message.document.get_file()
+        content = bytes(await file.download_as_bytearray()).decode("utf-8", errors="ignore")
+        codes = parse_confirmation_codes(content)
+    else:
+        codes = parse_confirmation_codes(message.text)[1:]  # Sin el comando
+    if not codes:
+        await message.reply_text("Uso: /entregados <código1> <código2> ...\n"
+                                 "o envíe un archivo .txt con los códigos y /entregados como descripción.")
+        return
+    await deliver_codes(update, context, codes)
+
 def get_delivered_orders(telegram_id, limit=20):
     """Obtiene los últimos 'limit' pedidos entregados para el usuario."""
     conn = None
@@ -321,10 +2257,8 @@ def get_delivered_orders(telegram_id, limit=20):
     try:
         conn = connect_db()
         cur = conn.cursor()
-        cur.execute(
-            "SELECT id, cart_id, confirmation_code, order_date FROM orders WHERE telegram_id = %s AND status = 'entregado' ORDER BY order_date DESC LIMIT %s",
-            (telegram_id, limit)
-        )
+        # Los entregados pueden estar en 'orders' o, si son viejos, en 'orders_archive'
+        statements.execute(cur, "delivered_orders", (telegram_id, limit, telegram_id, limit, limit))
         orders = cur.fetchall()
         return orders
     except Exception as e:
@@ -340,9 +2274,8 @@ async def show_history_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     telegram_id = query.from_user.id
     orders = get_delivered_orders(telegram_id, limit=20)
     if not orders:
-        keyboard = [[InlineKeyboardButton("Volver al Menú Principal", callback_data="back_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("No tienes pedidos entregados en tu historial.", reply_markup=reply_markup)
+        reply_markup = BACK_MAIN_MARKUP
+        await edit_view(query, "No tienes pedidos entregados en tu historial.", reply_markup=reply_markup)
         return MAIN_MENU
     text = "Historial de pedidos entregados:\n\n"
     for order in orders:
@@ -352,11 +2285,777 @@ async def show_history_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         else:
             order_date_str = str(order_date)
         text += f"Pedido #{order_id}: Código {confirmation_code} - Fecha {order_date_str}\n"
-    keyboard = [[InlineKeyboardButton("Volver al Menú Principal", callback_data="back_main")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text, reply_markup=reply_markup)
+    reply_markup = BACK_MAIN_MARKUP
+    await edit_view(query, text, reply_markup=reply_markup)
     return MAIN_MENU
 
+#########################################
+# ARCHIVO DE PEDIDOS ENTREGADOS
+#########################################
+
+# 'orders' guarda solo los pedidos "vivos": pendientes y entregados recientes. Una tarea
+# periódica mueve por lotes a 'orders_archive' los entregados hace más de
+# ORDERS_ARCHIVE_DAYS días cuyo conjunto ya terminó, así las consultas de pedidos
+# pendientes no crecen con el historial. El historial del cliente lee de ambas tablas.
+ORDERS_ARCHIVE_DAYS = int(os.getenv("ORDERS_ARCHIVE_DAYS", "30"))
+ORDERS_ARCHIVE_BATCH = int(os.getenv("ORDERS_ARCHIVE_BATCH", "5000"))
+ORDERS_ARCHIVE_INTERVAL = int(os.getenv("ORDERS_ARCHIVE_INTERVAL", "3600"))
+
+ORDER_COLUMNS = "id, cart_id, telegram_id, confirmation_code, status, order_date, entrega_date, conjunto_id, payment_id"
+
+archive_stats = {"runs": 0, "archived": 0, "last_run_ms": 0.0}
+register_metrics("orders_archive", lambda: dict(archive_stats))
+
+
+def create_orders_indexes(cur):
+    """Índices de las consultas frecuentes sobre pedidos (pendientes) y del archivo."""
+    cur.execute("CREATE INDEX IF NOT EXISTS orders_pending_conjunto_idx ON orders (conjunto_id) WHERE status = 'pendiente'")
+    cur.execute("CREATE INDEX IF NOT EXISTS orders_pending_user_idx ON orders (telegram_id, order_date DESC) WHERE status = 'pendiente'")
+    cur.execute("CREATE INDEX IF NOT EXISTS orders_conjunto_idx ON orders (conjunto_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS orders_cart_idx ON orders (cart_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS orders_archive_user_idx ON orders_archive (telegram_id, order_date DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS orders_archive_code_idx ON orders_archive (confirmation_code)")
+    cur.execute("CREATE INDEX IF NOT EXISTS orders_archive_payment_idx ON orders_archive (payment_id) WHERE payment_id IS NOT NULL")
+
+
+def archive_delivered_orders(cur, older_than_days, batch_size):
+    """
+    Mueve un lote de pedidos entregados hace más de 'older_than_days' días (y cuyo conjunto
+    ya no existe) de 'orders' a 'orders_archive', en una sola sentencia.
+    Retorna la cantidad de pedidos movidos.
+    """
+    cur.execute(
+        "WITH moved AS ("
+        "DELETE FROM orders WHERE id IN ("
+        "SELECT o.id FROM orders o WHERE o.status = 'entregado' "
+        "AND COALESCE(o.entrega_date, o.order_date) < NOW() - make_interval(days => %s) "
+        "AND (o.conjunto_id IS NULL OR NOT EXISTS (SELECT 1 FROM conjuntos c WHERE c.id = o.conjunto_id)) "
+        "LIMIT %s FOR UPDATE SKIP LOCKED) "
+        f"RETURNING {ORDER_COLUMNS}) "
+        f"INSERT INTO orders_archive ({ORDER_COLUMNS}) SELECT {ORDER_COLUMNS} FROM moved",
+        (older_than_days, batch_size)
+    )
+    return cur.rowcount
+
+
+async def run_orders_archival():
+    """Tarea periódica: archiva los pedidos entregados viejos, un lote por transacción."""
+    start = time.perf_counter()
+    total = 0
+    try:
+        while True:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                moved = archive_delivered_orders(cur, ORDERS_ARCHIVE_DAYS, ORDERS_ARCHIVE_BATCH)
+                conn.commit()
+                cur.close()
+            total += moved
+            if moved < ORDERS_ARCHIVE_BATCH:
+                break
+            # Entre lote y lote se deja correr al resto del bot
+            await asyncio.sleep(0.1)
+    except Exception as e:
+        logger.error(f"Error al archivar pedidos entregados: {e}")
+    archive_stats["runs"] += 1
+    archive_stats["archived"] += total
+    archive_stats["last_run_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    if total:
+        logger.info(f"Se archivaron {total} pedidos entregados")
+
+
+if ORDERS_ARCHIVE_DAYS > 0:
+    scheduler.add_job(run_orders_archival, "interval", seconds=ORDERS_ARCHIVE_INTERVAL,
+                      id="orders_archival", max_instances=1, coalesce=True)
+
+
+#########################################
+# ESTADÍSTICAS DE VENTAS (/stats)
+#########################################
+
+# Resúmenes diarios que se actualizan en la misma transacción que crea o entrega el pedido,
+# para que /stats lea unas pocas filas por día en lugar de recorrer orders y cart_items:
+#   ventas_diarias    (día, producto): pedidos, unidades, gramos e ingresos
+#   pedidos_diarios   (día, fragmento): pedidos; el fragmento es cart_id % STATS_ORDER_SHARDS,
+#                     así los checkouts simultáneos no esperan todos por la misma fila
+#   entregas_diarias  (día, equipo): entregas (equipo 0 = conjunto sin equipo)
+# Los totales del día (ingresos, entregas) se suman de esas mismas tablas al leer.
+STATS_DEFAULT_DAYS = 7
+STATS_TOP_PRODUCTS = 10
+STATS_ORDER_SHARDS = int(os.getenv("STATS_ORDER_SHARDS", "16"))
+
+
+def create_sales_rollup_tables(cur):
+    """Crea las tablas de resúmenes diarios."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS ventas_diarias (
+            dia DATE NOT NULL,
+            product_id INTEGER NOT NULL,
+            pedidos INTEGER NOT NULL DEFAULT 0,
+            unidades NUMERIC NOT NULL DEFAULT 0,
+            gramos NUMERIC NOT NULL DEFAULT 0,
+            ingresos NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, product_id)
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS pedidos_diarios (
+            dia DATE NOT NULL,
+            shard INTEGER NOT NULL,
+            pedidos INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, shard)
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS entregas_diarias (
+            dia DATE NOT NULL,
+            equipo_id INTEGER NOT NULL,
+            entregas INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, equipo_id)
+        );
+    """)
+
+
+# Suma al resumen las líneas del carrito de un pedido (o de varios, en la reconstrucción)
+SALES_ROLLUP_UPSERT = """
+    INSERT INTO ventas_diarias (dia, product_id, pedidos, unidades, gramos, ingresos)
+    SELECT s.dia, s.product_id, s.pedidos,
+           CASE WHEN p.sale_type = 'unidad' THEN s.cantidad ELSE 0 END,
+           CASE WHEN p.sale_type = 'unidad' THEN 0 ELSE s.cantidad END,
+           s.ingresos
+    FROM ({items}) s
+    JOIN products p ON p.id = s.product_id
+    ON CONFLICT (dia, product_id) DO UPDATE SET
+        pedidos = ventas_diarias.pedidos + EXCLUDED.pedidos,
+        unidades = ventas_diarias.unidades + EXCLUDED.unidades,
+        gramos = ventas_diarias.gramos + EXCLUDED.gramos,
+        ingresos = ventas_diarias.ingresos + EXCLUDED.ingresos
+"""
+
+
+def record_sale(cur, cart_id):
+    """Suma un pedido nuevo (el contenido de su carrito) a los resúmenes del día."""
+    cur.execute(SALES_ROLLUP_UPSERT.format(items=
+        "SELECT CURRENT_DATE AS dia, product_id, 1 AS pedidos, SUM(quantity) AS cantidad, SUM(subtotal) AS ingresos "
+        "FROM cart_items WHERE cart_id = %s GROUP BY product_id"), (cart_id,))
+    cur.execute(
+        "INSERT INTO pedidos_diarios (dia, shard, pedidos) VALUES (CURRENT_DATE, %s, 1) "
+        "ON CONFLICT (dia, shard) DO UPDATE SET pedidos = pedidos_diarios.pedidos + 1",
+        (cart_id % STATS_ORDER_SHARDS,)
+    )
+
+
+def record_deliveries(cur, conjunto_ids):
+    """
+    Suma las entregas del día por equipo. 'conjunto_ids' tiene un elemento por pedido entregado
+    (None si no tenía conjunto); debe llamarse antes de finalizar los conjuntos.
+    """
+    if not conjunto_ids:
+        return
+    cur.execute(
+        "INSERT INTO entregas_diarias (dia, equipo_id, entregas) "
+        "SELECT CURRENT_DATE, COALESCE(c.equipo_id, 0), COUNT(*) "
+        "FROM unnest(%s::integer[]) AS e(conjunto_id) LEFT JOIN conjuntos c ON c.id = e.conjunto_id "
+        "GROUP BY 2 "
+        "ON CONFLICT (dia, equipo_id) DO UPDATE SET entregas = entregas_diarias.entregas + EXCLUDED.entregas",
+        (list(conjunto_ids),)
+    )
+
+
+def rebuild_sales_rollups(cur):
+    """
+    Recalcula los resúmenes desde orders, orders_archive y cart_items (se usa una sola vez,
+    cuando las tablas de resúmenes están vacías). Las entregas de conjuntos ya finalizados
+    quedan como "sin equipo", porque el conjunto ya no existe.
+    """
+    all_orders = (
+        "SELECT cart_id, order_date, entrega_date, status, conjunto_id FROM orders "
+        "UNION ALL SELECT cart_id, order_date, entrega_date, status, conjunto_id FROM orders_archive"
+    )
+    cur.execute(SALES_ROLLUP_UPSERT.format(items=
+        "SELECT o.order_date::date AS dia, ci.product_id, COUNT(DISTINCT o.cart_id) AS pedidos, "
+        "SUM(ci.quantity) AS cantidad, SUM(ci.subtotal) AS ingresos "
+        f"FROM ({all_orders}) o JOIN cart_items ci ON ci.cart_id = o.cart_id "
+        "GROUP BY 1, 2"))
+    cur.execute(
+        "INSERT INTO pedidos_diarios (dia, shard, pedidos) "
+        "SELECT o.order_date::date, o.cart_id %% %s, COUNT(*) "
+        f"FROM ({all_orders}) o "
+        "GROUP BY 1, 2 "
+        "ON CONFLICT (dia, shard) DO NOTHING",
+        (STATS_ORDER_SHARDS,)
+    )
+    cur.execute(
+        "INSERT INTO entregas_diarias (dia, equipo_id, entregas) "
+        "SELECT o.entrega_date::date, COALESCE(c.equipo_id, 0), COUNT(*) "
+        f"FROM ({all_orders}) o LEFT JOIN conjuntos c ON c.id = o.conjunto_id "
+        "WHERE o.status = 'entregado' AND o.entrega_date IS NOT NULL "
+        "GROUP BY 1, 2 "
+        "ON CONFLICT (dia, equipo_id) DO NOTHING"
+    )
+
+
+def init_sales_rollups(cur):
+    """Crea las tablas de resúmenes y, si están vacías y ya hay pedidos, las reconstruye."""
+    create_sales_rollup_tables(cur)
+    cur.execute("SELECT to_regclass('ventas_diarias_totales') IS NOT NULL")
+    if cur.fetchone()[0]:
+        # Versión anterior: una sola fila de totales por día (ingresos y entregas ahora se suman
+        # de ventas_diarias y entregas_diarias)
+        cur.execute(
+            "INSERT INTO pedidos_diarios (dia, shard, pedidos) "
+            "SELECT dia, 0, pedidos FROM ventas_diarias_totales WHERE pedidos > 0 "
+            "ON CONFLICT (dia, shard) DO NOTHING"
+        )
+        cur.execute("DROP TABLE ventas_diarias_totales")
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pedidos_diarios)")
+    if cur.fetchone()[0]:
+        return
+    cur.execute("SELECT EXISTS (SELECT 1 FROM orders) OR EXISTS (SELECT 1 FROM orders_archive)")
+    if cur.fetchone()[0]:
+        logger.info("Reconstruyendo los resúmenes diarios de ventas")
+        rebuild_sales_rollups(cur)
+
+
+def query_sales_stats(cur, desde, hasta):
+    """
+    Estadísticas de ventas entre 'desde' y 'hasta' (fechas, ambas incluidas), leídas de los
+    resúmenes diarios. Retorna un dict con totales, productos más vendidos y entregas por equipo.
+    """
+    cur.execute(
+        "SELECT (SELECT COALESCE(SUM(pedidos), 0) FROM pedidos_diarios WHERE dia BETWEEN %s AND %s), "
+        "(SELECT COALESCE(SUM(ingresos), 0) FROM ventas_diarias WHERE dia BETWEEN %s AND %s), "
+        "(SELECT COALESCE(SUM(entregas), 0) FROM entregas_diarias WHERE dia BETWEEN %s AND %s)",
+        (desde, hasta) * 3
+    )
+    pedidos, ingresos, entregados = cur.fetchone()
+    cur.execute(
+        "SELECT p.name, SUM(v.pedidos), SUM(v.unidades), SUM(v.gramos), SUM(v.ingresos) "
+        "FROM ventas_diarias v JOIN products p ON p.id = v.product_id "
+        "WHERE v.dia BETWEEN %s AND %s "
+        "GROUP BY p.id, p.name ORDER BY SUM(v.ingresos) DESC LIMIT %s",
+        (desde, hasta, STATS_TOP_PRODUCTS)
+    )
+    productos = cur.fetchall()
+    cur.execute(
+        "SELECT equipo_id, SUM(entregas) FROM entregas_diarias "
+        "WHERE dia BETWEEN %s AND %s GROUP BY equipo_id ORDER BY SUM(entregas) DESC",
+        (desde, hasta)
+    )
+    equipos = cur.fetchall()
+    return {
+        "pedidos": pedidos,
+        "ingresos": ingresos,
+        "entregados": entregados,
+        "productos": productos,
+        "equipos": equipos,
+    }
+
+
+def get_sales_stats(desde, hasta):
+    """Ver query_sales_stats."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        stats = query_sales_stats(cur, desde, hasta)
+        cur.close()
+    return stats
+
+
+def parse_stats_range(args, today=None):
+    """
+    Interpreta los argumentos de /stats y retorna (desde, hasta):
+      (nada)                    últimos STATS_DEFAULT_DAYS días
+      hoy | ayer                ese día
+      <n>                       últimos n días
+      <AAAA-MM-DD>              ese día
+      <AAAA-MM-DD> <AAAA-MM-DD> ese rango
+    También la usa /exportar. Lanza ValueError si los argumentos no son válidos.
+    """
+    today = today or datetime.date.today()
+    if not args:
+        return today - datetime.timedelta(days=STATS_DEFAULT_DAYS - 1), today
+    if len(args) == 1:
+        arg = args[0].lower()
+        if arg == "hoy":
+            return today, today
+        if arg == "ayer":
+            day = today - datetime.timedelta(days=1)
+            return day, day
+        if arg.isdigit():
+            days = int(arg)
+            if days < 1:
+                raise ValueError("La cantidad de días debe ser mayor a 0.")
+            return today - datetime.timedelta(days=days - 1), today
+        day = datetime.date.fromisoformat(arg)
+        return day, day
+    if len(args) == 2:
+        desde = datetime.date.fromisoformat(args[0])
+        hasta = datetime.date.fromisoformat(args[1])
+        if desde > hasta:
+            desde, hasta = hasta, desde
+        return desde, hasta
+    raise ValueError("Demasiados argumentos.")
+
+
+def format_sales_stats(stats, desde, hasta):
+    """Texto de la respuesta de /stats."""
+    periodo = f"{desde:%d/%m/%Y}" if desde == hasta else f"{desde:%d/%m/%Y} al {hasta:%d/%m/%Y}"
+    lines = [
+        f"Estadísticas del {periodo}",
+        f"Pedidos: {stats['pedidos']}",
+        f"Ingresos: ${stats['ingresos']:.2f}",
+        f"Entregados: {stats['entregados']}",
+    ]
+    if stats["productos"]:
+        lines.append("\nProductos más vendidos:")
+        for name, pedidos, unidades, gramos, ingresos in stats["productos"]:
+            cantidad = []
+            if unidades:
+                cantidad.append(f"{unidades:g} u.")
+            if gramos:
+                cantidad.append(f"{gramos:g} g")
+            lines.append(f"- {name}: {', '.join(cantidad) or '0'} en {pedidos} "
+                         f"{'pedido' if pedidos == 1 else 'pedidos'} (${ingresos:.2f})")
+    if stats["equipos"]:
+        lines.append("\nEntregas por equipo:")
+        for equipo_id, entregas in stats["equipos"]:
+            label = f"Equipo {equipo_id}" if equipo_id else "Sin equipo"
+            lines.append(f"- {label}: {entregas}")
+    return "\n".join(lines)
+
+
+@admin_only
+async def stats_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Muestra las ventas de un período.
+    Uso: /stats [hoy | ayer | <días> | <AAAA-MM-DD> [<AAAA-MM-DD>]]
+    """
+    args = update.message.text.split()[1:]
+    try:
+        desde, hasta = parse_stats_range(args)
+    except ValueError:
+        await update.message.reply_text(
+            "Uso: /stats [hoy | ayer | <días> | <AAAA-MM-DD> [<AAAA-MM-DD>]]\n"
+            f"Sin argumentos muestra los últimos {STATS_DEFAULT_DAYS} días."
+        )
+        return
+    try:
+        stats = get_sales_stats(desde, hasta)
+    except Exception as e:
+        logger.error(f"Error al obtener estadísticas: {e}")
+        await update.message.reply_text("Error al obtener las estadísticas.")
+        return
+    await update.message.reply_text(format_sales_stats(stats, desde, hasta))
+
+
+#########################################
+# EXPORTACIÓN DE PEDIDOS (CSV / PARQUET)
+#########################################
+
+# Exporta una fila por línea de carrito de cada pedido (orders y orders_archive) con su
+# producto y su cliente. Las filas se leen con un cursor con nombre de a EXPORT_CHUNK y se
+# escriben a medida que llegan, así la memoria no crece con el tamaño del período.
+# Parquet requiere pyarrow (opcional, se importa solo al usarlo).
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "10000"))
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
+EXPORT_FORMATS = ("csv", "parquet")
+# Límite de Telegram para documentos enviados por bots
+EXPORT_MAX_DOCUMENT_BYTES = 50 * 1024 * 1024
+
+EXPORT_COLUMNS = [
+    ("pedido_id", "o.id"),
+    ("codigo", "o.confirmation_code"),
+    ("estado", "o.status"),
+    ("fecha_pedido", "o.order_date"),
+    ("fecha_entrega", "o.entrega_date"),
+    ("telegram_id", "o.telegram_id"),
+    ("cliente", "u.name"),
+    ("direccion", "u.address"),
+    ("producto", "p.name"),
+    ("tipo_venta", "p.sale_type"),
+    ("cantidad", "ci.quantity"),
+    ("subtotal", "ci.subtotal"),
+]
+
+
+def iter_export_rows(conn, desde, hasta):
+    """
+    Recorre las líneas de los pedidos hechos entre 'desde' y 'hasta' (fechas, ambas incluidas)
+    con un cursor del lado del servidor, de a EXPORT_CHUNK filas.
+    """
+    columns = ", ".join(expr for _, expr in EXPORT_COLUMNS)
+    cur = conn.cursor(name="order_export")
+    cur.itersize = EXPORT_CHUNK
+    try:
+        cur.execute(
+            f"SELECT {columns} FROM ("
+            "SELECT id, cart_id, telegram_id, confirmation_code, status, order_date, entrega_date FROM orders "
+            "UNION ALL "
+            "SELECT id, cart_id, telegram_id, confirmation_code, status, order_date, entrega_date FROM orders_archive"
+            ") o "
+            "JOIN cart_items ci ON ci.cart_id = o.cart_id "
+            "JOIN products p ON p.id = ci.product_id "
+            "LEFT JOIN users u ON u.telegram_id = o.telegram_id "
+            "WHERE o.order_date >= %s AND o.order_date < %s "
+            "ORDER BY o.order_date, o.id",
+            (desde, hasta + datetime.timedelta(days=1))
+        )
+        while True:
+            rows = cur.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
+
+
+def iter_csv_chunks(chunks):
+    """Convierte cada bloque de filas en un bloque de texto CSV (con encabezado al inicio)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in EXPORT_COLUMNS])
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def write_orders_csv(chunks, fileobj):
+    """Escribe las filas como CSV en 'fileobj' (texto). Retorna la cantidad de filas."""
+    count = 0
+
+    def counted():
+        nonlocal count
+        for rows in chunks:
+            count += len(rows)
+            yield rows
+
+    for text in iter_csv_chunks(counted()):
+        fileobj.write(text)
+    return count
+
+
+def write_orders_parquet(chunks, path):
+    """
+    Escribe las filas como Parquet en 'path', un row group por bloque.
+    Retorna la cantidad de filas. Lanza ImportError si pyarrow no está instalado.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    types = {
+        "pedido_id": pa.int64(), "telegram_id": pa.int64(),
+        "fecha_pedido": pa.timestamp("us"), "fecha_entrega": pa.timestamp("us"),
+        "cantidad": pa.float64(), "subtotal": pa.float64(),
+    }
+    schema = pa.schema([(name, types.get(name, pa.string())) for name, _ in EXPORT_COLUMNS])
+    numeric = {i for i, (name, _) in enumerate(EXPORT_COLUMNS) if types.get(name) == pa.float64()}
+    count = 0
+    with pq.ParquetWriter(path, schema, compression="snappy") as writer:
+        for rows in chunks:
+            columns = []
+            for i, values in enumerate(zip(*rows)):
+                if i in numeric:
+                    values = [None if v is None else float(v) for v in values]
+                columns.append(pa.array(values, type=schema.field(i).type))
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            count += len(rows)
+    return count
+
+
+def export_orders(desde, hasta, fmt, path):
+    """
+    Exporta los pedidos del período a 'path' en formato 'csv' o 'parquet', usando una
+    conexión dedicada (el cursor con nombre la ocupa durante toda la exportación).
+    Retorna la cantidad de filas escritas.
+    """
+    conn = db_pool.dedicated()
+    try:
+        chunks = iter_export_rows(conn, desde, hasta)
+        if fmt == "parquet":
+            return write_orders_parquet(chunks, path)
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            return write_orders_csv(chunks, f)
+    finally:
+        conn.close()
+
+
+def export_filename(desde, hasta, fmt):
+    return f"pedidos_{desde:%Y%m%d}_{hasta:%Y%m%d}.{fmt}"
+
+
+@admin_only
+async def exportar_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Envía como documento los pedidos de un período.
+    Uso: /exportar [csv | parquet] [hoy | ayer | <días> | <AAAA-MM-DD> [<AAAA-MM-DD>]]
+    """
+    args = update.message.text.split()[1:]
+    fmt = "csv"
+    if args and args[0].lower() in EXPORT_FORMATS:
+        fmt = args.pop(0).lower()
+    try:
+        desde, hasta = parse_stats_range(args)
+    except ValueError:
+        await update.message.reply_text(
+            "Uso: /exportar [csv | parquet] [hoy | ayer | <días> | <AAAA-MM-DD> [<AAAA-MM-DD>]]\n"
+            f"Sin período exporta los últimos {STATS_DEFAULT_DAYS} días."
+        )
+        return
+    filename = export_filename(desde, hasta, fmt)
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        # La exportación es bloqueante: corre en un hilo para no frenar al bot
+        rows = await asyncio.to_thread(export_orders, desde, hasta, fmt, path)
+        if os.path.getsize(path) > EXPORT_MAX_DOCUMENT_BYTES:
+            await update.message.reply_text(
+                "La exportación supera el tamaño máximo de un documento de Telegram. "
+                "Usa un período más corto o la ruta /export/orders."
+            )
+            return
+        with open(path, "rb") as doc_file:
+            await context.bot.send_document(chat_id=update.effective_chat.id, document=doc_file,
+                                            filename=filename, caption=f"{rows} filas")
+    except ImportError:
+        await update.message.reply_text("El formato parquet requiere instalar pyarrow.")
+    except Exception as e:
+        logger.error(f"Error al exportar pedidos: {e}")
+        await update.message.reply_text("Error al exportar los pedidos.")
+    finally:
+        os.remove(path)
+
+
+@app.route("/export/orders", methods=["GET"])
+def export_orders_route():
+    """
+    Exporta los pedidos de un período: /export/orders?desde=AAAA-MM-DD&hasta=AAAA-MM-DD&formato=csv|parquet
+    Requiere EXPORT_TOKEN en el encabezado 'Authorization: Bearer <token>' (no se acepta en
+    la URL, que queda en los logs de proxies y del navegador).
+    El CSV se envía a medida que se lee; el Parquet se arma en un archivo temporal.
+    """
+    if not bearer_token_valid(EXPORT_TOKEN):
+        return jsonify({"error": "no autorizado"}), 403
+    fmt = request.args.get("formato", "csv").lower()
+    try:
+        hasta = datetime.date.fromisoformat(request.args["hasta"]) if "hasta" in request.args else datetime.date.today()
+        desde = datetime.date.fromisoformat(request.args["desde"]) if "desde" in request.args else hasta
+    except ValueError:
+        return jsonify({"error": "fechas inválidas (formato AAAA-MM-DD)"}), 400
+    if fmt not in EXPORT_FORMATS or desde > hasta:
+        return jsonify({"error": "parámetros inválidos"}), 400
+    filename = export_filename(desde, hasta, fmt)
+
+    if fmt == "csv":
+        def generate():
+            conn = db_pool.dedicated()
+            try:
+                yield from iter_csv_chunks(iter_export_rows(conn, desde, hasta))
+            finally:
+                conn.close()
+        return Response(generate(), mimetype="text/csv",
+                        headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+    fd, path = tempfile.mkstemp(suffix=".parquet")
+    os.close(fd)
+    try:
+        export_orders(desde, hasta, fmt, path)
+    except ImportError:
+        os.remove(path)
+        return jsonify({"error": "el formato parquet requiere pyarrow"}), 501
+    except Exception as e:
+        os.remove(path)
+        logger.error(f"Error al exportar pedidos: {e}")
+        return jsonify({"error": "error al exportar"}), 500
+    response = send_file(path, mimetype="application/vnd.apache.parquet", as_attachment=True, download_name=filename)
+    response.call_on_close(lambda: os.remove(path))
+    return response
+
+
+#########################################
+# LISTA DE PREPARACIÓN PARA EL PROVEEDOR
+#########################################
+
+# Cantidad total por producto de los pedidos pendientes (todos, o los de algunos conjuntos o
+# equipos), para que el proveedor no tenga que sumar a mano los mensajes de cada pedido.
+# Se calcula con un solo GROUP BY y se cachea con la versión de "conjuntos", que cambia con
+# cada pedido nuevo, entregado o reasignado. PICKING_LIST_TIMES ("HH:MM,HH:MM", UTC) programa
+# el envío automático a PICKING_LIST_CHAT_ID.
+PICKING_LIST_TIMES = os.getenv("PICKING_LIST_TIMES", "")
+PICKING_LIST_CHAT_ID = int(os.getenv("PICKING_LIST_CHAT_ID", str(PROVIDER_CHAT_ID)))
+# Cache propio (no el de teclados): clave (versión de "conjuntos", números, equipos)
+picking_cache = TTLCache(maxsize=64, ttl=float(os.getenv("PICKING_CACHE_TTL", "120")))
+picking_cache_lock = threading.Lock()
+
+
+def query_picking_list(cur, numeros=None, equipo_ids=None):
+    """
+    Suma cantidad por producto de los pedidos pendientes, opcionalmente solo de los conjuntos
+    con esos números o de los equipos indicados.
+    Retorna (items, total_pedidos), con items = [(nombre, sale_type, cantidad, pedidos)].
+    """
+    conditions = ["o.status = 'pendiente'"]
+    params = []
+    if numeros:
+        conditions.append("c.numero_conjunto = ANY(%s)")
+        params.append(list(numeros))
+    if equipo_ids:
+        conditions.append("c.equipo_id = ANY(%s)")
+        params.append(list(equipo_ids))
+    # El conjunto de agrupamiento vacío agrega la fila con el total de pedidos distintos
+    cur.execute(
+        "SELECT p.name, p.sale_type, SUM(ci.quantity), COUNT(DISTINCT o.id), GROUPING(p.id) "
+        "FROM orders o "
+        "JOIN cart_items ci ON ci.cart_id = o.cart_id "
+        "JOIN products p ON p.id = ci.product_id "
+        "LEFT JOIN conjuntos c ON c.id = o.conjunto_id "
+        f"WHERE {' AND '.join(conditions)} "
+        "GROUP BY GROUPING SETS ((p.id, p.name, p.sale_type), ()) "
+        "ORDER BY GROUPING(p.id), p.name",
+        params
+    )
+    items = []
+    total_pedidos = 0
+    for name, sale_type, cantidad, pedidos, is_total in cur.fetchall():
+        if is_total:
+            total_pedidos = pedidos
+        else:
+            items.append((name, sale_type, cantidad, pedidos))
+    return items, total_pedidos
+
+
+def get_picking_list(numeros=None, equipo_ids=None):
+    """Ver query_picking_list. El resultado se cachea hasta el próximo cambio en los pedidos."""
+    def build():
+        with db_connection() as conn:
+            cur = conn.cursor()
+            result = query_picking_list(cur, numeros, equipo_ids)
+            cur.close()
+        return result
+    key = (keyboards.version("conjuntos"), tuple(numeros or ()), tuple(equipo_ids or ()))
+    with picking_cache_lock:
+        result = picking_cache.get(key)
+    if result is None:
+        result = build()
+        with picking_cache_lock:
+            picking_cache[key] = result
+    return result
+
+
+def format_picking_quantity(sale_type, cantidad):
+    if sale_type == "unidad":
+        return f"{cantidad:g} u."
+    if cantidad >= 1000:
+        return f"{cantidad / 1000:g} kg"
+    return f"{cantidad:g} g"
+
+
+def picking_list_lines(items, total_pedidos, titulo):
+    lines = [titulo, f"Pedidos pendientes: {total_pedidos}", ""]
+    for name, sale_type, cantidad, pedidos in items:
+        lines.append(f"- {name}: {format_picking_quantity(sale_type, cantidad)} "
+                     f"({pedidos} {'pedido' if pedidos == 1 else 'pedidos'})")
+    return lines
+
+
+def picking_list_title(numeros=None, equipo_ids=None):
+    titulo = "Lista de preparación"
+    if numeros:
+        titulo += f" - conjuntos {format_numeros(numeros)}"
+    if equipo_ids:
+        titulo += f" - equipos {', '.join(str(e) for e in equipo_ids)}"
+    return titulo
+
+
+def generate_picking_list_pdf(items, total_pedidos, titulo):
+    """Genera el PDF de la lista de preparación en un archivo temporal y retorna su ruta."""
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Arial", size=12)
+    pdf.cell(0, 10, txt=titulo, ln=True)
+    pdf.cell(0, 10, txt=f"Fecha: {datetime.datetime.now():%Y-%m-%d %H:%M}", ln=True)
+    pdf.cell(0, 10, txt=f"Pedidos pendientes: {total_pedidos}", ln=True)
+    pdf.ln(5)
+    for name, sale_type, cantidad, pedidos in items:
+        pdf.cell(120, 10, txt=name, border=1)
+        pdf.cell(40, 10, txt=format_picking_quantity(sale_type, cantidad), border=1)
+        pdf.cell(30, 10, txt=str(pedidos), border=1, ln=True)
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    os.close(fd)
+    pdf.output(path)
+    return path
+
+
+async def send_picking_list(bot, chat_id, numeros=None, equipo_ids=None, as_pdf=False):
+    """Envía la lista de preparación como mensaje o como PDF. Retorna False si no hay pedidos."""
+    items, total_pedidos = get_picking_list(numeros, equipo_ids)
+    if not items:
+        return False
+    titulo = picking_list_title(numeros, equipo_ids)
+    if not as_pdf:
+        await bot.send_message(chat_id=chat_id, text="\n".join(picking_list_lines(items, total_pedidos, titulo)),
+                               rate_limit_args=PRIORITY_NOTIFICATION)
+        return True
+    path = await asyncio.to_thread(generate_picking_list_pdf, items, total_pedidos, titulo)
+    try:
+        with open(path, "rb") as doc_file:
+            await bot.send_document(chat_id=chat_id, document=doc_file,
+                                    filename=f"preparacion_{datetime.datetime.now():%Y%m%d_%H%M}.pdf")
+    finally:
+        os.remove(path)
+    return True
+
+
+@admin_only
+async def preparacion_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Envía la cantidad total por producto de los pedidos pendientes.
+    Uso: /preparacion [pdf] [conjuntos <números> | equipos <ids>]
+    """
+    args = update.message.text.split()[1:]
+    as_pdf = bool(args) and args[0].lower() == "pdf"
+    if as_pdf:
+        args = args[1:]
+    numeros = equipo_ids = None
+    try:
+        if args and args[0].lower() in ("conjunto", "conjuntos"):
+            numeros = parse_numeros_conjunto(" ".join(args[1:]))
+        elif args and args[0].lower() in ("equipo", "equipos"):
+            equipo_ids = sorted({int(e) for e in re.split(r"[\s,;]+", " ".join(args[1:]).strip())})
+        elif args:
+            raise ValueError("Filtro desconocido")
+    except ValueError:
+        await update.message.reply_text(
+            "Uso: /preparacion [pdf] [conjuntos <números> | equipos <ids>]\n"
+            "Ejemplos: /preparacion, /preparacion pdf, /preparacion conjuntos 1-10, /preparacion equipos 2,3"
+        )
+        return
+    try:
+        sent = await send_picking_list(context.bot, update.effective_chat.id, numeros, equipo_ids, as_pdf)
+    except Exception as e:
+        logger.error(f"Error al generar la lista de preparación: {e}")
+        await update.message.reply_text("Error al generar la lista de preparación.")
+        return
+    if not sent:
+        await update.message.reply_text("No hay pedidos pendientes para esa selección.")
+
+
+async def run_scheduled_picking_list():
+    """Tarea programada: envía la lista de preparación completa si hay pedidos pendientes."""
+    try:
+        await send_picking_list(TELEGRAM_BOT, PICKING_LIST_CHAT_ID, as_pdf=True)
+    except Exception as e:
+        logger.error(f"Error al enviar la lista de preparación programada: {e}")
+
+
+for _time in filter(None, (t.strip() for t in PICKING_LIST_TIMES.split(","))):
+    _hour, _minute = _time.split(":")
+    scheduler.add_job(run_scheduled_picking_list, "cron", hour=int(_hour), minute=int(_minute),
+                      id=f"picking_list_{_hour}{_minute}", coalesce=True)
+
+
 #########################################
 # NUEVAS FUNCIONES PARA GESTIÓN DE CONJUNTOS
 #########################################
@@ -366,91 +3065,225 @@ def get_last_conjunto():
     Retorna el último conjunto creado (con su id y número de conjunto)
     o None si aún no existe.
     """
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id, numero_conjunto FROM conjuntos ORDER BY id DESC LIMIT 1")
-    result = cur.fetchone()
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        statements.execute(cur, "last_conjunto")
+        result = cur.fetchone()
+        cur.close()
     return result  # Ej: (3, 1) => id=3, numero_conjunto=1
 
 def count_pending_orders_in_conjunto(conjunto_id):
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM orders WHERE conjunto_id = %s AND status = 'pendiente'", (conjunto_id,))
-    count = cur.fetchone()[0]
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        statements.execute(cur, "pending_in_conjunto", (conjunto_id,))
+        count = cur.fetchone()[0]
+        cur.close()
     return count
 
-# 1. Función para generar el PDF de un conjunto
+#########################################
+# PDF DE CONJUNTOS PRE-GENERADOS
+#########################################
 
-def generate_conjunto_pdf(conjunto_id, show_confirmation=True):
+# Los PDF de los conjuntos se generan en un pool de hilos cuando el conjunto se llena o se
+# asigna a un equipo, y se guardan en memoria (con y sin códigos de confirmación); descargar
+# uno es solo enviarlo. Cuando cambia el estado de un pedido del conjunto el PDF se descarta
+# y se vuelve a generar reusando los bloques ya armados de cada pedido (artículos y código),
+# así solo se repiten las dos consultas del conjunto. Si se pide un PDF que no está listo se
+# genera en el momento, como antes.
+CONJUNTO_PDF_WORKERS = int(os.getenv("CONJUNTO_PDF_WORKERS", "2"))
+CONJUNTO_PDF_CACHE_SIZE = int(os.getenv("CONJUNTO_PDF_CACHE_SIZE", "500"))
+CONJUNTO_PDF_BLOCKS = int(os.getenv("CONJUNTO_PDF_BLOCKS", "5000"))
+
+
+def conjunto_order_block(order):
+    """Datos de un pedido para el PDF (una fila de 'conjunto_orders'); no dependen de su estado."""
+    order_id, cart_id, confirmation_code, order_date, client_id = order
+    # Formatear la fecha
+    if isinstance(order_date, datetime.datetime):
+        fecha = order_date.strftime("%Y-%m-%d %H:%M:%S")
+    else:
+        fecha = str(order_date)
+    items = [f"{item['name']}: {item['quantity']} = {item['subtotal']:.2f}" for item in get_cart_details(cart_id)]
+    return {"fecha": fecha, "items": items, "client_id": client_id, "confirmation_code": confirmation_code}
+
+
+def render_conjunto_pdf(pendientes, blocks, show_confirmation=True):
     """
-    Genera un PDF para el conjunto especificado.
-    Se listan los pedidos del conjunto con su fecha/hora de pago, artículos (nombre, cantidad, subtotal),
-    datos del cliente y código de confirmación (este último solo se muestra si show_confirmation es True).
-    También se muestra la cantidad de pedidos restantes al inicio y al final.
-    
-    Retorna el nombre del archivo PDF generado.
+    Arma el PDF de un conjunto: sus pedidos con fecha/hora de pago, artículos (nombre,
+    cantidad, subtotal), datos del cliente y código de confirmación (solo si show_confirmation),
+    con la cantidad de pedidos restantes al inicio y al final. Retorna los bytes del PDF.
     """
     from fpdf import FPDF
     pdf = FPDF()
     pdf.add_page()
     pdf.set_font("Arial", size=12)
-    
-    # Obtener la cantidad de pedidos pendientes en el conjunto
-    pendientes = count_pending_orders_in_conjunto(conjunto_id)
     pdf.cell(0, 10, txt=f"Pedidos restantes: {pendientes}", ln=True)
     pdf.ln(5)
-    
-    # Obtener todos los pedidos del conjunto ordenados por fecha
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, cart_id, confirmation_code, order_date, telegram_id FROM orders WHERE conjunto_id = %s ORDER BY order_date",
-        (conjunto_id,)
-    )
-    pedidos = cur.fetchall()
-    cur.close()
-    release_db(conn)
-    
-    for pedido in pedidos:
-        order_id, cart_id, confirmation_code, order_date, client_id = pedido
-        # Formatear la fecha
-        if isinstance(order_date, datetime.datetime):
-            fecha = order_date.strftime("%Y-%m-%d %H:%M:%S")
-        else:
-            fecha = str(order_date)
-        pdf.cell(0, 10, txt=f"Fecha y Hora del pedido: {fecha}", ln=True)
+    for block in blocks:
+        pdf.cell(0, 10, txt=f"Fecha y Hora del pedido: {block['fecha']}", ln=True)
         pdf.ln(2)
         pdf.cell(0, 10, txt="Artículos:", ln=True)
-        # Obtener los items del carrito (usando tu función get_cart_details)
-        items = get_cart_details(cart_id)
-        for item in items:
-            line = f"{item['name']}: {item['quantity']} = {item['subtotal']:.2f}"
+        for line in block["items"]:
             pdf.cell(0, 10, txt=line, ln=True)
         pdf.ln(2)
         pdf.cell(0, 10, txt="Cliente:", ln=True)
-        # Obtener información del cliente (usando tu función get_user_info)
-        client_info = get_user_info_cached(client_id)
+        # Los datos del cliente no se guardan en el bloque: puede cambiar su dirección
+        client_info = get_user_info_cached(block["client_id"])
         if client_info:
             pdf.cell(0, 10, txt=f"Nombre: {client_info['name']}", ln=True)
             pdf.cell(0, 10, txt=f"Dirección: {client_info['address']}", ln=True)
         else:
             pdf.cell(0, 10, txt="Nombre: Desconocido", ln=True)
             pdf.cell(0, 10, txt="Dirección: Desconocida", ln=True)
-        # Mostrar el código de confirmación solo si se solicita
         if show_confirmation:
-            pdf.cell(0, 10, txt=f"Código de Confirmación: {confirmation_code}", ln=True)
+            pdf.cell(0, 10, txt=f"Código de Confirmación: {block['confirmation_code']}", ln=True)
         pdf.ln(5)
-    
     pdf.ln(5)
     pdf.cell(0, 10, txt=f"Pedidos restantes: {pendientes}", ln=True)
-    
-    filename = f"conjunto_{conjunto_id}.pdf"
-    pdf.output(filename)
-    return filename
+    # fpdf 1.x retorna str (latin-1) y fpdf2 un bytearray
+    data = pdf.output(dest="S")
+    return data.encode("latin-1") if isinstance(data, str) else bytes(data)
+
+
+def load_conjunto(conjunto_id):
+    """(pedidos pendientes, filas de 'conjunto_orders') del conjunto."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        statements.execute(cur, "pending_in_conjunto", (conjunto_id,))
+        pendientes = cur.fetchone()[0]
+        statements.execute(cur, "conjunto_orders", (conjunto_id,))
+        pedidos = cur.fetchall()
+        cur.close()
+    return pendientes, pedidos
+
+
+class ConjuntoDocuments:
+    """
+    PDFs de conjuntos listos para enviar. Cada conjunto tiene una versión que cambia al
+    invalidarlo; un PDF generado se guarda solo si su versión sigue vigente al terminar.
+    """
+
+    def __init__(self, workers, cache_size, blocks_size):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._versions = {}
+        self._counter = itertools.count(1)
+        self._queued = set()
+        self._documents = LRUCache(maxsize=cache_size)
+        self._blocks = LRUCache(maxsize=blocks_size)
+        self._stats = {"prerendered": 0, "hits": 0, "misses": 0, "block_hits": 0, "block_misses": 0,
+                       "discarded": 0, "errors": 0}
+
+    def _version(self, conjunto_id):
+        version = self._versions.get(conjunto_id)
+        if version is None:
+            version = self._versions[conjunto_id] = next(self._counter)
+        return version
+
+    def _blocks_for(self, pedidos):
+        blocks = []
+        for pedido in pedidos:
+            with self._lock:
+                block = self._blocks.get(pedido[0])
+                self._stats["block_hits" if block is not None else "block_misses"] += 1
+            if block is None:
+                block = conjunto_order_block(pedido)
+                with self._lock:
+                    self._blocks[pedido[0]] = block
+            blocks.append(block)
+        return blocks
+
+    def _render(self, conjunto_id, version, variants=(True, False)):
+        """
+        Genera las variantes pedidas del PDF (con y/o sin códigos de confirmación) y las
+        guarda si 'version' sigue vigente.
+        """
+        pendientes, pedidos = load_conjunto(conjunto_id)
+        blocks = self._blocks_for(pedidos)
+        documents = {show: render_conjunto_pdf(pendientes, blocks, show) for show in variants}
+        with self._lock:
+            if self._versions.get(conjunto_id) == version:
+                cached = self._documents.get(conjunto_id)
+                if cached is not None and cached[0] == version:
+                    documents = {**cached[1], **documents}
+                self._documents[conjunto_id] = (version, documents)
+            else:
+                self._stats["discarded"] += 1
+        return documents
+
+    def _prerender(self, conjunto_id):
+        with self._lock:
+            self._queued.discard(conjunto_id)
+            version = self._version(conjunto_id)
+        try:
+            self._render(conjunto_id, version)
+            with self._lock:
+                self._stats["prerendered"] += 1
+        except Exception as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            logger.error(f"Error al generar el PDF del conjunto {conjunto_id}: {e}")
+
+    def get(self, conjunto_id, show_confirmation=True):
+        """Bytes del PDF del conjunto; si no está generado (o quedó viejo) se genera ahora."""
+        with self._lock:
+            version = self._version(conjunto_id)
+            cached = self._documents.get(conjunto_id)
+            if cached is not None and cached[0] == version and show_confirmation in cached[1]:
+                self._stats["hits"] += 1
+                return cached[1][show_confirmation]
+            self._stats["misses"] += 1
+        return self._render(conjunto_id, version, (show_confirmation,))[show_confirmation]
+
+    def refresh(self, conjunto_ids):
+        """Descarta los PDF de los conjuntos y los vuelve a generar en segundo plano."""
+        self.discard(conjunto_ids)
+        with self._lock:
+            pending = [conjunto_id for conjunto_id in conjunto_ids if conjunto_id not in self._queued]
+            self._queued.update(pending)
+            if pending and self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="conjunto-pdf")
+        for conjunto_id in pending:
+            self._executor.submit(self._prerender, conjunto_id)
+
+    def discard(self, conjunto_ids):
+        """Descarta los PDF de los conjuntos (cambiaron o ya no existen)."""
+        with self._lock:
+            for conjunto_id in conjunto_ids:
+                self._versions.pop(conjunto_id, None)
+                self._documents.pop(conjunto_id, None)
+
+    def refresh_on_commit(self, conjunto_ids):
+        conjunto_ids = [conjunto_id for conjunto_id in conjunto_ids if conjunto_id is not None]
+        if conjunto_ids:
+            on_commit(lambda: self.refresh(conjunto_ids))
+
+    def discard_on_commit(self, conjunto_ids):
+        conjunto_ids = [conjunto_id for conjunto_id in conjunto_ids if conjunto_id is not None]
+        if conjunto_ids:
+            on_commit(lambda: self.discard(conjunto_ids))
+
+    def get_stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["documents"] = len(self._documents)
+            data["blocks"] = len(self._blocks)
+            data["queued"] = len(self._queued)
+        return data
+
+
+conjunto_documents = ConjuntoDocuments(CONJUNTO_PDF_WORKERS, CONJUNTO_PDF_CACHE_SIZE, CONJUNTO_PDF_BLOCKS)
+register_metrics("conjunto_pdfs", conjunto_documents.get_stats)
+
+
+# 1. Función para generar el PDF de un conjunto
+
+def generate_conjunto_pdf(conjunto_id, show_confirmation=True):
+    """Genera el PDF del conjunto desde cero, sin caches. Retorna los bytes del PDF."""
+    pendientes, pedidos = load_conjunto(conjunto_id)
+    return render_conjunto_pdf(pendientes, [conjunto_order_block(pedido) for pedido in pedidos], show_confirmation)
 
 # -----------------------------------------------------------------------------
 # 2. Función para obtener el equipo al que pertenece un trabajador
@@ -461,12 +3294,11 @@ def get_equipo_del_trabajador(telegram_id):
     (si el trabajador está en la tabla 'equipos' en alguna de las columnas trabajador1 o trabajador2).
     Si no se encuentra, retorna None.
     """
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id, trabajador1, trabajador2 FROM equipos WHERE trabajador1 = %s OR trabajador2 = %s", (telegram_id, telegram_id))
-    row = cur.fetchone()
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        statements.execute(cur, "equipo_del_trabajador", (telegram_id, telegram_id))
+        row = cur.fetchone()
+        cur.close()
     if row:
         equipo_id, t1, t2 = row
         return {"id": equipo_id, "trabajador1": t1, "trabajador2": t2}
@@ -482,12 +3314,11 @@ def get_conjuntos_por_equipo(equipo_id):
     Cada diccionario contiene: id, numero (numero_conjunto) y pendientes.
     Se ordena de menor a mayor según la cantidad de pedidos pendientes.
     """
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id, numero_conjunto FROM conjuntos WHERE equipo_id = %s", (equipo_id,))
-    rows = cur.fetchall()
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        statements.execute(cur, "conjuntos_por_equipo", (equipo_id,))
+        rows = cur.fetchall()
+        cur.close()
     conjuntos = []
     for row in rows:
         conjunto_id, numero = row
@@ -511,49 +3342,44 @@ async def gestion_pedidos_personal_handler(update: Update, context: ContextTypes
     user_id = query.from_user.id
     equipo = get_equipo_del_trabajador(user_id)
     if not equipo:
-        await query.edit_message_text("No se encontró un equipo asignado a su cuenta.")
+        await edit_view(query, "No se encontró un equipo asignado a su cuenta.")
         return MAIN_MENU
     equipo_id = equipo["id"]
-    conjuntos = get_conjuntos_por_equipo(equipo_id)
-    if not conjuntos:
-        await query.edit_message_text("Usted y su compañero de equipo no tienen conjuntos asignados.")
+
+    def build():
+        conjuntos = get_conjuntos_por_equipo(equipo_id)
+        if not conjuntos:
+            return None
+        return keyboard_markup(*[[(f"Conjunto {c['numero']}: {c['pendientes']} pendientes", cb("descargar_pdf", c['id']))]
+                                 for c in conjuntos])
+
+    reply_markup = keyboards.get("conjuntos", ("equipo", equipo_id), build)
+    if reply_markup is None:
+        await edit_view(query, "Usted y su compañero de equipo no tienen conjuntos asignados.")
         return MAIN_MENU
-    buttons = []
-    for c in conjuntos:
-        btn_text = f"Conjunto {c['numero']}: {c['pendientes']} pendientes"
-        buttons.append([InlineKeyboardButton(btn_text, callback_data=f"descargarpdf_{c['id']}")])
-    reply_markup = InlineKeyboardMarkup(buttons)
-    await query.edit_message_text("Usted y su compañero de equipo tienen asignado los siguientes conjuntos (presione en un conjunto para consultarlo):", reply_markup=reply_markup)
+    await edit_view(query, "Usted y su compañero de equipo tienen asignado los siguientes conjuntos (presione en un conjunto para consultarlo):", reply_markup=reply_markup)
     return GESTION_PEDIDOS
 
 # -----------------------------------------------------------------------------
 # 5. Handler para descargar el PDF de un conjunto seleccionado
 
-async def descargar_pdf_conjunto_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def descargar_pdf_conjunto_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, conjunto_id: int) -> int:
     """
-    Cuando se presiona en un conjunto (botón con callback_data "descargarpdf_<conjunto_id>"),
-    se genera el PDF con la información de ese conjunto y se envía al usuario.
+    Cuando se presiona en un conjunto (acción "descargar_pdf" con el id del conjunto),
+    se envía el PDF con la información de ese conjunto (ver ConjuntoDocuments).
     Si el usuario es trabajador, se omite el código de confirmación.
     """
     query = update.callback_query
     await query.answer()
-    try:
-        # Extraer el id del conjunto del callback data "descargarpdf_<conjunto_id>"
-        conjunto_id = int(query.data.split("_")[1])
-    except Exception as e:
-        await query.edit_message_text("Error al procesar el conjunto seleccionado.")
-        return GESTION_PEDIDOS
     # Determinar si se debe mostrar el código de confirmación
     user_id = query.from_user.id
     show_conf = not es_trabajador(user_id)
-    filename = generate_conjunto_pdf(conjunto_id, show_confirmation=show_conf)
+    document = conjunto_documents.get(conjunto_id, show_confirmation=show_conf)
     # Enviar el PDF como documento
-    with open(filename, "rb") as doc_file:
-        await context.bot.send_document(chat_id=user_id, document=doc_file, filename=filename)
+    await context.bot.send_document(chat_id=user_id, document=document, filename=f"conjunto_{conjunto_id}.pdf")
     # Mostrar un botón para volver al menú de Gestión de Pedidos
-    keyboard = [[InlineKeyboardButton("Volver a Gestión de Pedidos", callback_data="gestion_pedidos_personal")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("PDF generado y enviado. Presione el botón para volver a Gestión de Pedidos.", reply_markup=reply_markup)
+    reply_markup = BACK_GESTION_PERSONAL_MARKUP
+    await edit_view(query, "PDF generado y enviado. Presione el botón para volver a Gestión de Pedidos.", reply_markup=reply_markup)
     return GESTION_PEDIDOS
 
 # -----------------------------------------------------------------------------
@@ -576,98 +3402,776 @@ async def descargar_pdf_conjunto_handler(update: Update, context: ContextTypes.D
 # Asegúrate de asignar un estado adecuado (por ejemplo, reutiliza GESTION_PEDIDOS o crea un nuevo estado si es necesario).
 
 
-def create_new_conjunto(numero_conjunto):
+#########################################
+# NUMERACIÓN DE CONJUNTOS
+#########################################
+
+# Los números de los conjuntos finalizados se reutilizan: al eliminar un conjunto su número
+# pasa a la tabla conjunto_numeros_libres y el próximo conjunto toma el menor libre (o el
+# siguiente al mayor en uso). Un advisory lock de transacción serializa las asignaciones
+# concurrentes, y el índice único sobre numero_conjunto lo garantiza en la base.
+CONJUNTO_NUMBER_LOCK = 7301
+
+
+def allocate_conjunto_number(cur):
+    """
+    Reserva el menor número de conjunto libre. Debe ejecutarse en la misma transacción
+    que inserta el conjunto: el lock se libera recién cuando esa transacción termina.
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (CONJUNTO_NUMBER_LOCK,))
+    while True:
+        cur.execute(
+            "DELETE FROM conjunto_numeros_libres "
+            "WHERE numero = (SELECT MIN(numero) FROM conjunto_numeros_libres) RETURNING numero"
+        )
+        row = cur.fetchone()
+        if row is None:
+            break
+        # Un número libre puede haberse usado a mano (creando el conjunto con número fijo)
+        cur.execute("SELECT 1 FROM conjuntos WHERE numero_conjunto = %s", (row[0],))
+        if cur.fetchone() is None:
+            return row[0]
+    cur.execute("SELECT COALESCE(MAX(numero_conjunto), 0) + 1 FROM conjuntos")
+    return cur.fetchone()[0]
+
+
+def release_conjunto_numbers(cur, numeros):
+    """Devuelve a la lista de libres los números de conjuntos eliminados."""
+    if numeros:
+        cur.execute(
+            "INSERT INTO conjunto_numeros_libres (numero) SELECT unnest(%s::integer[]) ON CONFLICT DO NOTHING",
+            (list(numeros),)
+        )
+
+
+def sync_conjunto_numbers(cur):
+    """
+    Reconstruye la lista de números libres a partir de los conjuntos existentes (huecos
+    entre 1 y el mayor número en uso). Se ejecuta al iniciar, por si quedó desfasada.
+    """
+    cur.execute(
+        "DELETE FROM conjunto_numeros_libres f "
+        "WHERE EXISTS (SELECT 1 FROM conjuntos c WHERE c.numero_conjunto = f.numero) "
+        "OR f.numero > (SELECT COALESCE(MAX(numero_conjunto), 0) FROM conjuntos)"
+    )
+    cur.execute(
+        "INSERT INTO conjunto_numeros_libres (numero) "
+        "SELECT g FROM generate_series(1, (SELECT COALESCE(MAX(numero_conjunto), 0) FROM conjuntos)) g "
+        "WHERE NOT EXISTS (SELECT 1 FROM conjuntos c WHERE c.numero_conjunto = g) "
+        "ON CONFLICT DO NOTHING"
+    )
+
+
+def get_next_available_conjunto_number():
+    """
+    Retorna el menor número entero positivo que NO está siendo usado en la tabla 'conjuntos'
+    (el que tomaría el próximo conjunto). No lo reserva: para crear un conjunto se usa
+    create_new_conjunto(), que asigna el número dentro de su transacción.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT COALESCE((SELECT MIN(numero) FROM conjunto_numeros_libres), "
+            "(SELECT COALESCE(MAX(numero_conjunto), 0) + 1 FROM conjuntos))"
+        )
+        numero = cur.fetchone()[0]
+        cur.close()
+    return numero
+
+
+def create_new_conjunto(numero_conjunto=None):
     """
-    Crea un nuevo registro en la tabla 'conjuntos' con el número de conjunto dado.
+    Crea un nuevo registro en la tabla 'conjuntos' con el número de conjunto dado
+    (o con el menor número libre si no se indica).
     Retorna el id del nuevo conjunto.
     """
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO conjuntos (numero_conjunto) VALUES (%s) RETURNING id", (numero_conjunto,))
-    new_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        if numero_conjunto is None:
+            numero_conjunto = allocate_conjunto_number(cur)
+        cur.execute("INSERT INTO conjuntos (numero_conjunto) VALUES (%s) RETURNING id", (numero_conjunto,))
+        new_id = cur.fetchone()[0]
+        conn.commit()
+        keyboards.bump_on_commit("conjuntos")
+        cur.close()
     return new_id
 
-def insert_order_with_conjunto(cart_id, telegram_id, confirmation_code):
+#########################################
+# CÓDIGOS DE CONFIRMACIÓN
+#########################################
+
+# Los códigos son únicos entre los pedidos pendientes: lo garantiza el índice único parcial
+# orders_pending_code_uidx (ver init_db). Si el código sorteado ya está en uso, el INSERT
+# falla y se reintenta con otro, deshaciendo solo ese INSERT (savepoint).
+CONFIRMATION_CODE_MIN = 100000
+CONFIRMATION_CODE_MAX = 999999
+CONFIRMATION_CODE_ATTEMPTS = 10
+
+code_stats = {"allocated": 0, "collisions": 0}
+register_metrics("confirmation_codes", lambda: dict(code_stats))
+
+
+def new_confirmation_code():
+    """Código de 6 dígitos impredecible (los clientes lo muestran para recibir el pedido)."""
+    return str(CONFIRMATION_CODE_MIN + secrets.randbelow(CONFIRMATION_CODE_MAX - CONFIRMATION_CODE_MIN + 1))
+
+
+class ConfirmationCodeIndexError(RuntimeError):
+    """No se pudo crear orders_pending_code_uidx (el bot no debe arrancar sin él)."""
+
+
+def ensure_pending_code_index(cur):
+    """
+    Crea orders_pending_code_uidx si falta. Antes, a los pedidos pendientes que repiten el
+    código de otro más antiguo se les asigna uno nuevo (la tabla queda bloqueada para
+    escrituras hasta el commit, así no aparecen repetidos entre medio).
+    Retorna [(telegram_id, order_id, código viejo, código nuevo)] para avisar a esos clientes.
+    """
+    cur.execute("SELECT to_regclass('orders_pending_code_uidx') IS NOT NULL")
+    if cur.fetchone()[0]:
+        return []
+    cur.execute("LOCK TABLE orders IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute(
+        "SELECT o.id, o.telegram_id, o.confirmation_code FROM orders o "
+        "WHERE o.status = 'pendiente' AND EXISTS (SELECT 1 FROM orders p WHERE p.status = 'pendiente' "
+        "AND p.confirmation_code = o.confirmation_code AND p.id < o.id) ORDER BY o.id"
+    )
+    duplicates = cur.fetchall()
+    renumbered = []
+    for order_id, telegram_id, old_code in duplicates:
+        while True:
+            code = new_confirmation_code()
+            cur.execute("SELECT 1 FROM orders WHERE status = 'pendiente' AND confirmation_code = %s", (code,))
+            if cur.fetchone() is None:
+                break
+        cur.execute("UPDATE orders SET confirmation_code = %s WHERE id = %s", (code, order_id))
+        renumbered.append((telegram_id, order_id, old_code, code))
+    if renumbered:
+        logger.error(f"Había {len(renumbered)} pedidos pendientes con códigos repetidos; se les asignó "
+                     f"un código nuevo: {[(order_id, old, new) for _, order_id, old, new in renumbered]}")
+    try:
+        cur.execute(
+            "CREATE UNIQUE INDEX orders_pending_code_uidx "
+            "ON orders (confirmation_code) WHERE status = 'pendiente'"
+        )
+    except psycopg2.Error as e:
+        raise ConfirmationCodeIndexError(f"No se pudo crear el índice único de códigos pendientes: {e}") from e
+    return renumbered
+
+
+async def notify_renumbered_codes(renumbered):
+    """Avisa a cada cliente el código nuevo de su pedido (ver ensure_pending_code_index)."""
+    for telegram_id, order_id, old_code, code in renumbered:
+        try:
+            await TELEGRAM_BOT.send_message(
+                chat_id=telegram_id,
+                text=f"El código de confirmación de su pedido #{order_id} cambió: ahora es {code} "
+                     f"(el código {old_code} ya no es válido para ese pedido).",
+                rate_limit_args=PRIORITY_NOTIFICATION,
+            )
+        except Exception as e:
+            logger.error(f"Error al avisar el código nuevo al usuario {telegram_id}: {e}")
+
+
+def insert_order_row(cur, cart_id, telegram_id, conjunto_id, confirmation_code=None, payment_id=None):
+    """
+    Inserta un pedido pendiente con un código de confirmación libre.
+    Si se pasa confirmation_code y ya está en uso, se propaga el UniqueViolation (también si
+    el payment_id ya tiene pedido).
+    Retorna (order_id, confirmation_code).
+    """
+    for attempt in range(CONFIRMATION_CODE_ATTEMPTS):
+        code = confirmation_code or new_confirmation_code()
+        cur.execute("SAVEPOINT order_code")
+        try:
+            cur.execute(
+                "INSERT INTO orders (cart_id, telegram_id, confirmation_code, status, conjunto_id, payment_id) "
+                "VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
+                (cart_id, telegram_id, code, "pendiente", conjunto_id, payment_id)
+            )
+        except psycopg2.errors.UniqueViolation as e:
+            cur.execute("ROLLBACK TO SAVEPOINT order_code")
+            if confirmation_code is not None or e.diag.constraint_name != "orders_pending_code_uidx":
+                raise
+            code_stats["collisions"] += 1
+            continue
+        order_id = cur.fetchone()[0]
+        cur.execute("RELEASE SAVEPOINT order_code")
+        code_stats["allocated"] += 1
+        return order_id, code
+    raise RuntimeError(f"No se pudo asignar un código de confirmación libre en {CONFIRMATION_CODE_ATTEMPTS} intentos")
+
+
+def insert_order_with_conjunto(cart_id, telegram_id, confirmation_code=None, payment_id=None):
     """
     Inserta un nuevo pedido y lo asigna a un conjunto.
     La lógica es:
-      - Si no existe ningún conjunto, se crea el conjunto 1.
-      - Si existe un conjunto y éste tiene menos de 3 pedidos, se asigna ese mismo conjunto.
-      - Si el conjunto actual ya tiene 3 pedidos, se crea un nuevo conjunto con el siguiente número.
-    Retorna una tupla (order_id, conjunto_id).
-    """
-    last = get_last_conjunto()
-    if last is None:
-        new_num = 1
-        conjunto_id = create_new_conjunto(new_num)
-    else:
-        last_conjunto_id, last_num = last
-        if count_orders_in_conjunto(last_conjunto_id) < 3:
-            conjunto_id = last_conjunto_id
+      - Con la agrupación por cercanía activa, el pedido queda sin conjunto (ver run_order_batcher).
+      - Si no existe ningún conjunto, se crea uno.
+      - Si existe un conjunto y éste tiene menos de CONJUNTO_SIZE pedidos (3 por defecto), se asigna ese mismo conjunto.
+      - Si el conjunto actual ya está lleno, se crea un nuevo conjunto con el menor número libre.
+      - Cuando el conjunto se llena, se asigna automáticamente al equipo menos cargado.
+    Si no se pasa confirmation_code, se asigna uno libre. payment_id es el pago de MercadoPago
+    que originó el pedido (ver process_approved_payment).
+    Retorna una tupla (order_id, conjunto_id, confirmation_code).
+    Todos los pasos se ejecutan en una misma unidad de trabajo (son atómicos).
+    """
+    with unit_of_work():
+        if CONJUNTO_BATCHING == "proximidad":
+            # El conjunto lo asigna después run_order_batcher, según la ubicación del cliente
+            conjunto_id = None
         else:
-            new_num = last_num + 1
-            conjunto_id = create_new_conjunto(new_num)
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute(
-         "INSERT INTO orders (cart_id, telegram_id, confirmation_code, status, conjunto_id) VALUES (%s, %s, %s, %s, %s) RETURNING id",
-         (cart_id, telegram_id, confirmation_code, "pendiente", conjunto_id)
-    )
-    order_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    release_db(conn)
-    return order_id, conjunto_id
+            last = get_last_conjunto()
+            if last is None:
+                conjunto_id = create_new_conjunto()
+            else:
+                last_conjunto_id, _ = last
+                if count_orders_in_conjunto(last_conjunto_id) < CONJUNTO_SIZE:
+                    conjunto_id = last_conjunto_id
+                else:
+                    conjunto_id = create_new_conjunto()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            order_id, confirmation_code = insert_order_row(cur, cart_id, telegram_id, conjunto_id,
+                                                           confirmation_code, payment_id)
+            record_sale(cur, cart_id)
+            conn.commit()
+            cur.close()
+        keyboards.bump_on_commit("conjuntos")
+        # El conjunto se llenó: se asigna al equipo menos cargado (que genera su PDF)
+        if conjunto_id is not None and count_orders_in_conjunto(conjunto_id) >= CONJUNTO_SIZE:
+            if not auto_assign_conjuntos([conjunto_id]):
+                conjunto_documents.refresh_on_commit([conjunto_id])
+        else:
+            conjunto_documents.discard_on_commit([conjunto_id])
+        return order_id, conjunto_id, confirmation_code
 
 def count_pending_orders_in_conjunto(conjunto_id):
     """
     Retorna la cantidad de pedidos pendientes en el conjunto.
     """
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM orders WHERE conjunto_id = %s AND status = 'pendiente'", (conjunto_id,))
-    count = cur.fetchone()[0]
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        statements.execute(cur, "pending_in_conjunto", (conjunto_id,))
+        count = cur.fetchone()[0]
+        cur.close()
+    return count
+
+def count_orders_in_conjunto(conjunto_id):
+    """
+    Retorna la cantidad total de pedidos (pendientes o no) asignados al conjunto.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        statements.execute(cur, "orders_in_conjunto", (conjunto_id,))
+        count = cur.fetchone()[0]
+        cur.close()
     return count
 
 def finalize_conjunto(conjunto_id):
     """
     Finaliza (elimina) el conjunto cuando ya no quedan pedidos pendientes.
     """
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM conjuntos WHERE id = %s", (conjunto_id,))
-    conn.commit()
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM conjuntos WHERE id = %s RETURNING numero_conjunto", (conjunto_id,))
+        release_conjunto_numbers(cur, [row[0] for row in cur.fetchall()])
+        conn.commit()
+        keyboards.bump_on_commit("conjuntos")
+        conjunto_documents.discard_on_commit([conjunto_id])
+        cur.close()
 
 def update_order_state(order_id, new_state):
     """
     Actualiza el estado de un pedido.
     Si se actualiza a 'entregado', y el conjunto del pedido ya no tiene pedidos pendientes,
     se finaliza el conjunto (se elimina).
+    La actualización y la finalización se confirman juntas en una unidad de trabajo.
     """
     now = datetime.datetime.now()
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE orders SET status = %s, entrega_date = %s WHERE id = %s RETURNING conjunto_id",
-        (new_state, now, order_id)
-    )
-    result = cur.fetchone()
-    conn.commit()
-    cur.close()
-    release_db(conn)
-    if result:
-         conjunto_id = result[0]
-         if new_state == "entregado" and count_pending_orders_in_conjunto(conjunto_id) == 0:
-              finalize_conjunto(conjunto_id)
+    with unit_of_work():
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "UPDATE orders SET status = %s, entrega_date = %s WHERE id = %s RETURNING conjunto_id",
+                (new_state, now, order_id)
+            )
+            result = cur.fetchone()
+            conn.commit()
+            cur.close()
+        if result:
+             keyboards.bump_on_commit("conjuntos")
+             conjunto_id = result[0]
+             if new_state == "entregado" and count_pending_orders_in_conjunto(conjunto_id) == 0:
+                  finalize_conjunto(conjunto_id)
+             else:
+                  conjunto_documents.refresh_on_commit([conjunto_id])
     return
 
+#########################################
+# AGRUPACIÓN DE PEDIDOS POR CERCANÍA
+#########################################
+
+# Por defecto (CONJUNTO_BATCHING=secuencial) se mantiene el esquema de "3 pedidos seguidos".
+# Con CONJUNTO_BATCHING=proximidad los pedidos nuevos quedan sin conjunto y una tarea
+# periódica los agrupa por cercanía de las ubicaciones de los clientes. Un grupo se cierra
+# cuando junta CONJUNTO_SIZE pedidos a menos de CONJUNTO_RADIUS_KM del más antiguo, o
+# cuando ese pedido ya esperó CONJUNTO_WINDOW segundos (sale con los que haya cerca).
+# La tarea corre en el scheduler del bot: para activarla el bot tiene que estar corriendo
+# (con wsgi.py solo no se agrupan).
+CONJUNTO_BATCHING = os.getenv("CONJUNTO_BATCHING", "secuencial")
+CONJUNTO_SIZE = int(os.getenv("CONJUNTO_SIZE", "3"))
+CONJUNTO_RADIUS_KM = float(os.getenv("CONJUNTO_RADIUS_KM", "2"))
+CONJUNTO_WINDOW = int(os.getenv("CONJUNTO_WINDOW", "900"))
+CONJUNTO_BATCH_INTERVAL = int(os.getenv("CONJUNTO_BATCH_INTERVAL", "60"))
+
+KM_PER_DEGREE = 111.32
+
+batching_stats = {"runs": 0, "orders_batched": 0, "conjuntos_created": 0, "last_run_ms": 0.0}
+register_metrics("batching", lambda: dict(batching_stats))
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Distancia aproximada (equirectangular); sobra precisión dentro de una ciudad."""
+    x = (lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = lat2 - lat1
+    return KM_PER_DEGREE * math.hypot(x, y)
+
+
+class GridIndex:
+    """
+    Índice espacial en memoria: grilla de celdas de 'cell_km' de lado sobre coordenadas
+    proyectadas a km alrededor de 'ref_lat'. near() recorre anillos de celdas alrededor
+    del punto y corta apenas ningún anillo más lejano puede mejorar el resultado.
+    """
+
+    def __init__(self, cell_km, ref_lat):
+        self.cell_km = cell_km
+        self.lon_km = KM_PER_DEGREE * max(math.cos(math.radians(ref_lat)), 0.01)
+        self._cells = {}
+        self._where = {}
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def _project(self, lat, lon):
+        return lat * KM_PER_DEGREE, lon * self.lon_km
+
+    def _cell(self, x, y):
+        return (int(math.floor(x / self.cell_km)), int(math.floor(y / self.cell_km)))
+
+    def insert(self, key, lat, lon):
+        x, y = self._project(lat, lon)
+        cell = self._cell(x, y)
+        self._cells.setdefault(cell, {})[key] = (x, y)
+        self._where[key] = cell
+
+    def remove(self, key):
+        cell = self._where.pop(key)
+        points = self._cells[cell]
+        del points[key]
+        if not points:
+            del self._cells[cell]
+
+    def _ring(self, row, col, r):
+        """Celdas a distancia de Chebyshev exactamente r de (row, col)."""
+        if r == 0:
+            yield row, col
+            return
+        for d in range(-r, r + 1):
+            yield row - r, col + d
+            yield row + r, col + d
+        for d in range(-r + 1, r):
+            yield row + d, col - r
+            yield row + d, col + r
+
+    def near(self, lat, lon, radius_km, limit=None):
+        """Retorna [(distancia, key)] de los puntos a menos de radius_km (los 'limit' más cercanos)."""
+        x, y = self._project(lat, lon)
+        row, col = self._cell(x, y)
+        max_d2 = radius_km * radius_km
+        found = []
+        for r in range(int(math.ceil(radius_km / self.cell_km)) + 1):
+            for cell in self._ring(row, col, r):
+                for key, (p_x, p_y) in self._cells.get(cell, {}).items():
+                    d2 = (p_x - x) ** 2 + (p_y - y) ** 2
+                    if d2 <= max_d2:
+                        found.append((d2, key))
+            # Todo lo que está más allá del anillo r queda a más de r * cell_km
+            if limit and len(found) >= limit and heapq.nsmallest(limit, found)[-1][0] <= (r * self.cell_km) ** 2:
+                break
+        found = heapq.nsmallest(limit, found) if limit else sorted(found)
+        return [(math.sqrt(d2), key) for d2, key in found]
+
+
+def build_proximity_batches(orders, now, size=None, radius_km=None, window=None):
+    """
+    Arma los grupos de pedidos. 'orders' es una lista de (order_id, lat, lon, order_date);
+    lat/lon pueden ser None si el cliente no compartió su ubicación (esos se agrupan por
+    orden de llegada). Retorna una lista de listas de order_id; los pedidos que todavía
+    pueden esperar a tener vecinos quedan afuera.
+    """
+    size = size or CONJUNTO_SIZE
+    radius_km = radius_km or CONJUNTO_RADIUS_KM
+    window = datetime.timedelta(seconds=CONJUNTO_WINDOW if window is None else window)
+    orders = sorted(orders, key=lambda o: o[3])
+    located = [o for o in orders if o[1] is not None and o[2] is not None]
+    unlocated = [o for o in orders if o[1] is None or o[2] is None]
+    batches = []
+
+    if located:
+        ref_lat = sum(o[1] for o in located) / len(located)
+        index = GridIndex(radius_km / 8, ref_lat)
+        for order_id, lat, lon, _ in located:
+            index.insert(order_id, lat, lon)
+        for order_id, lat, lon, order_date in located:
+            if order_id not in index:
+                continue  # Ya quedó en un grupo
+            group = [key for _, key in index.near(lat, lon, radius_km, limit=size)]
+            if order_id not in group:
+                group = [order_id] + group[:size - 1]
+            if len(group) == size or now - order_date >= window:
+                for key in group:
+                    index.remove(key)
+                batches.append(group)
+
+    for start in range(0, len(unlocated), size):
+        chunk = unlocated[start:start + size]
+        if len(chunk) == size or now - chunk[0][3] >= window:
+            batches.append([o[0] for o in chunk])
+    return batches
+
+
+def get_unbatched_orders():
+    """Pedidos pendientes sin conjunto, con la ubicación de su cliente."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT o.id, u.latitude, u.longitude, o.order_date FROM orders o "
+            "LEFT JOIN users u ON u.telegram_id = o.telegram_id "
+            "WHERE o.status = 'pendiente' AND o.conjunto_id IS NULL"
+        )
+        rows = cur.fetchall()
+        cur.close()
+    return rows
+
+
+def assign_batches_to_conjuntos(batches):
+    """
+    Crea un conjunto por grupo, le asigna sus pedidos y lo asigna a un equipo,
+    todo en una unidad de trabajo. Los pedidos del grupo se bloquean antes de crear el
+    conjunto: si otro proceso ya los agrupó (o los tiene tomados) el grupo se saltea y no
+    quedan conjuntos vacíos.
+    Retorna una tupla (conjuntos creados, pedidos agrupados).
+    """
+    with unit_of_work():
+        conjunto_ids = []
+        batched = 0
+        with db_connection() as conn:
+            cur = conn.cursor()
+            for batch in batches:
+                cur.execute(
+                    "SELECT id FROM orders WHERE id = ANY(%s) AND conjunto_id IS NULL "
+                    "FOR UPDATE SKIP LOCKED",
+                    (batch,)
+                )
+                order_ids = [row[0] for row in cur.fetchall()]
+                if not order_ids:
+                    continue
+                conjunto_id = create_new_conjunto()
+                cur.execute("UPDATE orders SET conjunto_id = %s WHERE id = ANY(%s)", (conjunto_id, order_ids))
+                conjunto_ids.append(conjunto_id)
+                batched += len(order_ids)
+            conn.commit()
+            cur.close()
+        if conjunto_ids:
+            keyboards.bump_on_commit("conjuntos")
+            auto_assign_conjuntos(conjunto_ids)
+    return len(conjunto_ids), batched
+
+
+async def run_order_batcher():
+    """Tarea periódica: agrupa los pedidos pendientes sin conjunto."""
+    start = time.perf_counter()
+    created = batched = 0
+    try:
+        orders = get_unbatched_orders()
+        batches = build_proximity_batches(orders, datetime.datetime.now())
+        if batches:
+            created, batched = assign_batches_to_conjuntos(batches)
+            logger.info(f"Agrupación por cercanía: {created} conjuntos nuevos con "
+                        f"{batched} pedidos ({len(orders)} sin agrupar)")
+    except Exception as e:
+        logger.error(f"Error agrupando pedidos en conjuntos: {e}")
+        return
+    batching_stats["runs"] += 1
+    batching_stats["orders_batched"] += batched
+    batching_stats["conjuntos_created"] += created
+    batching_stats["last_run_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+
+if CONJUNTO_BATCHING == "proximidad":
+    scheduler.add_job(run_order_batcher, "interval", seconds=CONJUNTO_BATCH_INTERVAL,
+                      id="order_batcher", max_instances=1, coalesce=True)
+
+
+def save_user_location(telegram_id, latitude, longitude):
+    """Guarda la ubicación del usuario. Retorna False si el usuario no está registrado."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE users SET latitude = %s, longitude = %s WHERE telegram_id = %s",
+            (latitude, longitude, telegram_id)
+        )
+        updated = cur.rowcount > 0
+        conn.commit()
+        cur.close()
+    return updated
+
+
+LOCATION_REQUEST_MARKUP = ReplyKeyboardMarkup(
+    [[KeyboardButton("Compartir ubicación", request_location=True)]],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
+
+
+async def ubicacion_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Pide al usuario que comparta su ubicación (se usa para agrupar los pedidos por zona)."""
+    await update.message.reply_text(
+        "Comparta su ubicación para que podamos organizar mejor las entregas:",
+        reply_markup=LOCATION_REQUEST_MARKUP
+    )
+
+
+async def location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Guarda la ubicación que el usuario compartió."""
+    location = update.message.location
+    try:
+        saved = save_user_location(update.effective_user.id, location.latitude, location.longitude)
+    except Exception as e:
+        logger.error(f"Error al guardar la ubicación: {e}")
+        await update.message.reply_text("Error al guardar la ubicación.", reply_markup=ReplyKeyboardRemove())
+        return
+    if saved:
+        await update.message.reply_text("Ubicación guardada.", reply_markup=ReplyKeyboardRemove())
+    else:
+        await update.message.reply_text("Primero debe registrarse con /start.", reply_markup=ReplyKeyboardRemove())
+
+
+#########################################
+# ASIGNACIÓN AUTOMÁTICA DE CONJUNTOS A EQUIPOS
+#########################################
+
+# Cada conjunto que se cierra se asigna al equipo con menos pedidos pendientes, y una tarea
+# periódica reparte lo que haya quedado sin asignar y mueve conjuntos (todavía sin empezar)
+# del equipo más cargado al menos cargado cuando la diferencia supera el umbral.
+CONJUNTO_AUTO_ASSIGN = os.getenv("CONJUNTO_AUTO_ASSIGN", "1") != "0"
+REBALANCE_INTERVAL = int(os.getenv("REBALANCE_INTERVAL", "600"))
+REBALANCE_THRESHOLD = int(os.getenv("REBALANCE_THRESHOLD", str(CONJUNTO_SIZE)))
+REBALANCE_MAX_MOVES = int(os.getenv("REBALANCE_MAX_MOVES", "10"))
+
+auto_assign_stats = {"assigned": 0, "moved": 0, "runs": 0}
+register_metrics("auto_assign", lambda: dict(auto_assign_stats))
+
+
+class TeamLoadHeap:
+    """
+    Montículo de equipos por carga (pedidos pendientes): least() retorna el menos cargado.
+    Al cambiar una carga se agrega una entrada nueva; las viejas se descartan al llegar arriba.
+    """
+
+    def __init__(self, loads):
+        self.loads = dict(loads)
+        self._heap = [(load, equipo_id) for equipo_id, load in self.loads.items()]
+        heapq.heapify(self._heap)
+
+    def least(self):
+        while self._heap:
+            load, equipo_id = self._heap[0]
+            if self.loads.get(equipo_id) == load:
+                return equipo_id, load
+            heapq.heappop(self._heap)
+        return None
+
+    def most(self):
+        if not self.loads:
+            return None
+        return max(self.loads.items(), key=lambda item: (item[1], -item[0]))
+
+    def add(self, equipo_id, delta):
+        self.loads[equipo_id] += delta
+        heapq.heappush(self._heap, (self.loads[equipo_id], equipo_id))
+
+
+def get_equipo_loads():
+    """Retorna {equipo_id: pedidos pendientes en sus conjuntos} con una sola consulta."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT e.id, COUNT(o.id) FROM equipos e "
+            "LEFT JOIN conjuntos c ON c.equipo_id = e.id "
+            "LEFT JOIN orders o ON o.conjunto_id = c.id AND o.status = 'pendiente' "
+            "GROUP BY e.id"
+        )
+        loads = dict(cur.fetchall())
+        cur.close()
+    return loads
+
+
+def get_closed_unassigned_conjuntos():
+    """
+    Conjuntos sin equipo que ya no van a recibir pedidos: con la agrupación por cercanía
+    son todos; en el esquema secuencial, los llenos y los que no son el último.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT c.id FROM conjuntos c WHERE c.equipo_id IS NULL AND (%s "
+            "OR c.id < (SELECT MAX(id) FROM conjuntos) "
+            "OR (SELECT COUNT(*) FROM orders o WHERE o.conjunto_id = c.id) >= %s)",
+            (CONJUNTO_BATCHING == "proximidad", CONJUNTO_SIZE)
+        )
+        ids = [row[0] for row in cur.fetchall()]
+        cur.close()
+    return ids
+
+
+def auto_assign_conjuntos(conjunto_ids):
+    """
+    Asigna los conjuntos indicados (si siguen sin equipo) al equipo menos cargado,
+    empezando por los de más pedidos. Retorna la cantidad asignada.
+    """
+    if not CONJUNTO_AUTO_ASSIGN or not conjunto_ids:
+        return 0
+    changes = []
+    assigned = []
+    with unit_of_work():
+        heap = TeamLoadHeap(get_equipo_loads())
+        if heap.least() is None:
+            logger.warning("No hay equipos para asignar conjuntos automáticamente")
+            return 0
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT c.id, c.numero_conjunto, COUNT(o.id) FROM conjuntos c "
+                "LEFT JOIN orders o ON o.conjunto_id = c.id AND o.status = 'pendiente' "
+                "WHERE c.id = ANY(%s) AND c.equipo_id IS NULL "
+                "GROUP BY c.id ORDER BY COUNT(o.id) DESC, c.id",
+                (list(conjunto_ids),)
+            )
+            for conjunto_id, numero, pendientes in cur.fetchall():
+                equipo_id, _ = heap.least()
+                cur.execute("UPDATE conjuntos SET equipo_id = %s WHERE id = %s", (equipo_id, conjunto_id))
+                heap.add(equipo_id, pendientes)
+                assigned.append(conjunto_id)
+                changes.append((equipo_id, f"Se asignó el conjunto {numero} a su equipo ({pendientes} pedidos pendientes)."))
+            conn.commit()
+            cur.close()
+        if changes:
+            keyboards.bump_on_commit("conjuntos")
+            conjunto_documents.refresh_on_commit(assigned)
+            notify_equipos_on_commit(changes)
+    auto_assign_stats["assigned"] += len(changes)
+    return len(changes)
+
+
+def rebalance_conjuntos():
+    """
+    Mueve conjuntos sin entregas del equipo más cargado al menos cargado mientras la
+    diferencia supere REBALANCE_THRESHOLD. Retorna la cantidad de conjuntos movidos.
+    """
+    changes = []
+    moved = 0
+    with unit_of_work():
+        heap = TeamLoadHeap(get_equipo_loads())
+        with db_connection() as conn:
+            cur = conn.cursor()
+            for _ in range(REBALANCE_MAX_MOVES):
+                least, most = heap.least(), heap.most()
+                if least is None or least[0] == most[0]:
+                    break
+                gap = most[1] - least[1]
+                if gap <= REBALANCE_THRESHOLD:
+                    break
+                # Solo conjuntos que el equipo todavía no empezó a entregar
+                cur.execute(
+                    "SELECT c.id, c.numero_conjunto, COUNT(o.id) FROM conjuntos c "
+                    "JOIN orders o ON o.conjunto_id = c.id WHERE c.equipo_id = %s "
+                    "GROUP BY c.id HAVING BOOL_AND(o.status = 'pendiente')",
+                    (most[0],)
+                )
+                # Mover p pedidos achica la diferencia si 0 < p < gap; lo ideal es p = gap / 2
+                candidates = [row for row in cur.fetchall() if 0 < row[2] < gap]
+                if not candidates:
+                    break
+                conjunto_id, numero, pendientes = min(candidates, key=lambda row: abs(gap / 2 - row[2]))
+                cur.execute("UPDATE conjuntos SET equipo_id = %s WHERE id = %s", (least[0], conjunto_id))
+                heap.add(most[0], -pendientes)
+                heap.add(least[0], pendientes)
+                moved += 1
+                changes.append((most[0], f"El conjunto {numero} se reasignó a otro equipo."))
+                changes.append((least[0], f"Se asignó el conjunto {numero} a su equipo ({pendientes} pedidos pendientes)."))
+            conn.commit()
+            cur.close()
+        if changes:
+            keyboards.bump_on_commit("conjuntos")
+            notify_equipos_on_commit(changes)
+    auto_assign_stats["moved"] += moved
+    return moved
+
+
+def notify_equipos_on_commit(changes):
+    """
+    Arma un solo mensaje por trabajador con todos los cambios de sus equipos y lo envía
+    cuando se confirma la unidad de trabajo. 'changes' es una lista de (equipo_id, texto).
+    """
+    by_equipo = {}
+    for equipo_id, text in changes:
+        by_equipo.setdefault(equipo_id, []).append(text)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, trabajador1, trabajador2 FROM equipos WHERE id = ANY(%s)", (list(by_equipo),))
+        rows = cur.fetchall()
+        cur.close()
+    by_worker = {}
+    for equipo_id, trabajador1, trabajador2 in rows:
+        for worker in (trabajador1, trabajador2):
+            if worker:
+                by_worker.setdefault(worker, []).extend(by_equipo[equipo_id])
+    if by_worker:
+        on_commit(lambda: run_on_bot_loop(send_worker_notifications(by_worker)))
+
+
+async def send_worker_notifications(by_worker):
+    results = await asyncio.gather(
+        *(TELEGRAM_BOT.send_message(chat_id=worker, text="\n".join(lines), rate_limit_args=PRIORITY_NOTIFICATION)
+          for worker, lines in by_worker.items()),
+        return_exceptions=True
+    )
+    for worker, result in zip(by_worker, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error al notificar al trabajador {worker}: {result}")
+
+
+async def run_auto_assignment():
+    """Tarea periódica: asigna los conjuntos cerrados sin equipo y rebalancea la carga."""
+    try:
+        assigned = auto_assign_conjuntos(get_closed_unassigned_conjuntos())
+        moved = rebalance_conjuntos()
+    except Exception as e:
+        logger.error(f"Error en la asignación automática de conjuntos: {e}")
+        return
+    auto_assign_stats["runs"] += 1
+    if assigned or moved:
+        logger.info(f"Asignación automática: {assigned} conjuntos asignados, {moved} reasignados")
+
+
+if CONJUNTO_AUTO_ASSIGN:
+    scheduler.add_job(run_auto_assignment, "interval", seconds=REBALANCE_INTERVAL,
+                      id="conjunto_rebalance", max_instances=1, coalesce=True)
+
+
 #########################################
 # GENERACIÓN DE PDF DE CONJUNTO (STUB)
 #########################################
@@ -677,12 +4181,11 @@ def es_trabajador(telegram_id):
     Devuelve True si el telegram_id pertenece a un trabajador (o a alguien del personal),
     consultando la tabla "trabajadores".
     """
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM trabajadores WHERE telegram_id = %s", (telegram_id,))
-    result = cur.fetchone()
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        statements.execute(cur, "es_trabajador", (telegram_id,))
+        result = cur.fetchone()
+        cur.close()
     return result is not None
 
 #########################################
@@ -737,45 +4240,21 @@ def es_trabajador(telegram_id):
 #########################################
 
 
-async def cart_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def cart_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, cart_id: int) -> int:
     """Muestra el menú para un carrito específico con sus opciones y botones para volver."""
     query = update.callback_query
     await query.answer()
-    logger.info(f"cart_menu_handler invocado con callback data: {query.data}")
-    try:
-        data = query.data
-        # Se espera que el callback data tenga el formato "cartmenu_{cart_id}"
-        if data.startswith("cartmenu_"):
-            parts = data.split("_")
-            cart_id = int(parts[1])
-        elif data.startswith("back_cart_"):
-            parts = data.split("_")
-            cart_id = int(parts[2])
-        else:
-            raise ValueError("Formato de callback data no reconocido")
-    except Exception as e:
-        logger.error(f"Error al procesar callback data en cart_menu_handler: {e}")
-        await query.edit_message_text("Error al procesar el carrito.")
-        return MAIN_MENU
+    logger.debug("cart_menu_handler invocado para el carrito %s", cart_id)
     context.user_data['selected_cart_id'] = cart_id
     carts = get_user_carts(query.from_user.id)
-    logger.info(f"Carritos del usuario: {carts}")
+    logger.debug("Carritos del usuario: %s", carts)
     cart_info = next((c for c in carts if c['id'] == cart_id), None)
     if not cart_info:
-        await query.edit_message_text("Carrito no encontrado.")
+        await edit_view(query, "Carrito no encontrado.")
         return MAIN_MENU
     text = f"Menú del carrito: {cart_info['name']} (Total: {cart_info['total']:.2f})"
-    keyboard = [
-        [InlineKeyboardButton("Ver detalles del carrito", callback_data=f"cart_details_{cart_id}")],
-        [InlineKeyboardButton("Agregar productos", callback_data=f"cart_add_{cart_id}")],
-        [InlineKeyboardButton("Quitar productos", callback_data=f"cart_remove_{cart_id}")],
-        [InlineKeyboardButton("Eliminar carrito", callback_data=f"cart_delete_{cart_id}")],
-        [InlineKeyboardButton("Pagar carrito", callback_data=f"cart_pay_{cart_id}")],
-        [InlineKeyboardButton("Volver a la lista de carritos", callback_data="show_carts")],
-        [InlineKeyboardButton("Volver al Menú Principal", callback_data="back_main")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text, reply_markup=reply_markup)
+    reply_markup = cart_menu_markup(cart_id)
+    await edit_view(query, text, reply_markup=reply_markup)
     return CART_MENU
 
 async def new_cart_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -785,29 +4264,22 @@ async def new_cart_query_handler(update: Update, context: ContextTypes.DEFAULT_T
     """
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("Ingrese el nombre del nuevo carrito:")
+    await edit_view(query, "Ingrese el nombre del nuevo carrito:")
     return NEW_CART
 
 
-async def cart_details_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def cart_details_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, cart_id: int) -> int:
     """
     Muestra los detalles del carrito: nombre, lista de productos con cantidad y subtotal, y total.
     Incluye un botón para volver al menú del carrito.
     """
     query = update.callback_query
     await query.answer()
-    try:
-        # Se espera que la callback_data tenga el formato "cart_details_{cart_id}"
-        cart_id = int(query.data.split("_")[2])
-    except Exception as e:
-        await query.edit_message_text("Error al procesar el carrito.")
-        return CART_MENU
-
     # Obtener la información del carrito del usuario
     carts = get_user_carts(query.from_user.id)
     cart_info = next((c for c in carts if c['id'] == cart_id), None)
     if not cart_info:
-        await query.edit_message_text("Carrito no encontrado.")
+        await edit_view(query, "Carrito no encontrado.")
         return CART_MENU
 
     # Obtener los detalles de los items del carrito
@@ -821,62 +4293,42 @@ async def cart_details_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     details_text += f"\nTotal: {cart_info['total']:.2f}"
 
     # Botón para volver al menú del carrito
-    keyboard = [[InlineKeyboardButton("Volver al menú del carrito", callback_data=f"cartmenu_{cart_id}")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(details_text, reply_markup=reply_markup)
+    reply_markup = cart_back_markup(cart_id)
+    await edit_view(query, details_text, reply_markup=reply_markup)
     return CART_MENU
 
 
-async def cart_add_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def cart_add_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, cart_id: int) -> int:
     """Redirige al flujo de agregar productos usando el carrito seleccionado."""
     query = update.callback_query
     await query.answer()
-    try:
-        cart_id = int(query.data.split("_")[2])
-    except Exception as e:
-        await query.edit_message_text("Error al procesar el carrito.")
-        return CART_MENU
     context.user_data['selected_cart_id'] = cart_id
-    products = get_products()
-    if not products:
-        await query.edit_message_text("No hay productos disponibles.")
-        return CART_MENU
-    keyboard = []
-    for product in products:
-        keyboard.append([InlineKeyboardButton(product['name'], callback_data=f"product_{product['id']}")])
     # El botón "Volver" regresa al menú del carrito específico
-    keyboard.append([InlineKeyboardButton("Volver al menú del carrito", callback_data=f"back_cart_{cart_id}")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Seleccione un producto para agregar:", reply_markup=reply_markup)
+    remember_products_back(context, back_cart_id=cart_id)
+    reply_markup = products_markup(back_cart_id=cart_id)
+    if reply_markup is None:
+        await edit_view(query, "No hay productos disponibles.")
+        return CART_MENU
+    await edit_view(query, "Seleccione un producto para agregar:", reply_markup=reply_markup)
     return ORDERING
 
-async def cart_remove_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def cart_remove_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, cart_id: int) -> int:
     """Muestra la lista de productos del carrito para quitar uno, con detalles y botón para volver al menú del carrito."""
     query = update.callback_query
     await query.answer()
-    logger.info(f"[cart_remove_handler] Callback data recibida: {query.data}")
-    try:
-        # Se espera que el callback data tenga el formato "cart_remove_{cart_id}"
-        parts = query.data.split("_")
-        if len(parts) < 3:
-            raise ValueError("Formato de callback data incorrecto")
-        cart_id = int(parts[2])
-    except Exception as e:
-        logger.error(f"[cart_remove_handler] Error al parsear callback data: {e}")
-        await query.edit_message_text("Error al procesar el carrito.")
-        return CART_MENU
+    logger.debug("[cart_remove_handler] Carrito seleccionado: %s", cart_id)
 
     # Obtener la información del carrito
     carts = get_user_carts(query.from_user.id)
     cart_info = next((c for c in carts if c['id'] == cart_id), None)
     if not cart_info:
-        await query.edit_message_text("Carrito no encontrado.")
+        await edit_view(query, "Carrito no encontrado.")
         return CART_MENU
 
     # Obtener los detalles actuales de los productos del carrito
     details = get_cart_details(cart_id)
     if not details:
-        await query.edit_message_text("El carrito está vacío.")
+        await edit_view(query, "El carrito está vacío.")
         return CART_MENU
 
     # Armar mensaje y teclado con la lista de productos
@@ -884,13 +4336,13 @@ async def cart_remove_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     msg += "Seleccione un producto para quitarlo:\n\n"
     keyboard = []
     for item in details:
-        # Se genera callback data en el formato "cart_removeitem_{cart_id}_{product_id}"
+        # Acción "cart_removeitem" con el carrito y el producto a quitar
         button_text = f"{item['name']} - {item['quantity']} = {item['subtotal']:.2f}"
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"cart_removeitem_{cart_id}_{item['product_id']}")])
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=cb("cart_removeitem", cart_id, item['product_id']))])
     # Botón para volver al menú del carrito
-    keyboard.append([InlineKeyboardButton("Volver al menú del carrito", callback_data=f"cartmenu_{cart_id}")])
+    keyboard.append([InlineKeyboardButton("Volver al menú del carrito", callback_data=cb("cart_menu", cart_id))])
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(msg, reply_markup=reply_markup)
+    await edit_view(query, msg, reply_markup=reply_markup)
     return CART_MENU
 
 
@@ -913,6 +4365,7 @@ def remove_product_from_cart(cart_id, product_id):
         # Actualizar el total del carrito en la tabla 'carts'
         cur.execute("UPDATE carts SET total = %s WHERE id = %s", (new_total, cart_id))
         conn.commit()
+        keyboards.bump_on_commit("carts")
         return True
     except Exception as e:
         logger.error(f"Error al eliminar producto del carrito: {e}")
@@ -937,9 +4390,8 @@ async def cambiar_direccion_handler(update: Update, context: ContextTypes.DEFAUL
     current_address = user_info.get("address", "No definida") if user_info else "No definida"
     
     # Mostrar la dirección actual y pedir la nueva
-    keyboard = [[InlineKeyboardButton("Cancelar", callback_data="cancelar_direccion")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(
+    reply_markup = CANCELAR_DIRECCION_MARKUP
+    await edit_view(query, 
         text=f"Tu dirección actual es: {current_address}\n\nPor favor, ingresa la nueva dirección:",
         reply_markup=reply_markup
     )
@@ -970,8 +4422,7 @@ async def procesar_cambio_direccion_handler(update: Update, context: ContextType
         if conn:
             release_db(conn)
     
-    keyboard = [[InlineKeyboardButton("Aceptar", callback_data="back_main")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = ACEPTAR_MARKUP
     await update.message.reply_text(
         text=f"Dirección actualizada exitosamente. Los pedidos serán enviados a: {new_address}",
         reply_markup=reply_markup
@@ -985,24 +4436,14 @@ async def cancelar_cambio_direccion_handler(update: Update, context: ContextType
     """
     query = update.callback_query
     await query.answer()
-    keyboard = [[InlineKeyboardButton("Aceptar", callback_data="back_main")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Cambio de dirección cancelado.", reply_markup=reply_markup)
+    reply_markup = ACEPTAR_MARKUP
+    await edit_view(query, "Cambio de dirección cancelado.", reply_markup=reply_markup)
     return MAIN_MENU
 
-async def cart_removeitem_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def cart_removeitem_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, cart_id: int, product_id: int) -> int:
     """Elimina el producto seleccionado del carrito y muestra la lista actualizada de productos para quitar."""
     query = update.callback_query
     await query.answer()
-    try:
-        # Se espera que la callback_data tenga el formato "cart_removeitem_{cart_id}_{product_id}"
-        parts = query.data.split("_")
-        cart_id = int(parts[2])
-        product_id = int(parts[3])
-    except Exception as e:
-        await query.edit_message_text("Error al procesar la selección.")
-        return CART_MENU
-
     # Intentar eliminar el producto del carrito
     success = remove_product_from_cart(cart_id, product_id)
     if success:
@@ -1014,7 +4455,7 @@ async def cart_removeitem_handler(update: Update, context: ContextTypes.DEFAULT_
     carts = get_user_carts(query.from_user.id)
     cart_info = next((c for c in carts if c['id'] == cart_id), None)
     if not cart_info:
-        await query.edit_message_text("Carrito no encontrado.")
+        await edit_view(query, "Carrito no encontrado.")
         return MAIN_MENU
 
     # Obtener los detalles actualizados de los productos en el carrito
@@ -1023,19 +4464,17 @@ async def cart_removeitem_handler(update: Update, context: ContextTypes.DEFAULT_
         msg += f"Carrito: {cart_info['name']} (Total: {cart_info['total']:.2f})\nSeleccione otro producto para quitarlo:\n\n"
         keyboard = []
         for item in details:
-            # Genera el callback data con el formato correcto
             keyboard.append([InlineKeyboardButton(
                 f"{item['name']} - {item['quantity']} = {item['subtotal']:.2f}",
-                callback_data=f"cart_removeitem_{cart_id}_{item['product_id']}"
+                callback_data=cb("cart_removeitem", cart_id, item['product_id'])
             )])
-        keyboard.append([InlineKeyboardButton("Volver al menú del carrito", callback_data=f"cartmenu_{cart_id}")])
+        keyboard.append([InlineKeyboardButton("Volver al menú del carrito", callback_data=cb("cart_menu", cart_id))])
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(msg, reply_markup=reply_markup)
+        await edit_view(query, msg, reply_markup=reply_markup)
     else:
         msg += "El carrito está vacío."
-        keyboard = [[InlineKeyboardButton("Volver al menú del carrito", callback_data=f"cartmenu_{cart_id}")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(msg, reply_markup=reply_markup)
+        reply_markup = cart_back_markup(cart_id)
+        await edit_view(query, msg, reply_markup=reply_markup)
     return CART_MENU
 
 
@@ -1047,9 +4486,11 @@ def delete_cart(cart_id):
     try:
         conn = connect_db()
         cur = conn.cursor()
+        release_stock(cur, cart_id)
         cur.execute("DELETE FROM cart_items WHERE cart_id = %s", (cart_id,))
         cur.execute("DELETE FROM carts WHERE id = %s", (cart_id,))
         conn.commit()
+        keyboards.bump_on_commit("carts")
         return True
     except Exception as e:
         logger.error(f"Error al eliminar el carrito: {e}")
@@ -1062,44 +4503,38 @@ def delete_cart(cart_id):
         if conn:
             release_db(conn)
 
-async def cart_delete_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def cart_delete_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, cart_id: int) -> int:
     """Elimina el carrito seleccionado y muestra la lista actualizada de carritos."""
     query = update.callback_query
     await query.answer()
-    try:
-        cart_id = int(query.data.split("_")[2])
-    except Exception as e:
-        await query.edit_message_text("Error al procesar el carrito.")
-        return CART_MENU
     if delete_cart(cart_id):
-        await query.edit_message_text("Carrito eliminado correctamente.")
+        await edit_view(query, "Carrito eliminado correctamente.")
     else:
-        await query.edit_message_text("Error al eliminar el carrito.")
+        await edit_view(query, "Error al eliminar el carrito.")
     # Mostrar la lista actualizada de carritos
     return await show_carts_handler(update, context)
 
-async def cart_pay_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def cart_pay_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, cart_id: int) -> int:
     """Muestra el botón para pagar el carrito seleccionado."""
     query = update.callback_query
     await query.answer()
+    context.user_data['selected_cart_id'] = cart_id
     try:
-        cart_id = int(query.data.split("_")[2])
-    except Exception as e:
-        await query.edit_message_text("Error al procesar el carrito.")
+        cart_name, init_point = create_payment_preference_for_cart(cart_id)
+    except OutOfStockError as e:
+        await edit_view(query, out_of_stock_text(e), reply_markup=cart_back_markup(cart_id))
         return CART_MENU
-    context.user_data['selected_cart_id'] = cart_id
-    cart_name, init_point = create_payment_preference_for_cart(cart_id)
     if not init_point:
-        await query.edit_message_text("Error al crear la preferencia de pago.")
+        await edit_view(query, "Error al crear la preferencia de pago.")
         return CART_MENU
     keyboard = [
         [InlineKeyboardButton("Pagar", url=init_point)],
-        [InlineKeyboardButton("Volver al menú del carrito", callback_data=f"cartmenu_{cart_id}")]
+        [InlineKeyboardButton("Volver al menú del carrito", callback_data=cb("cart_menu", cart_id))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     msg = (f"Para pagar el carrito '{cart_name}', haga clic en 'Pagar'.\n"
            "El mensaje de confirmación se enviará cuando se complete el pago.")
-    await query.edit_message_text(msg, reply_markup=reply_markup)
+    await edit_view(query, msg, reply_markup=reply_markup)
     return CART_MENU
 
 
@@ -1110,7 +4545,7 @@ def get_user_carts(telegram_id):
     try:
         conn = connect_db()
         cur = conn.cursor()
-        cur.execute("SELECT id, name, total FROM carts WHERE telegram_id = %s", (telegram_id,))
+        statements.execute(cur, "user_carts", (telegram_id,))
         rows = cur.fetchall()
         carts = []
         for row in rows:
@@ -1130,12 +4565,7 @@ def get_cart_details(cart_id):
     try:
         conn = connect_db()
         cur = conn.cursor()
-        cur.execute("""
-            SELECT p.id, p.name, ci.quantity, ci.subtotal
-            FROM cart_items ci
-            JOIN products p ON ci.product_id = p.id
-            WHERE ci.cart_id = %s
-        """, (cart_id,))
+        statements.execute(cur, "cart_details", (cart_id,))
         rows = cur.fetchall()
         items = []
         for row in rows:
@@ -1163,7 +4593,7 @@ def get_user_info(telegram_id):
     try:
         conn = connect_db()
         cur = conn.cursor()
-        cur.execute("SELECT name, address FROM users WHERE telegram_id = %s", (telegram_id,))
+        statements.execute(cur, "user_info", (telegram_id,))
         row = cur.fetchone()
         if row:
             return {'name': row[0], 'address': row[1]}
@@ -1201,9 +4631,12 @@ async def send_order_notifications(cart_id, confirmation_code, context, user_id)
         f"El pedido se llevará a la dirección proporcionada.\n\n"
         f"Escriba /start para abrir el menu principal"
     )
-    await context.bot.send_message(chat_id=user_id, text=message, parse_mode="HTML")
-    await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=message, parse_mode="HTML")
-    await context.bot.send_message(chat_id=PROVIDER_CHAT_ID, text=message, parse_mode="HTML")
+    await context.bot.send_message(chat_id=user_id, text=message, parse_mode="HTML",
+                                   rate_limit_args=PRIORITY_NOTIFICATION)
+    await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=message, parse_mode="HTML",
+                                   rate_limit_args=PRIORITY_NOTIFICATION)
+    await context.bot.send_message(chat_id=PROVIDER_CHAT_ID, text=message, parse_mode="HTML",
+                                   rate_limit_args=PRIORITY_NOTIFICATION)
 
 
 def add_product_to_cart(cart_id, product, quantity):
@@ -1225,7 +4658,7 @@ def add_product_to_cart(cart_id, product, quantity):
         conn = connect_db()
         cur = conn.cursor()
         # Obtener el total actual del carrito
-        cur.execute("SELECT total FROM carts WHERE id = %s", (cart_id,))
+        statements.execute(cur, "cart_total", (cart_id,))
         row = cur.fetchone()
         if row is None:
             raise Exception("Carrito no encontrado")
@@ -1240,6 +4673,7 @@ def add_product_to_cart(cart_id, product, quantity):
         # Actualizar el total del carrito
         cur.execute("UPDATE carts SET total = %s WHERE id = %s", (nuevo_total, cart_id))
         conn.commit()
+        keyboards.bump_on_commit("carts")
         return total_anterior, subtotal, nuevo_total
     except Exception as e:
         logger.error(f"Error al agregar producto al carrito: {e}")
@@ -1266,6 +4700,7 @@ def create_new_cart(telegram_id, cart_name):
         )
         cart_id = cur.fetchone()[0]
         conn.commit()
+        keyboards.bump_on_commit("carts")
         return cart_id
     except Exception as e:
         logger.error(f"Error al crear nuevo carrito: {e}")
@@ -1285,7 +4720,7 @@ def get_products():
     try:
         conn = connect_db()
         cur = conn.cursor()
-        cur.execute("SELECT id, name, price, sale_type FROM products")
+        statements.execute(cur, "products")
         products = cur.fetchall()
         product_list = []
         for row in products:
@@ -1310,7 +4745,7 @@ def get_product(product_id):
     try:
         conn = connect_db()
         cur = conn.cursor()
-        cur.execute("SELECT id, name, price, sale_type FROM products WHERE id = %s", (product_id,))
+        statements.execute(cur, "product", (product_id,))
         row = cur.fetchone()
         if row:
             return {'id': row[0], 'name': row[1], 'price': row[2], 'sale_type': row[3]}
@@ -1333,9 +4768,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         conn = connect_db()
         cur = conn.cursor()
-        cur.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
+        statements.execute(cur, "user_exists", (telegram_id,))
         user = cur.fetchone()
         logger.info("Resultado de consulta para usuario %s: %s", telegram_id, user)
+        if user:
+            # Si había bloqueado el bot, volvió: vuelve a recibir difusiones
+            statements.execute(cur, "user_unblock", (telegram_id,))
+            conn.commit()
     except Exception as e:
         logger.exception("Error al consultar la base de datos")
         await update.message.reply_text("Error al conectar a la base de datos.")
@@ -1354,20 +4793,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     # Si el usuario ya está registrado, envía el menú principal
     logger.info("Usuario registrado, enviando menú principal")
-    keyboard = [
-        [InlineKeyboardButton("Ordenar", callback_data="menu_ordenar")],
-        [InlineKeyboardButton("Historial", callback_data="menu_historial")],
-        [InlineKeyboardButton("Pedidos Pendientes", callback_data="menu_pedidos")],
-        [InlineKeyboardButton("Carritos", callback_data="menu_carritos")],
-        [InlineKeyboardButton("Cambiar Dirección", callback_data="menu_cambiar")],
-        [InlineKeyboardButton("Contacto", callback_data="menu_contacto")],
-        [InlineKeyboardButton("Ayuda", callback_data="menu_ayuda")]
-    ]
-    if telegram_id in allowed_ids:
-        keyboard.append([InlineKeyboardButton("Gestión de Pedidos y Equipos", callback_data="gestion_pedidos")])
-    if es_trabajador(telegram_id):
-        keyboard.append([InlineKeyboardButton("Gestión de Pedidos", callback_data="gestion_pedidos_personal")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = main_menu_markup(telegram_id)
     
     # Enviar un mensaje de prueba adicional para confirmar el envío
     try:
@@ -1414,96 +4840,55 @@ async def address_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if conn: release_db(conn)
 
     # Mostrar menú principal tras el registro
-    keyboard = [
-        [InlineKeyboardButton("Ordenar", callback_data="menu_ordenar")],
-        [InlineKeyboardButton("Historial", callback_data="menu_historial")],
-        [InlineKeyboardButton("Pedidos Pendientes", callback_data="menu_pedidos")],
-        [InlineKeyboardButton("Carritos", callback_data="menu_carritos")],
-        [InlineKeyboardButton("Cambiar Direccion", callback_data="menu_cambiar")],
-        [InlineKeyboardButton("Contacto", callback_data="menu_contacto")],
-        [InlineKeyboardButton("Ayuda", callback_data="menu_ayuda")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = main_menu_markup(telegram_id)
     await update.message.reply_text("Menú Principal:", reply_markup=reply_markup)
     return MAIN_MENU
 
 
 # Dentro de la función main_menu_handler, agrega las nuevas opciones.
-async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, option: str = "principal") -> int:
     query = update.callback_query
     await query.answer()
-    data = query.data
-    logger.info(f"main_menu_handler invoked with data: {data}")
+    logger.debug("main_menu_handler invoked with option: %s", option)
     user_id = query.from_user.id
 
-    if data == "menu_ordenar":
+    if option == "ordenar":
         context.user_data["origin"] = "ordenar"
-        products = get_products()
-        if not products:
-            await query.edit_message_text("No hay productos disponibles.")
+        remember_products_back(context, main_label="Volver")
+        reply_markup = products_markup(main_label="Volver")
+        if reply_markup is None:
+            await edit_view(query, "No hay productos disponibles.")
             return MAIN_MENU
-        keyboard = []
-        for product in products:
-            keyboard.append([InlineKeyboardButton(product['name'], callback_data=f"product_{product['id']}")])
-        keyboard.append([InlineKeyboardButton("Volver", callback_data="menu")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Seleccione un producto:", reply_markup=reply_markup)
+        await edit_view(query, "Seleccione un producto:", reply_markup=reply_markup)
         return ORDERING
 
-    elif data == "menu_historial":
+    elif option == "historial":
         return await show_history_handler(update, context)
 
-    elif data == "menu_pedidos":
+    elif option == "pedidos":
         return await pending_orders_handler(update, context)
 
-    elif data == "menu_carritos":
+    elif option == "carritos":
         context.user_data["origin"] = "carrito"
         return await show_carts_handler(update, context)
 
-    elif data == "menu_cambiar":
+    elif option == "cambiar":
         return await cambiar_direccion_handler(update, context)
 
-    elif data == "menu_contacto":
+    elif option == "contacto":
         return await contacto_handler(update, context)
 
-    elif data == "menu_ayuda":
+    elif option == "ayuda":
         return await ayuda_handler(update, context)
 
-    elif data == "gestion_pedidos":
-        return await gestion_pedidos_handler(update, context)
-
-    elif data == "gestion_pedidos_personal":
-        return await gestion_pedidos_personal_handler(update, context)
-
-    elif data in ["back_main", "menu"]:
-        keyboard = [
-            [InlineKeyboardButton("Ordenar", callback_data="menu_ordenar")],
-            [InlineKeyboardButton("Historial", callback_data="menu_historial")],
-            [InlineKeyboardButton("Pedidos Pendientes", callback_data="menu_pedidos")],
-            [InlineKeyboardButton("Carritos", callback_data="menu_carritos")],
-            [InlineKeyboardButton("Cambiar Dirección", callback_data="menu_cambiar")],
-            [InlineKeyboardButton("Contacto", callback_data="menu_contacto")],
-            [InlineKeyboardButton("Ayuda", callback_data="menu_ayuda")]
-        ]
-        if user_id in allowed_ids:
-            keyboard.append([InlineKeyboardButton("Gestión de Pedidos y Equipos", callback_data="gestion_pedidos")])
-        if es_trabajador(user_id):
-            keyboard.append([InlineKeyboardButton("Gestión de Pedidos", callback_data="gestion_pedidos_personal")])
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-        rand_val = random.randint(0, 9999)
-        new_text = f"Menú Principal: {now} - {rand_val}"
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        try:
-            await query.edit_message_text(new_text, reply_markup=reply_markup)
-        except BadRequest as e:
-            if "Message is not modified" in str(e):
-                logger.info("El mensaje ya tenía ese contenido. Se ignora el error.")
-            else:
-                raise e
+    elif option == "principal":
+        reply_markup = main_menu_markup(user_id)
+        # edit_view omite la edición si el mensaje ya muestra este mismo menú
+        await edit_view(query, "Menú Principal:", reply_markup=reply_markup)
         return MAIN_MENU
 
     else:
-        await query.edit_message_text("Opción no implementada aún.")
+        await edit_view(query, "Opción no implementada aún.")
         return MAIN_MENU
     
 async def cancelar_cambio_direccion_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1512,9 +4897,8 @@ async def cancelar_cambio_direccion_handler(update: Update, context: ContextType
     """
     query = update.callback_query
     await query.answer()
-    keyboard = [[InlineKeyboardButton("Aceptar", callback_data="back_main")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Cambio de dirección cancelado.", reply_markup=reply_markup)
+    reply_markup = ACEPTAR_MARKUP
+    await edit_view(query, "Cambio de dirección cancelado.", reply_markup=reply_markup)
     return MAIN_MENU
 
 
@@ -1525,7 +4909,7 @@ async def asignar_conjuntos_handler(update: Update, context: ContextTypes.DEFAUL
     await query.answer()
     conjuntos = get_all_conjuntos()  # Esta función obtiene la lista de conjuntos
     if not conjuntos:
-        await query.edit_message_text("No existen conjuntos creados.")
+        await edit_view(query, "No existen conjuntos creados.")
         return GESTION_PEDIDOS
 
     buttons = []
@@ -1536,11 +4920,11 @@ async def asignar_conjuntos_handler(update: Update, context: ContextTypes.DEFAUL
             if equipo_info:
                 equipo_text = f"Equipo {equipo_info['id']} ({equipo_info['trabajador1']} y {equipo_info['trabajador2']})"
         btn_text = f"Conjunto {c['numero']}: {c['pendientes']} pendientes, {equipo_text}"
-        buttons.append([InlineKeyboardButton(btn_text, callback_data=f"select_conjunto_{c['id']}")])
+        buttons.append([InlineKeyboardButton(btn_text, callback_data=cb("select_conjunto", c['id']))])
     reply_markup = InlineKeyboardMarkup(buttons)
-    await query.edit_message_text("Seleccione un conjunto para asignar:", reply_markup=reply_markup)
+    await edit_view(query, "Seleccione un conjunto para asignar:", reply_markup=reply_markup)
     
-    # Retornamos SELECCIONAR_EQUIPO para que el handler de "select_conjunto_\\d+" se active
+    # Retornamos SELECCIONAR_EQUIPO para que se enrute la acción "select_conjunto"
     return SELECCIONAR_EQUIPO
 
 
@@ -1548,7 +4932,7 @@ async def revocar_conjuntos_handler(update: Update, context: ContextTypes.DEFAUL
     query = update.callback_query
     await query.answer()
     try:
-        await query.edit_message_text("Funcionalidad de Revocar Conjuntos en construcción.")
+        await edit_view(query, "Funcionalidad de Revocar Conjuntos en construcción.")
     except Exception as e:
         if "Message is not modified" in str(e):
             pass
@@ -1560,7 +4944,7 @@ async def ver_equipos_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     try:
-        await query.edit_message_text("Funcionalidad de Ver Equipos en construcción.")
+        await edit_view(query, "Funcionalidad de Ver Equipos en construcción.")
     except Exception as e:
         if "Message is not modified" in str(e):
             pass
@@ -1572,7 +4956,7 @@ async def crear_nuevo_equipo_handler(update: Update, context: ContextTypes.DEFAU
     query = update.callback_query
     await query.answer()
     try:
-        await query.edit_message_text("Funcionalidad de Crear Nuevo Equipo en construcción.")
+        await edit_view(query, "Funcionalidad de Crear Nuevo Equipo en construcción.")
     except Exception as e:
         if "Message is not modified" in str(e):
             pass
@@ -1594,9 +4978,8 @@ async def contacto_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         "Dirección: Calle Falsa 123, Ciudad Ejemplo\n\n"
         "Para más información, visita nuestro sitio web: https://www.verduleriaonline.com"
     )
-    keyboard = [[InlineKeyboardButton("Volver al Menú Principal", callback_data="back_main")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text=mensaje, reply_markup=reply_markup, parse_mode="Markdown")
+    reply_markup = BACK_MAIN_MARKUP
+    await edit_view(query, text=mensaje, reply_markup=reply_markup, parse_mode="Markdown")
     return MAIN_MENU
 
 async def ayuda_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1615,25 +4998,15 @@ async def ayuda_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         "El boton Cambiar Direccion, le permitira actualizar la direccion asociada a su cuenta.\n\n"
         "El boton Contacto le mostrara una serie de datos de contacto de la verduleria.\n\n"
     )
-    keyboard = [[InlineKeyboardButton("Volver al Menú Principal", callback_data="back_main")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text=mensaje, reply_markup=reply_markup, parse_mode="Markdown")
+    reply_markup = BACK_MAIN_MARKUP
+    await edit_view(query, text=mensaje, reply_markup=reply_markup, parse_mode="Markdown")
     return MAIN_MENU
 
 
 async def gestion_pedidos_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    keyboard = [
-        [InlineKeyboardButton("Asignar Conjuntos", callback_data="asignar_conjuntos")],
-        [InlineKeyboardButton("Revocar Conjuntos", callback_data="revocar_conjuntos")],
-        [InlineKeyboardButton("Ver Equipos", callback_data="ver_equipos")],
-        [InlineKeyboardButton("Crear Nuevo Equipo", callback_data="crear_nuevo_equipo")],
-        [InlineKeyboardButton("Eliminar Equipos", callback_data="eliminar_equipos")],
-        [InlineKeyboardButton("Ver Conjuntos No Terminados", callback_data="ver_conjuntos_no_terminados")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Gestión de Pedidos y Equipos:", reply_markup=reply_markup)
+    await edit_view(query, "Gestión de Pedidos y Equipos:", reply_markup=GESTION_MENU_MARKUP)
     return GESTION_PEDIDOS
 
 #########################################
@@ -1645,13 +5018,12 @@ def get_all_conjuntos():
     Retorna una lista de conjuntos que NO están asignados a ningún equipo,
     cada uno con su id, número de conjunto, cantidad de pedidos pendientes y 'equipo_id' (que será None).
     """
-    conn = connect_db()
-    cur = conn.cursor()
-    # Filtramos los conjuntos que no tengan asignado un equipo (equipo_id IS NULL)
-    cur.execute("SELECT id, numero_conjunto FROM conjuntos WHERE equipo_id IS NULL")
-    conjuntos = cur.fetchall()
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        # Filtramos los conjuntos que no tengan asignado un equipo (equipo_id IS NULL)
+        cur.execute("SELECT id, numero_conjunto FROM conjuntos WHERE equipo_id IS NULL")
+        conjuntos = cur.fetchall()
+        cur.close()
     conjuntos_list = []
     for row in conjuntos:
         conjunto_id, numero_conjunto = row
@@ -1671,12 +5043,11 @@ def get_all_equipos():
     Retorna una lista de equipos con sus datos y la información de los integrantes
     (nombres en lugar de IDs) obtenida mediante get_equipo_info.
     """
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM equipos")
-    equipos = cur.fetchall()
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM equipos")
+        equipos = cur.fetchall()
+        cur.close()
     equipos_list = []
     for row in equipos:
         equipo_id = row[0]
@@ -1696,12 +5067,13 @@ def assign_conjunto_to_equipo(conjunto_id, equipo_id):
     """
     Asigna el conjunto al equipo actualizando la columna equipo_id en la tabla conjuntos.
     """
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE conjuntos SET equipo_id = %s WHERE id = %s", (equipo_id, conjunto_id))
-    conn.commit()
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE conjuntos SET equipo_id = %s WHERE id = %s", (equipo_id, conjunto_id))
+        conn.commit()
+        keyboards.bump_on_commit("conjuntos")
+        conjunto_documents.refresh_on_commit([conjunto_id])
+        cur.close()
     return True
 
 #########################################
@@ -1716,52 +5088,47 @@ async def asignar_conjuntos_handler(update: Update, context: ContextTypes.DEFAUL
     """
     query = update.callback_query
     await query.answer()
-    # Obtenemos todos los conjuntos
-    conjuntos = get_all_conjuntos()  # Asegúrate de que esta función devuelva registros
-    if not conjuntos:
-        await query.edit_message_text("No existen conjuntos creados.")
-        return GESTION_PEDIDOS
 
-    buttons = []
-    for c in conjuntos:
-        equipo_text = "Sin equipo asignado"
-        if c["equipo_id"] is not None:
-            equipo_info = get_equipo_info(c["equipo_id"])
-            if equipo_info:
-                equipo_text = f"Equipo {equipo_info['id']} ({equipo_info['trabajador1']} y {equipo_info['trabajador2']})"
-        btn_text = f"Conjunto {c['numero']}: {c['pendientes']} pendientes, {equipo_text}"
-        # El callback_data debe coincidir con el patrón "^select_conjunto_\d+$"
-        buttons.append([InlineKeyboardButton(btn_text, callback_data=f"select_conjunto_{c['id']}")])
-    reply_markup = InlineKeyboardMarkup(buttons)
-    await query.edit_message_text("Seleccione un conjunto para asignar:", reply_markup=reply_markup)
+    def build():
+        # Obtenemos todos los conjuntos
+        conjuntos = get_all_conjuntos()  # Asegúrate de que esta función devuelva registros
+        if not conjuntos:
+            return None
+        rows = []
+        for c in conjuntos:
+            equipo_text = "Sin equipo asignado"
+            if c["equipo_id"] is not None:
+                equipo_info = get_equipo_info(c["equipo_id"])
+                if equipo_info:
+                    equipo_text = f"Equipo {equipo_info['id']} ({equipo_info['trabajador1']} y {equipo_info['trabajador2']})"
+            btn_text = f"Conjunto {c['numero']}: {c['pendientes']} pendientes, {equipo_text}"
+            rows.append([(btn_text, cb("select_conjunto", c['id']))])
+        rows.append([("Selección múltiple", cb("multiselect"))])
+        return keyboard_markup(*rows)
+
+    reply_markup = keyboards.get("conjuntos", "asignar", build)
+    if reply_markup is None:
+        await edit_view(query, "No existen conjuntos creados.")
+        return GESTION_PEDIDOS
+    await edit_view(query, "Seleccione un conjunto para asignar:", reply_markup=reply_markup)
     # Retornamos el estado SELECCIONAR_EQUIPO para que se active el handler correspondiente
     return SELECCIONAR_EQUIPO
 
-async def select_conjunto_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def select_conjunto_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, conjunto_id: int) -> int:
     """
     Cuando se selecciona un conjunto, se verifica si ya tiene asignado un equipo y 
     se muestran los equipos disponibles (con los nombres de los integrantes) para asignarlo.
     """
     query = update.callback_query
     await query.answer()
-    try:
-        # Se espera que el callback_data tenga el formato "select_conjunto_{id}"
-        parts = query.data.split("_")
-        conjunto_id = int(parts[2])
-    except Exception as e:
-        logger.error(f"Error al procesar el conjunto seleccionado: {e}")
-        await query.edit_message_text("Error al procesar el conjunto seleccionado.")
-        return SELECCIONAR_EQUIPO
-
     # Consultamos el conjunto para ver si ya tiene asignado un equipo
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT equipo_id, numero_conjunto FROM conjuntos WHERE id = %s", (conjunto_id,))
-    row = cur.fetchone()
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT equipo_id, numero_conjunto FROM conjuntos WHERE id = %s", (conjunto_id,))
+        row = cur.fetchone()
+        cur.close()
     if not row:
-        await query.edit_message_text("Conjunto no encontrado.")
+        await edit_view(query, "Conjunto no encontrado.")
         return SELECCIONAR_EQUIPO
     equipo_id, num_conjunto = row
     if equipo_id:
@@ -1773,55 +5140,49 @@ async def select_conjunto_handler(update: Update, context: ContextTypes.DEFAULT_
     else:
         info = "sin equipo asignado"
 
-    await query.edit_message_text(
+    await edit_view(query, 
         f"Ha seleccionado el Conjunto {num_conjunto} ({info}).\n\nAhora, seleccione un equipo para asignarlo:"
     )
 
     # Mostramos la lista de equipos disponibles (se asume que get_all_equipos utiliza get_equipo_info)
-    equipos = get_all_equipos()  # Esta función debe devolver cada equipo con un campo "info" con los nombres.
-    if not equipos:
-        await query.edit_message_text("No existen equipos creados.")
+    def build():
+        equipos = get_all_equipos()  # Esta función debe devolver cada equipo con un campo "info" con los nombres.
+        if not equipos:
+            return None
+        rows = []
+        for equipo in equipos:
+            eq_info = equipo["info"]
+            # Mostramos solo los nombres de los integrantes, sin el ID
+            btn_text = f"{eq_info['trabajador1']} y {eq_info['trabajador2']} (Pendientes: {equipo['pendientes']})"
+            rows.append([(btn_text, cb("asignar", conjunto_id, equipo['id']))])
+        return keyboard_markup(*rows)
+
+    reply_markup = keyboards.get("conjuntos", ("equipos", conjunto_id), build)
+    if reply_markup is None:
+        await edit_view(query, "No existen equipos creados.")
         return SELECCIONAR_EQUIPO
-
-    equipo_buttons = []
-    for equipo in equipos:
-        eq_info = equipo["info"]
-        # Mostramos solo los nombres de los integrantes, sin el ID
-        btn_text = f"{eq_info['trabajador1']} y {eq_info['trabajador2']} (Pendientes: {equipo['pendientes']})"
-        # Se utiliza el id del equipo para el callback
-        equipo_buttons.append([InlineKeyboardButton(btn_text, callback_data=f"asignar_{conjunto_id}_equipo_{equipo['id']}")])
-    reply_markup = InlineKeyboardMarkup(equipo_buttons)
-    await query.edit_message_text("Seleccione el equipo al cual asignar el conjunto:", reply_markup=reply_markup)
+    await edit_view(query, "Seleccione el equipo al cual asignar el conjunto:", reply_markup=reply_markup)
     context.user_data['selected_conjunto_id'] = conjunto_id
     return SELECCIONAR_EQUIPO
 
 
 
-async def asignar_equipo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def asignar_equipo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, conjunto_id: int, equipo_id: int) -> int:
     """
     Una vez seleccionado un equipo, asigna el conjunto al equipo (actualizando la columna equipo_id en la tabla conjuntos)
     y notifica al usuario.
     """
     query = update.callback_query
     await query.answer()
-    logger.info(f"asignar_equipo_handler triggered with data: {query.data}")
-    try:
-        # Se espera el callback_data con formato "asignar_{conjunto_id}_equipo_{equipo_id}"
-        parts = query.data.split("_")
-        conjunto_id = int(parts[1])
-        equipo_id = int(parts[3])
-    except Exception as e:
-        logger.error(f"Error al procesar la selección del equipo: {e}")
-        await query.edit_message_text("Error al procesar la selección del equipo.")
-        return SELECCIONAR_EQUIPO
+    logger.info("asignar_equipo_handler triggered: conjunto %s, equipo %s", conjunto_id, equipo_id)
 
     # Asignamos el conjunto al equipo
     assign_conjunto_to_equipo(conjunto_id, equipo_id)
     equipo_info = get_equipo_info(equipo_id)
     if equipo_info:
-        await query.edit_message_text(f"Conjunto asignado exitosamente al Equipo {equipo_info['id']} ({equipo_info['trabajador1']} y {equipo_info['trabajador2']}).")
+        await edit_view(query, f"Conjunto asignado exitosamente al Equipo {equipo_info['id']} ({equipo_info['trabajador1']} y {equipo_info['trabajador2']}).")
     else:
-        await query.edit_message_text("Conjunto asignado, pero no se pudo obtener la información del equipo.")
+        await edit_view(query, "Conjunto asignado, pero no se pudo obtener la información del equipo.")
     return MAIN_MENU
     
 #########################################
@@ -1846,44 +5207,130 @@ async def asignar_equipo_handler(update: Update, context: ContextTypes.DEFAULT_T
 # Asegúrate de que estos estados (GESTION_PEDIDOS, ASIGNAR_CONJUNTOS, SELECCIONAR_EQUIPO, etc.) estén definidos y no colisionen con los existentes.
 
 
-async def product_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Manejador cuando se selecciona un producto o se pulsa 'Volver'."""
+async def product_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id: int) -> int:
+    """Manejador cuando se selecciona un producto ('Volver' se enruta a main_menu_handler)."""
+    query = update.callback_query
+    await query.answer()
+    product = get_product(product_id)
+    if not product:
+        await edit_view(query, "Producto no encontrado.")
+        return ORDERING
+    # Guardamos el producto seleccionado para usarlo en la siguiente etapa
+    context.user_data['selected_product'] = product
+    await edit_view(query, 
+        f"{product['name']}\n{product_price_text(product)}\n\n¿Cuánto desea agregar?"
+    )
+    return ASK_QUANTITY
+
+
+PRODUCT_INLINE_PAGE_SIZE = 50  # máximo de resultados por respuesta que acepta Telegram
+PRODUCT_INLINE_CACHE_TIME = int(os.getenv("PRODUCT_INLINE_CACHE_TIME", "300"))
+
+
+def remember_products_back(context, back_cart_id=None, main_label=PRODUCT_BACK_LABELS[0]):
+    """Guarda a dónde vuelve la lista de productos, para las búsquedas por texto."""
+    context.user_data["products_back"] = (back_cart_id, main_label)
+    context.user_data.pop("product_search", None)
+
+
+async def products_page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                page: int, cart_id: int, label: int, is_search: int) -> int:
+    """Cambia de página la lista de productos (o de resultados de búsqueda)."""
     query = update.callback_query
     await query.answer()
-    data = query.data
-    if data.startswith("product_"):
-        product_id = data.split("_")[1]
-        product = get_product(product_id)
+    main_label = PRODUCT_BACK_LABELS[label] if label < len(PRODUCT_BACK_LABELS) else PRODUCT_BACK_LABELS[0]
+    search = context.user_data.get("product_search") if is_search else None
+    if not is_search:
+        context.user_data.pop("product_search", None)
+    reply_markup = products_markup(cart_id or None, main_label, page=page, search=search)
+    if reply_markup is None:
+        await edit_view(query, "No hay productos disponibles.")
+        return ORDERING
+    text = f"Resultados para «{search}»:" if search else "Seleccione un producto:"
+    await edit_view(query, text, reply_markup=reply_markup)
+    return ORDERING
+
+
+async def reply_product_search(message, context, search) -> int:
+    """Responde a 'message' con los productos que coinciden con 'search'."""
+    back_cart_id, main_label = context.user_data.get("products_back", (None, PRODUCT_BACK_LABELS[0]))
+    reply_markup = products_markup(back_cart_id, main_label, search=search)
+    if reply_markup is None:
+        context.user_data.pop("product_search", None)
+        await message.reply_text(
+            f"No se encontraron productos para «{search}». Seleccione uno de la lista o escriba otra búsqueda:",
+            reply_markup=products_markup(back_cart_id, main_label)
+        )
+        return ORDERING
+    context.user_data["product_search"] = search
+    await message.reply_text(f"Resultados para «{search}»:", reply_markup=reply_markup)
+    return ORDERING
+
+
+async def product_search_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Texto escrito mientras se muestra la lista de productos: se busca por nombre."""
+    return await reply_product_search(update.message, context, update.message.text.strip())
+
+
+async def producto_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /producto <id>     elige el producto (es el mensaje que envía un resultado de inline mode)
+    /producto <texto>  muestra los productos que coinciden
+    """
+    telegram_id = update.effective_user.id
+    if not context.args:
+        await update.message.reply_text("Uso: /producto <nombre del producto>")
+        return None
+    with db_connection() as conn:
+        cur = conn.cursor()
+        statements.execute(cur, "user_exists", (telegram_id,))
+        registered = cur.fetchone() is not None
+        cur.close()
+    if not registered:
+        await update.message.reply_text("Primero debe registrarse: escriba /start.")
+        return None
+    text = " ".join(context.args)
+    if text.isdigit():
+        product = get_product(int(text))
         if not product:
-            await query.edit_message_text("Producto no encontrado.")
-            return ORDERING
-        # Guardamos el producto seleccionado para usarlo en la siguiente etapa
+            await update.message.reply_text("Producto no encontrado.")
+            return None
+        context.user_data["origin"] = "ordenar"
         context.user_data['selected_product'] = product
-        # Mostrar precio según tipo de venta
-        if product['sale_type'] == 'unidad':
-            price_text = f"Precio por unidad: {product['price']}"
-        else:
-            price_text = f"Precio por 100 gramos: {product['price']}"
-        await query.edit_message_text(
-            f"{product['name']}\n{price_text}\n\n¿Cuánto desea agregar?"
+        await update.message.reply_text(
+            f"{product['name']}\n{product_price_text(product)}\n\n¿Cuánto desea agregar?"
         )
         return ASK_QUANTITY
-    elif data == "menu":
-        # Construir el menú principal y regresar a él
-        keyboard = [
-            [InlineKeyboardButton("Ordenar", callback_data="menu_ordenar")],
-            [InlineKeyboardButton("Historial", callback_data="menu_historial")],
-            [InlineKeyboardButton("Pedidos Pendientes", callback_data="menu_pedidos")],
-            [InlineKeyboardButton("Carritos", callback_data="menu_carritos")],
-            [InlineKeyboardButton("Cambiar Direccion", callback_data="menu_cambiar")],
-            [InlineKeyboardButton("Contacto", callback_data="menu_contacto")],
-        [   InlineKeyboardButton("Ayuda", callback_data="menu_ayuda")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Menú Principal:", reply_markup=reply_markup)
-        return MAIN_MENU
-    else:
-        return MAIN_MENU
+    context.user_data["origin"] = "ordenar"
+    remember_products_back(context, main_label="Volver")
+    return await reply_product_search(update.message, context, text)
+
+
+def product_inline_results(index, search):
+    """Resultados de inline mode para 'search' (todos los productos si está vacío)."""
+    products = index.search(search) if normalize_text(search) else index.products
+    return [
+        InlineQueryResultArticle(
+            id=str(product['id']),
+            title=product['name'],
+            description=product_price_text(product),
+            input_message_content=InputTextMessageContent(f"/producto {product['id']}"),
+        )
+        for product in products
+    ]
+
+
+async def product_inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Inline mode (@bot limon): busca en el mismo índice que los teclados, con cache."""
+    inline_query = update.inline_query
+    search = inline_query.query or ""
+    results = product_catalog.cached(
+        ("inline", normalize_text(search)), lambda index: product_inline_results(index, search)
+    )
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    page = results[offset:offset + PRODUCT_INLINE_PAGE_SIZE]
+    next_offset = str(offset + PRODUCT_INLINE_PAGE_SIZE) if offset + PRODUCT_INLINE_PAGE_SIZE < len(results) else ""
+    await inline_query.answer(page, cache_time=PRODUCT_INLINE_CACHE_TIME, next_offset=next_offset)
 
 
 async def quantity_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1914,12 +5361,7 @@ async def quantity_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         if total_anterior is None:
             await update.message.reply_text("Error al agregar el producto al carrito.")
             return SELECT_CART
-        keyboard = [
-            [InlineKeyboardButton("Agregar más productos", callback_data="add_more")],
-            [InlineKeyboardButton("Pagar Carrito", callback_data="pay_cart")],
-            [InlineKeyboardButton("Volver al menú del carrito", callback_data=f"back_cart_{cart_id}")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = post_adhesion_markup(cart_id)
         msg = (f"Se agregó al carrito.\n"
                f"Total anterior: {total_anterior:.2f}\n"
                f"Subtotal: {sub:.2f}\n"
@@ -1933,13 +5375,14 @@ async def quantity_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         context.user_data.pop('selected_cart_id', None)
         # Mostrar la lista de carritos para elegir
         telegram_id = update.effective_user.id
-        carts = get_user_carts(telegram_id)
-        keyboard = []
-        for cart in carts:
-            keyboard.append([InlineKeyboardButton(cart['name'], callback_data=f"select_cart_{cart['id']}")])
-        keyboard.append([InlineKeyboardButton("Volver", callback_data="back_quantity")])
-        keyboard.append([InlineKeyboardButton("Nuevo Carrito", callback_data="new_cart")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+
+        def build():
+            rows = [[(cart['name'], cb("select_cart", cart['id']))] for cart in get_user_carts(telegram_id)]
+            rows.append([("Volver", cb("back_quantity"))])
+            rows.append([("Nuevo Carrito", cb("new_cart"))])
+            return keyboard_markup(*rows)
+
+        reply_markup = keyboards.get("carts", ("select", telegram_id), build)
         msg = (f"Subtotal para {product['name']} ({quantity} " +
                ("unidades" if product['sale_type']=='unidad' else "gramos") +
                f"): {subtotal:.2f}\nElige uno de tus carritos para agregar el producto:")
@@ -1947,19 +5390,6 @@ async def quantity_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return SELECT_CART
 
 
-async def back_cart_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Manejador para volver al menú del carrito desde la lista de productos."""
-    query = update.callback_query
-    await query.answer()
-    try:
-        # Se espera que la callback_data tenga el formato "back_cart_{cart_id}"
-        cart_id = int(query.data.split("_")[2])
-    except Exception as e:
-        await query.edit_message_text("Error al procesar el carrito.")
-        return CART_MENU
-    # Llama al menú del carrito usando la función ya definida
-    return await cart_menu_handler(update, context)
-
 def eliminar_equipo(equipo_id):
     """
     Función que elimina el equipo de la base de datos dado su ID.
@@ -1970,8 +5400,12 @@ def eliminar_equipo(equipo_id):
     try:
         conn = connect_db()
         cur = conn.cursor()
-        cur.execute("DELETE FROM equipos WHERE id = %s", (equipo_id,))
+        cur.execute("DELETE FROM equipos WHERE id = %s RETURNING trabajador1, trabajador2", (equipo_id,))
+        miembros = cur.fetchone()
         conn.commit()
+        keyboards.bump_on_commit("conjuntos")
+        if miembros:
+            forget_user_roles_on_commit(*miembros)
         return True
     except Exception as e:
         logger.error(f"Error al eliminar el equipo {equipo_id}: {e}")
@@ -2011,7 +5445,7 @@ async def eliminar_equipo_command_handler(update: Update, context: ContextTypes.
     elif update.callback_query:
         # Si se invoca desde un botón, lo ideal es mostrar las instrucciones o redirigir a la pantalla de eliminación.
         await update.callback_query.answer()
-        await update.callback_query.edit_message_text("Uso: /eliminar_equipo <equipo_id>\n\nPor favor, envía el comando con el ID del equipo que deseas eliminar.")
+        await edit_view(update.callback_query, "Uso: /eliminar_equipo <equipo_id>\n\nPor favor, envía el comando con el ID del equipo que deseas eliminar.")
         return ConversationHandler.END
 
     # Fallback
@@ -2024,12 +5458,11 @@ def get_conjuntos_no_terminados():
     Cada elemento es un diccionario con: id, numero y pendientes.
     """
     try:
-        conn = connect_db()
-        cur = conn.cursor()
-        cur.execute("SELECT id, numero_conjunto FROM conjuntos")
-        rows = cur.fetchall()
-        cur.close()
-        release_db(conn)
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT id, numero_conjunto FROM conjuntos")
+            rows = cur.fetchall()
+            cur.close()
         conjuntos = []
         for row in rows:
             conjunto_id, numero = row
@@ -2065,89 +5498,306 @@ async def crear_equipo_command_handler(update: Update, context: ContextTypes.DEF
         await update.message.reply_text("Error al crear el equipo.")
     return MAIN_MENU
 
-def asignar_conjunto_por_numero(numero_conjunto: int, equipo_id: int) -> bool:
+@admin_only
+async def asignar_conjunto_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
-    Asigna un conjunto (buscado por su número) al equipo especificado.
-    Se actualiza el campo equipo_id en el conjunto cuyo número coincide.
+    Comando para asignar uno o varios conjuntos a un equipo.
+    Uso: /asignar_conjunto <conjuntos> <id_equipo>
+    <conjuntos> puede ser un número (5), un rango (1-40), una lista (1,3,7-9)
+    o "sin_equipo" para todos los conjuntos que no tienen equipo.
     """
+    uso = "Uso: /asignar_conjunto <conjuntos> <id_equipo>\nEj.: /asignar_conjunto 1-40 2, /asignar_conjunto 1,3,7-9 2, /asignar_conjunto sin_equipo 2"
+    args = context.args
+    if len(args) < 2:
+        await update.message.reply_text(uso)
+        return MAIN_MENU
     try:
-        conn = connect_db()
-        cur = conn.cursor()
-        cur.execute("UPDATE conjuntos SET equipo_id = %s WHERE numero_conjunto = %s", (equipo_id, numero_conjunto))
-        conn.commit()
-        cur.close()
-        release_db(conn)
-        return True
+        equipo_id = int(args[-1])
+        seleccion = " ".join(args[:-1])
+        numeros = None if seleccion.lower() == "sin_equipo" else parse_numeros_conjunto(seleccion)
+    except ValueError:
+        await update.message.reply_text("Los valores deben ser números.\n" + uso)
+        return MAIN_MENU
+    if not equipo_exists(equipo_id):
+        await update.message.reply_text(f"No existe el Equipo {equipo_id}.")
+        return MAIN_MENU
+
+    try:
+        if numeros is None:
+            asignados = set_conjuntos_equipo(equipo_id, CONJUNTOS_SIN_EQUIPO)
+        else:
+            asignados = set_conjuntos_equipo(equipo_id, CONJUNTOS_POR_NUMERO, (numeros,))
     except Exception as e:
-        logger.error(f"Error al asignar conjunto: {e}")
-        if conn:
-            conn.rollback()
-        return False
+        logger.error(f"Error al asignar conjuntos: {e}")
+        await update.message.reply_text("Error al asignar el conjunto.")
+        return MAIN_MENU
+    await update.message.reply_text(f"Equipo {equipo_id}:\n" + bulk_summary("asignado", asignados, numeros))
+    return MAIN_MENU
 
 @admin_only
-async def asignar_conjunto_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def revocar_conjunto_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
-    Comando para asignar un conjunto a un equipo.
-    Uso: /asignar_conjunto <numero_conjunto> <id_equipo>
+    Comando para revocar (desasignar de su equipo) uno o varios conjuntos.
+    Uso: /revocar_conjunto <conjuntos>   (un número, un rango 1-40 o una lista 1,3,7-9)
+         /revocar_conjunto equipo <id_equipo>   (todos los conjuntos de ese equipo)
     """
+    uso = "Uso: /revocar_conjunto <conjuntos> o /revocar_conjunto equipo <id_equipo>"
+    args = context.args
+    if len(args) < 1:
+        await update.message.reply_text(uso)
+        return MAIN_MENU
     try:
-        args = context.args
-        if len(args) < 2:
-            await update.message.reply_text("Uso: /asignar_conjunto <numero_conjunto> <id_equipo>")
-            return MAIN_MENU
-        numero_conjunto = int(args[0])
-        equipo_id = int(args[1])
+        if args[0].lower() == "equipo":
+            if len(args) < 2:
+                await update.message.reply_text(uso)
+                return MAIN_MENU
+            equipo_id = int(args[1])
+            numeros = None
+        else:
+            numeros = parse_numeros_conjunto(" ".join(args))
     except ValueError:
-        await update.message.reply_text("Los valores deben ser números.")
+        await update.message.reply_text("El número del conjunto debe ser un número.\n" + uso)
         return MAIN_MENU
 
-    if asignar_conjunto_por_numero(numero_conjunto, equipo_id):
-        await update.message.reply_text(f"Conjunto {numero_conjunto} asignado al Equipo {equipo_id} exitosamente.")
-    else:
-        await update.message.reply_text("Error al asignar el conjunto.")
+    try:
+        if numeros is None:
+            revocados = set_conjuntos_equipo(None, CONJUNTOS_DE_EQUIPO, (equipo_id,))
+        else:
+            revocados = set_conjuntos_equipo(None, CONJUNTOS_POR_NUMERO, (numeros,))
+    except Exception as e:
+        logger.error(f"Error al revocar conjuntos: {e}")
+        await update.message.reply_text("Error al revocar el conjunto.")
+        return MAIN_MENU
+    await update.message.reply_text(bulk_summary("revocado", revocados, numeros))
     return MAIN_MENU
 
-def revocar_conjunto_por_numero(numero_conjunto: int) -> bool:
+#########################################
+# ASIGNACIÓN Y REVOCACIÓN MASIVA DE CONJUNTOS
+#########################################
+
+MAX_CONJUNTOS_SELECCION = 10000
+
+
+def parse_numeros_conjunto(text):
     """
-    Revoca (desasigna) un conjunto identificándolo por su número.
-    Es decir, se pone a NULL el campo equipo_id para el conjunto cuyo número coincide.
+    Interpreta una selección de números de conjunto: "5", "1-40", "1,3,7-9" (también
+    separados por espacios). Retorna la lista ordenada; ValueError si el formato es inválido.
     """
-    try:
-        conn = connect_db()
+    numeros = set()
+    for token in re.split(r"[\s,;]+", text.strip()):
+        if not token:
+            continue
+        desde, sep, hasta = token.partition("-")
+        desde = int(desde)
+        hasta = int(hasta) if sep else desde
+        if desde > hasta:
+            desde, hasta = hasta, desde
+        if len(numeros) + hasta - desde + 1 > MAX_CONJUNTOS_SELECCION:
+            raise ValueError("Selección demasiado grande")
+        numeros.update(range(desde, hasta + 1))
+    if not numeros:
+        raise ValueError("Selección vacía")
+    return sorted(numeros)
+
+
+def format_numeros(numeros):
+    """[1, 2, 3, 5, 7, 8] -> "1-3, 5, 7-8"."""
+    partes = []
+    numeros = sorted(set(numeros))
+    i = 0
+    while i < len(numeros):
+        j = i
+        while j + 1 < len(numeros) and numeros[j + 1] == numeros[j] + 1:
+            j += 1
+        partes.append(str(numeros[i]) if i == j else f"{numeros[i]}-{numeros[j]}")
+        i = j + 1
+    return ", ".join(partes)
+
+
+# Condiciones posibles para set_conjuntos_equipo (textos fijos; los valores van como parámetros)
+CONJUNTOS_POR_NUMERO = "numero_conjunto = ANY(%s)"
+CONJUNTOS_POR_ID = "id = ANY(%s)"
+CONJUNTOS_SIN_EQUIPO = "equipo_id IS NULL"
+CONJUNTOS_DE_EQUIPO = "equipo_id = %s"
+
+
+def set_conjuntos_equipo(equipo_id, condition, params=()):
+    """
+    Asigna (o revoca, con equipo_id=None) todos los conjuntos que cumplen 'condition' con
+    un solo UPDATE ... RETURNING. Avisa a los trabajadores de los equipos afectados.
+    Retorna la lista de números de conjunto que cambiaron.
+    """
+    with unit_of_work():
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "UPDATE conjuntos c SET equipo_id = %s "
+                f"FROM (SELECT id, equipo_id FROM conjuntos WHERE {condition} FOR UPDATE) prev "
+                "WHERE c.id = prev.id AND c.equipo_id IS DISTINCT FROM %s "
+                "RETURNING c.numero_conjunto, prev.equipo_id, c.id",
+                (equipo_id, *params, equipo_id)
+            )
+            rows = cur.fetchall()
+            conn.commit()
+            cur.close()
+        if rows:
+            keyboards.bump_on_commit("conjuntos")
+            if equipo_id is not None:
+                conjunto_documents.refresh_on_commit([row[2] for row in rows])
+            changes = []
+            for numero, anterior, _ in rows:
+                if anterior is not None:
+                    changes.append((anterior, f"El conjunto {numero} ya no está asignado a su equipo."))
+                if equipo_id is not None:
+                    changes.append((equipo_id, f"Se asignó el conjunto {numero} a su equipo."))
+            notify_equipos_on_commit(changes)
+    return sorted(numero for numero, _, _ in rows)
+
+
+def equipo_exists(equipo_id):
+    with db_connection() as conn:
         cur = conn.cursor()
-        cur.execute("UPDATE conjuntos SET equipo_id = NULL WHERE numero_conjunto = %s", (numero_conjunto,))
-        conn.commit()
+        cur.execute("SELECT 1 FROM equipos WHERE id = %s", (equipo_id,))
+        row = cur.fetchone()
         cur.close()
-        release_db(conn)
-        return True
-    except Exception as e:
-        logger.error(f"Error al revocar conjunto: {e}")
-        if conn:
-            conn.rollback()
-        return False
+    return row is not None
+
+
+def bulk_summary(accion, cambiados, pedidos=None):
+    """Resumen de una operación masiva; 'pedidos' son los números solicitados (si los hubo)."""
+    if not cambiados:
+        text = f"Ningún conjunto fue {accion}."
+    else:
+        text = f"Conjuntos {accion}s ({len(cambiados)}): {format_numeros(cambiados)}"
+    if pedidos:
+        sin_cambios = sorted(set(pedidos) - set(cambiados))
+        if sin_cambios:
+            text += f"\nSin cambios o inexistentes ({len(sin_cambios)}): {format_numeros(sin_cambios)}"
+    if len(text) > 4000:
+        text = text[:4000] + "..."
+    return text
+
 
 @admin_only
-async def revocar_conjunto_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def mover_conjuntos_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
-    Comando para revocar un conjunto (desasignarlo de un equipo) por su número.
-    Uso: /revocar_conjunto <numero_conjunto>
+    Mueve todos los conjuntos de un equipo a otro.
+    Uso: /mover_conjuntos <id_equipo_origen> <id_equipo_destino>
     """
     try:
         args = context.args
-        if len(args) < 1:
-            await update.message.reply_text("Uso: /revocar_conjunto <numero_conjunto>")
+        if len(args) < 2:
+            await update.message.reply_text("Uso: /mover_conjuntos <id_equipo_origen> <id_equipo_destino>")
             return MAIN_MENU
-        numero_conjunto = int(args[0])
+        origen = int(args[0])
+        destino = int(args[1])
     except ValueError:
-        await update.message.reply_text("El número del conjunto debe ser un número.")
+        await update.message.reply_text("Los IDs de equipo deben ser números.")
         return MAIN_MENU
-
-    if revocar_conjunto_por_numero(numero_conjunto):
-        await update.message.reply_text(f"Conjunto {numero_conjunto} revocado exitosamente.")
-    else:
-        await update.message.reply_text("Error al revocar el conjunto.")
+    if not equipo_exists(destino):
+        await update.message.reply_text(f"No existe el Equipo {destino}.")
+        return MAIN_MENU
+    try:
+        movidos = set_conjuntos_equipo(destino, CONJUNTOS_DE_EQUIPO, (origen,))
+    except Exception as e:
+        logger.error(f"Error al mover conjuntos: {e}")
+        await update.message.reply_text("Error al mover los conjuntos.")
+        return MAIN_MENU
+    await update.message.reply_text(f"Del Equipo {origen} al Equipo {destino}:\n" + bulk_summary("movido", movidos))
     return MAIN_MENU
 
+
+def get_conjuntos_para_seleccion():
+    """Conjuntos sin equipo para el teclado de selección múltiple (cacheados por versión)."""
+    return keyboards.get("conjuntos", "seleccion", get_all_conjuntos)
+
+
+def multiselect_markup(seleccionados):
+    rows = []
+    for c in get_conjuntos_para_seleccion():
+        marca = "☑" if c["id"] in seleccionados else "☐"
+        rows.append([(f"{marca} Conjunto {c['numero']}: {c['pendientes']} pendientes", cb("toggle_conjunto", c["id"]))])
+    rows.append([(f"Asignar seleccionados ({len(seleccionados)})", cb("assign_selected"))])
+    rows.append([("Volver", cb("asignar_conjuntos"))])
+    return keyboard_markup(*rows)
+
+
+async def multiselect_conjuntos_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Muestra los conjuntos con casillas para elegir varios y asignarlos juntos."""
+    query = update.callback_query
+    await query.answer()
+    context.user_data["conjuntos_seleccionados"] = []
+    if not get_conjuntos_para_seleccion():
+        await edit_view(query, "No existen conjuntos creados.")
+        return GESTION_PEDIDOS
+    await edit_view(query, "Marque los conjuntos a asignar:", reply_markup=multiselect_markup(set()))
+    return SELECCIONAR_EQUIPO
+
+
+async def toggle_conjunto_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, conjunto_id: int) -> int:
+    query = update.callback_query
+    await query.answer()
+    seleccionados = set(context.user_data.get("conjuntos_seleccionados", []))
+    seleccionados ^= {conjunto_id}
+    context.user_data["conjuntos_seleccionados"] = sorted(seleccionados)
+    await edit_view(query, "Marque los conjuntos a asignar:", reply_markup=multiselect_markup(seleccionados))
+    return SELECCIONAR_EQUIPO
+
+
+async def assign_selected_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Pide el equipo al que se asignan los conjuntos marcados."""
+    query = update.callback_query
+    seleccionados = context.user_data.get("conjuntos_seleccionados", [])
+    if not seleccionados:
+        await query.answer("No hay conjuntos seleccionados.", show_alert=True)
+        return SELECCIONAR_EQUIPO
+    await query.answer()
+
+    def build():
+        equipos = get_all_equipos()
+        if not equipos:
+            return None
+        rows = [[(f"{e['info']['trabajador1']} y {e['info']['trabajador2']}", cb("asignar_seleccion", e['id']))]
+                for e in equipos]
+        rows.append([("Volver", cb("multiselect"))])
+        return keyboard_markup(*rows)
+
+    reply_markup = keyboards.get("conjuntos", "equipos_seleccion", build)
+    if reply_markup is None:
+        await edit_view(query, "No existen equipos creados.")
+        return SELECCIONAR_EQUIPO
+    await edit_view(query, f"Seleccione el equipo para los {len(seleccionados)} conjuntos marcados:", reply_markup=reply_markup)
+    return SELECCIONAR_EQUIPO
+
+
+async def asignar_seleccion_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, equipo_id: int) -> int:
+    query = update.callback_query
+    await query.answer()
+    seleccionados = context.user_data.pop("conjuntos_seleccionados", [])
+    try:
+        asignados = set_conjuntos_equipo(equipo_id, CONJUNTOS_POR_ID, (seleccionados,))
+    except Exception as e:
+        logger.error(f"Error al asignar conjuntos seleccionados: {e}")
+        await edit_view(query, "Error al asignar los conjuntos.")
+        return MAIN_MENU
+    await edit_view(query, f"Equipo {equipo_id}:\n" + bulk_summary("asignado", asignados), reply_markup=BACK_GESTION_MARKUP)
+    return GESTION_PEDIDOS
+
+
+async def revocar_equipo_todos_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, equipo_id: int) -> int:
+    """Revoca de una vez todos los conjuntos de un equipo."""
+    query = update.callback_query
+    await query.answer()
+    try:
+        revocados = set_conjuntos_equipo(None, CONJUNTOS_DE_EQUIPO, (equipo_id,))
+    except Exception as e:
+        logger.error(f"Error al revocar conjuntos del equipo: {e}")
+        await edit_view(query, "Error al desasignar los conjuntos.")
+        return REVOCAR_CONJUNTOS
+    await edit_view(query, f"Equipo {equipo_id}:\n" + bulk_summary("revocado", revocados), reply_markup=BACK_GESTION_MARKUP)
+    return GESTION_PEDIDOS
+
+
 @admin_only
 async def ver_conjuntos_no_terminados_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
@@ -2156,79 +5806,66 @@ async def ver_conjuntos_no_terminados_handler(update: Update, context: ContextTy
     """
     query = update.callback_query
     await query.answer()
-    conjuntos = get_conjuntos_no_terminados()
-    if not conjuntos:
-        await query.edit_message_text("No hay conjuntos no terminados.")
+
+    def build():
+        conjuntos = get_conjuntos_no_terminados()
+        if not conjuntos:
+            return None
+        return keyboard_markup(*[[(f"Conjunto {c['numero']} - {c['pendientes']} pendientes", cb("descargar_conjunto", c['id']))]
+                                 for c in conjuntos])
+
+    reply_markup = keyboards.get("conjuntos", "no_terminados", build)
+    if reply_markup is None:
+        await edit_view(query, "No hay conjuntos no terminados.")
         return GESTION_PEDIDOS
-    buttons = []
-    for c in conjuntos:
-        btn_text = f"Conjunto {c['numero']} - {c['pendientes']} pendientes"
-        buttons.append([InlineKeyboardButton(btn_text, callback_data=f"descargar_conjunto_{c['id']}")])
-    reply_markup = InlineKeyboardMarkup(buttons)
-    await query.edit_message_text("Seleccione un conjunto no terminado para descargar su PDF:", reply_markup=reply_markup)
-    # Retornamos el estado VER_EQUIPOS para que el handler 'descargar_conjunto_handler'
-    # (registrado para pattern "^descargar_conjunto_\\d+$") se active.
+    await edit_view(query, "Seleccione un conjunto no terminado para descargar su PDF:", reply_markup=reply_markup)
+    # Retornamos el estado VER_EQUIPOS, donde se enruta la acción "descargar_conjunto".
     return VER_EQUIPOS
 
 
-async def cart_selection_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Manejador para la selección de un carrito o acción relacionada."""
+async def cart_selection_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, cart_id: int) -> int:
+    """Agrega el producto y la cantidad elegidos al carrito seleccionado."""
     query = update.callback_query
     await query.answer()
-    data = query.data
-    if data.startswith("select_cart_"):
-        cart_id = int(data.split("_")[-1])
-        product = context.user_data.get('selected_product')
-        quantity = context.user_data.get('quantity')
-        if not product or quantity is None:
-            await query.edit_message_text("Error: Falta información del producto o cantidad.")
-            return ASK_QUANTITY
-        # Agregar el producto al carrito seleccionado
-        total_anterior, subtotal, nuevo_total = add_product_to_cart(cart_id, product, quantity)
-        if total_anterior is None:
-            await query.edit_message_text("Error al agregar el producto al carrito.")
-            return SELECT_CART
-        # Guardar el carrito seleccionado para usarlo en el pago
-        context.user_data['selected_cart_id'] = cart_id
-        # Configurar el botón "Volver":
-        # Si el proceso se inició desde un carrito específico (origin == "carrito"), se muestra "Volver al menú del carrito".
-        # De lo contrario, se muestra "Volver al Menú Principal".
-        if context.user_data.get("origin") == "carrito":
-            back_button = InlineKeyboardButton("Volver al menú del carrito", callback_data=f"back_cart_{cart_id}")
-        else:
-            back_button = InlineKeyboardButton("Volver al Menú Principal", callback_data="back_main")
-        keyboard = [
-            [InlineKeyboardButton("Agregar más Productos", callback_data="add_more")],
-            [InlineKeyboardButton("Pagar Carrito", callback_data="pay_cart")],
-            [back_button]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        msg = (f"Se agregó al carrito.\n"
-               f"Total anterior: {total_anterior:.2f}\n"
-               f"Subtotal de la adhesión: {subtotal:.2f}\n"
-               f"Nuevo total: {nuevo_total:.2f}\n\n"
-               f"¿Qué desea hacer a continuación?\n\n"
-               f"Tenga en cuenta que si realiza el pago fuera del horario de atencion, el mismo se entregar durante la siguiente jornada laboral")
-        await query.edit_message_text(msg, reply_markup=reply_markup)
-        return POST_ADHESION
-    elif data == "back_quantity":
-        # Volver a la pantalla para ingresar la cantidad
-        product = context.user_data.get('selected_product')
-        if not product:
-            await query.edit_message_text("Error: Producto no seleccionado.")
-            return ORDERING
-        await query.edit_message_text(
-            f"{product['name']}\n"
-            f"{'Precio por unidad: ' + str(product['price']) if product['sale_type'] == 'unidad' else 'Precio por 100 gramos: ' + str(product['price'])}\n\n"
-            "¿Cuánto desea agregar?"
-        )
+    product = context.user_data.get('selected_product')
+    quantity = context.user_data.get('quantity')
+    if not product or quantity is None:
+        await edit_view(query, "Error: Falta información del producto o cantidad.")
         return ASK_QUANTITY
-    elif data == "new_cart":
-        # Solicitar el nombre del nuevo carrito
-        await query.edit_message_text("Ingrese el nombre del nuevo carrito:")
-        return NEW_CART
-    else:
+    # Agregar el producto al carrito seleccionado
+    total_anterior, subtotal, nuevo_total = add_product_to_cart(cart_id, product, quantity)
+    if total_anterior is None:
+        await edit_view(query, "Error al agregar el producto al carrito.")
         return SELECT_CART
+    # Guardar el carrito seleccionado para usarlo en el pago
+    context.user_data['selected_cart_id'] = cart_id
+    # Configurar el botón "Volver":
+    # Si el proceso se inició desde un carrito específico (origin == "carrito"), se muestra "Volver al menú del carrito".
+    # De lo contrario, se muestra "Volver al Menú Principal".
+    reply_markup = post_adhesion_markup(cart_id if context.user_data.get("origin") == "carrito" else None)
+    msg = (f"Se agregó al carrito.\n"
+           f"Total anterior: {total_anterior:.2f}\n"
+           f"Subtotal de la adhesión: {subtotal:.2f}\n"
+           f"Nuevo total: {nuevo_total:.2f}\n\n"
+           f"¿Qué desea hacer a continuación?\n\n"
+           f"Tenga en cuenta que si realiza el pago fuera del horario de atencion, el mismo se entregar durante la siguiente jornada laboral")
+    await edit_view(query, msg, reply_markup=reply_markup)
+    return POST_ADHESION
+
+async def back_quantity_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Vuelve a la pantalla para ingresar la cantidad del producto seleccionado."""
+    query = update.callback_query
+    await query.answer()
+    product = context.user_data.get('selected_product')
+    if not product:
+        await edit_view(query, "Error: Producto no seleccionado.")
+        return ORDERING
+    await edit_view(query, 
+        f"{product['name']}\n"
+        f"{'Precio por unidad: ' + str(product['price']) if product['sale_type'] == 'unidad' else 'Precio por 100 gramos: ' + str(product['price'])}\n\n"
+        "¿Cuánto desea agregar?"
+    )
+    return ASK_QUANTITY
 
 def get_equipo_info(equipo_id):
     """
@@ -2236,22 +5873,20 @@ def get_equipo_info(equipo_id):
     consultando la tabla "trabajadores" usando el telegram_id de cada integrante.
     Si no se encuentra la información, devuelve "N/D".
     """
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT trabajador1, trabajador2 FROM equipos WHERE id = %s", (equipo_id,))
-    row = cur.fetchone()
-    if not row:
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT trabajador1, trabajador2 FROM equipos WHERE id = %s", (equipo_id,))
+        row = cur.fetchone()
+        if not row:
+            cur.close()
+            return None
+        t1, t2 = row
+        # Obtener nombres de los trabajadores
+        statements.execute(cur, "nombre_trabajador", (t1,))
+        nombre1 = cur.fetchone()
+        statements.execute(cur, "nombre_trabajador", (t2,))
+        nombre2 = cur.fetchone()
         cur.close()
-        release_db(conn)
-        return None
-    t1, t2 = row
-    # Obtener nombres de los trabajadores
-    cur.execute("SELECT nombre FROM trabajadores WHERE telegram_id = %s", (t1,))
-    nombre1 = cur.fetchone()
-    cur.execute("SELECT nombre FROM trabajadores WHERE telegram_id = %s", (t2,))
-    nombre2 = cur.fetchone()
-    cur.close()
-    release_db(conn)
     return {
         "trabajador1": nombre1[0] if nombre1 else "N/D",
         "trabajador2": nombre2[0] if nombre2 else "N/D"
@@ -2261,12 +5896,11 @@ def get_equipo_info(equipo_id):
 
 # Función auxiliar para obtener los conjuntos asignados a un equipo
 def get_conjuntos_by_equipo(equipo_id):
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id, numero_conjunto FROM conjuntos WHERE equipo_id = %s", (equipo_id,))
-    rows = cur.fetchall()
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        statements.execute(cur, "conjuntos_por_equipo", (equipo_id,))
+        rows = cur.fetchall()
+        cur.close()
     conjuntos = []
     for row in rows:
         conjunto_id, numero_conjunto = row
@@ -2282,12 +5916,11 @@ def get_conjuntos_by_equipo(equipo_id):
 
 # Función auxiliar para obtener todos los equipos que tienen al menos un conjunto asignado
 def get_all_equipos_revocar():
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id, trabajador1, trabajador2 FROM equipos")
-    equipos = cur.fetchall()
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, trabajador1, trabajador2 FROM equipos")
+        equipos = cur.fetchall()
+        cur.close()
     equipos_list = []
     for row in equipos:
         equipo_id, t1, t2 = row
@@ -2301,168 +5934,130 @@ def get_all_equipos_revocar():
             })
     return equipos_list
 
-def get_next_available_conjunto_number():
-    """
-    Retorna el menor número entero positivo que NO está siendo usado en la tabla 'conjuntos'.
-    Esto permite reutilizar números liberados cuando se elimina un conjunto.
-    """
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT numero_conjunto FROM conjuntos ORDER BY numero_conjunto")
-    rows = cur.fetchall()
-    cur.close()
-    release_db(conn)
-    used_numbers = {row[0] for row in rows}
-    n = 1
-    while n in used_numbers:
-        n += 1
-    return n
-
 # Handler inicial para revocar conjuntos: muestra, para cada equipo, un mensaje con sus conjuntos asignados.
 async def revocar_conjuntos_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    equipos = get_all_equipos_revocar()
-    if not equipos:
-        await query.edit_message_text("No existen equipos con conjuntos asignados.")
+
+    def build():
+        equipos = get_all_equipos_revocar()
+        if not equipos:
+            return None
+        message = "Equipos con conjuntos asignados:\n\n"
+        rows = []
+        for equipo in equipos:
+            # Obtenemos la información del equipo (por ejemplo, usando la función get_equipo_info ya existente)
+            equipo_info = get_equipo_info(equipo["id"])
+            equipo_text = f"Equipo {equipo_info['id']} ({equipo_info['trabajador1']} y {equipo_info['trabajador2']})"
+            conjunto_texts = []
+            for c in equipo["conjuntos"]:
+                conjunto_texts.append(f"Conjunto {c['numero']} ({c['pendientes']} pendientes)")
+            conjuntos_str = ", ".join(conjunto_texts)
+            message += f"{equipo_text}: {conjuntos_str}\n"
+            # Botón para seleccionar este equipo
+            rows.append([(equipo_text, cb("revocar_equipo", equipo_info['id']))])
+        return message, keyboard_markup(*rows)
+
+    view = keyboards.get("conjuntos", "revocar", build)
+    if view is None:
+        await edit_view(query, "No existen equipos con conjuntos asignados.")
         return GESTION_PEDIDOS
-    message = "Equipos con conjuntos asignados:\n\n"
-    buttons = []
-    for equipo in equipos:
-        # Obtenemos la información del equipo (por ejemplo, usando la función get_equipo_info ya existente)
-        equipo_info = get_equipo_info(equipo["id"])
-        equipo_text = f"Equipo {equipo_info['id']} ({equipo_info['trabajador1']} y {equipo_info['trabajador2']})"
-        conjunto_texts = []
-        for c in equipo["conjuntos"]:
-            conjunto_texts.append(f"Conjunto {c['numero']} ({c['pendientes']} pendientes)")
-        conjuntos_str = ", ".join(conjunto_texts)
-        message += f"{equipo_text}: {conjuntos_str}\n"
-        # Botón para seleccionar este equipo (callback: "revocar_equipo_<equipo_id>")
-        buttons.append([InlineKeyboardButton(equipo_text, callback_data=f"revocar_equipo_{equipo_info['id']}")])
-    reply_markup = InlineKeyboardMarkup(buttons)
-    await query.edit_message_text(message, reply_markup=reply_markup)
+    message, reply_markup = view
+    await edit_view(query, message, reply_markup=reply_markup)
     return REVOCAR_CONJUNTOS
 
-# Handler que se activa al pulsar un botón "revocar_equipo_<equipo_id>" y muestra los conjuntos asignados a ese equipo.
-async def select_equipo_revocar_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+# Handler de la acción "revocar_equipo": muestra los conjuntos asignados a ese equipo.
+async def select_equipo_revocar_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, equipo_id: int) -> int:
     query = update.callback_query
     await query.answer()
-    try:
-        equipo_id = int(query.data.split("_")[2])
-    except Exception as e:
-        await query.edit_message_text("Error al procesar el equipo seleccionado.")
-        return REVOCAR_CONJUNTOS
     conjuntos = get_conjuntos_by_equipo(equipo_id)
     if not conjuntos:
-        await query.edit_message_text("El equipo seleccionado no tiene conjuntos asignados.")
+        await edit_view(query, "El equipo seleccionado no tiene conjuntos asignados.")
         return REVOCAR_CONJUNTOS
     message = f"Conjuntos asignados al equipo {equipo_id}:\n\n"
     buttons = []
     for c in conjuntos:
         btn_text = f"Conjunto {c['numero']} ({c['pendientes']} pendientes)"
         message += f"{btn_text}\n"
-        # Botón para revocar este conjunto (callback: "revocar_conjunto_<conjunto_id>")
-        buttons.append([InlineKeyboardButton(btn_text, callback_data=f"revocar_conjunto_{c['id']}")])
+        # Botón para revocar este conjunto
+        buttons.append([InlineKeyboardButton(btn_text, callback_data=cb("revocar_conjunto", c['id']))])
+    buttons.append([InlineKeyboardButton("Revocar todos", callback_data=cb("revocar_equipo_todos", equipo_id))])
     reply_markup = InlineKeyboardMarkup(buttons)
-    await query.edit_message_text(message, reply_markup=reply_markup)
+    await edit_view(query, message, reply_markup=reply_markup)
     return REVOCAR_CONJUNTOS
 
 # Handler que desasigna (revoca) un conjunto de un equipo.
-async def revocar_conjunto_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def revocar_conjunto_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, conjunto_id: int) -> int:
     query = update.callback_query
     await query.answer()
     try:
-        conjunto_id = int(query.data.split("_")[2])
-    except Exception as e:
-        await query.edit_message_text("Error al procesar el conjunto seleccionado.")
-        return REVOCAR_CONJUNTOS
-    try:
-        conn = connect_db()
-        cur = conn.cursor()
-        cur.execute("UPDATE conjuntos SET equipo_id = NULL WHERE id = %s", (conjunto_id,))
-        conn.commit()
-        cur.close()
-        release_db(conn)
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("UPDATE conjuntos SET equipo_id = NULL WHERE id = %s", (conjunto_id,))
+            conn.commit()
+            keyboards.bump_on_commit("conjuntos")
+            cur.close()
     except Exception as e:
         logger.error(f"Error al desasignar el conjunto: {e}")
-        await query.edit_message_text("Error al desasignar el conjunto.")
+        await edit_view(query, "Error al desasignar el conjunto.")
         return REVOCAR_CONJUNTOS
-    await query.edit_message_text(f"Conjunto {conjunto_id} ha sido desasignado exitosamente.")
+    await edit_view(query, f"Conjunto {conjunto_id} ha sido desasignado exitosamente.")
     return MAIN_MENU
 
-async def post_adhesion_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def post_adhesion_add_more_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Muestra la lista de productos para seguir agregando al carrito."""
     query = update.callback_query
     await query.answer()
-    data = query.data
-    if data == "add_more":
-        products = get_products()
-        if not products:
-            await query.edit_message_text("No hay productos disponibles.")
-            return MAIN_MENU
-        keyboard = []
-        for product in products:
-            keyboard.append([InlineKeyboardButton(product['name'], callback_data=f"product_{product['id']}")])
-        # Según el origen, configurar el botón de "Volver"
-        if context.user_data.get("origin") == "carrito" and 'selected_cart_id' in context.user_data:
-            cart_id = context.user_data['selected_cart_id']
-            keyboard.append([InlineKeyboardButton("Volver al menú del carrito", callback_data=f"back_cart_{cart_id}")])
-        else:
-            keyboard.append([InlineKeyboardButton("Volver al Menú Principal", callback_data="back_main")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Seleccione un producto:", reply_markup=reply_markup)
-        return ORDERING
-    elif data == "pay_cart":
-        cart_id = context.user_data.get('selected_cart_id')
-        if not cart_id:
-            await query.edit_message_text("Error: Carrito no seleccionado.")
-            return POST_ADHESION
+    # Según el origen, configurar el botón de "Volver"
+    if context.user_data.get("origin") == "carrito" and 'selected_cart_id' in context.user_data:
+        remember_products_back(context, back_cart_id=context.user_data['selected_cart_id'])
+        reply_markup = products_markup(back_cart_id=context.user_data['selected_cart_id'])
+    else:
+        remember_products_back(context)
+        reply_markup = products_markup()
+    if reply_markup is None:
+        await edit_view(query, "No hay productos disponibles.")
+        return MAIN_MENU
+    await edit_view(query, "Seleccione un producto:", reply_markup=reply_markup)
+    return ORDERING
+
+async def post_adhesion_pay_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Crea la preferencia de pago del carrito seleccionado y muestra el botón para pagar."""
+    query = update.callback_query
+    await query.answer()
+    cart_id = context.user_data.get('selected_cart_id')
+    if not cart_id:
+        await edit_view(query, "Error: Carrito no seleccionado.")
+        return POST_ADHESION
+    try:
         cart_name, init_point = create_payment_preference_for_cart(cart_id)
-        if not init_point:
-            await query.edit_message_text("Error al crear la preferencia de pago.")
-            return POST_ADHESION
-        keyboard = [
-            [InlineKeyboardButton("Pagar", url=init_point)]
-        ]
-        if context.user_data.get("origin") == "carrito":
-            keyboard.append([InlineKeyboardButton("Volver al menú del carrito", callback_data=f"back_cart_{cart_id}")])
-        else:
-            keyboard.append([InlineKeyboardButton("Volver al Menú Principal", callback_data="back_main")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        msg = (f"Para pagar el carrito '{cart_name}', haga clic en 'Pagar'.\n"
-               "El mensaje de confirmación se enviará cuando se complete el pago.\n\n"
-               "Cuando realize el pago, regrese al bot")
-        await query.edit_message_text(msg, reply_markup=reply_markup)
+    except OutOfStockError as e:
+        await edit_view(query, out_of_stock_text(e), reply_markup=post_adhesion_markup(
+            cart_id if context.user_data.get("origin") == "carrito" else None))
         return POST_ADHESION
-    elif data.startswith("back_main"):
-        # Volver al menú principal
-        keyboard = [
-            [InlineKeyboardButton("Ordenar", callback_data="menu_ordenar")],
-            [InlineKeyboardButton("Historial", callback_data="menu_historial")],
-            [InlineKeyboardButton("Pedidos Pendientes", callback_data="menu_pedidos")],
-            [InlineKeyboardButton("Carritos", callback_data="menu_carritos")],
-            [InlineKeyboardButton("Cambiar Direccion", callback_data="menu_cambiar")],
-            [InlineKeyboardButton("Contacto", callback_data="menu_contacto")],
-        [InlineKeyboardButton("Ayuda", callback_data="menu_ayuda")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Menú Principal:", reply_markup=reply_markup)
-        return MAIN_MENU
-    elif data.startswith("back_cart_"):
-        try:
-            cart_id = int(data.split("_")[2])
-        except Exception as e:
-            await query.edit_message_text("Error al procesar el carrito.")
-            return CART_MENU
-        return await cart_menu_handler(update, context)
-    else:
+    if not init_point:
+        await edit_view(query, "Error al crear la preferencia de pago.")
         return POST_ADHESION
-
-
-
+    keyboard = [
+        [InlineKeyboardButton("Pagar", url=init_point)]
+    ]
+    if context.user_data.get("origin") == "carrito":
+        keyboard.append([InlineKeyboardButton("Volver al menú del carrito", callback_data=cb("cart_menu", cart_id))])
+    else:
+        keyboard.append([InlineKeyboardButton("Volver al Menú Principal", callback_data=cb("back_main"))])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    msg = (f"Para pagar el carrito '{cart_name}', haga clic en 'Pagar'.\n"
+           "El mensaje de confirmación se enviará cuando se complete el pago.\n\n"
+           "Cuando realize el pago, regrese al bot")
+    await edit_view(query, msg, reply_markup=reply_markup)
+    return POST_ADHESION
 
 
 def create_payment_preference_for_cart(cart_id):
-    """Crea una preferencia de pago para el carrito en producción y retorna (cart_name, init_point)."""
+    """
+    Reserva el stock del carrito, crea una preferencia de pago en producción y retorna
+    (cart_name, init_point). Lanza OutOfStockError si no alcanza el stock.
+    """
     conn = None
     cur = None
     try:
@@ -2485,7 +6080,8 @@ def create_payment_preference_for_cart(cart_id):
             cur.close()
         if conn:
             release_db(conn)
-    
+
+    reserve_cart_stock(cart_id)
     # Usa tu token de producción
     sdk = mercadopago.SDK(MP_SDK)  # Reemplaza con tu token de producción
     preference_data = {
@@ -2504,10 +6100,17 @@ def create_payment_preference_for_cart(cart_id):
         },
         "auto_return": "approved"
     }
-    preference_response = sdk.preference().create(preference_data)
-    logger.info(f"Respuesta de preferencia (producción): {preference_response}")
+    try:
+        preference_response = sdk.preference().create(preference_data)
+    except Exception as e:
+        logger.error(f"Error al crear la preferencia de pago: {e}")
+        preference_response = {}
+    log_payload(logger, logging.INFO, "Respuesta de preferencia (producción)", preference_response)
     preference = preference_response.get("response", {})
     init_point = preference.get("init_point")
+    if not init_point:
+        # Sin preferencia no habrá pago: el stock no queda reservado hasta que venza
+        release_cart_stock(cart_id)
     return cart_name, init_point
 
 # Función que recupera todos los equipos y calcula la suma de pedidos pendientes de todos sus conjuntos asignados.
@@ -2517,12 +6120,11 @@ def get_all_equipos_for_view():
     y la suma de pedidos pendientes de todos los conjuntos asignados a ese equipo.
     """
     # Primero, obtenemos todos los equipos (solo sus IDs)
-    conn = connect_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM equipos")
-    equipos = cur.fetchall()
-    cur.close()
-    release_db(conn)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM equipos")
+        equipos = cur.fetchall()
+        cur.close()
     
     equipos_list = []
     for row in equipos:
@@ -2533,12 +6135,11 @@ def get_all_equipos_for_view():
         nombre2 = info["trabajador2"] if info else "N/D"
         
         # Recuperamos los conjuntos asignados a este equipo para calcular los pedidos pendientes
-        conn = connect_db()
-        cur = conn.cursor()
-        cur.execute("SELECT id FROM conjuntos WHERE equipo_id = %s", (equipo_id,))
-        conjuntos = cur.fetchall()
-        cur.close()
-        release_db(conn)
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT id FROM conjuntos WHERE equipo_id = %s", (equipo_id,))
+            conjuntos = cur.fetchall()
+            cur.close()
         
         total_pendientes = 0
         for c in conjuntos:
@@ -2560,44 +6161,45 @@ def get_all_equipos_for_view():
 async def ver_equipos_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    equipos = get_all_equipos_for_view()
-    if not equipos:
-        await query.edit_message_text("No existen equipos creados.")
+
+    def build():
+        equipos = get_all_equipos_for_view()
+        if not equipos:
+            return None
+        message = "Equipos:\n\n"
+        rows = []
+        for equipo in equipos:
+            # Se muestran los nombres de los integrantes en lugar de sus IDs
+            equipo_text = f"Equipo: {equipo['trabajador1']} y {equipo['trabajador2']} - {equipo['total_pendientes']} pedidos pendientes"
+            message += f"{equipo_text}\n"
+            # La acción "ver_equipo" lleva el id del equipo para ver_equipo_handler.
+            rows.append([(equipo_text, cb("ver_equipo", equipo['id']))])
+        return message, keyboard_markup(*rows)
+
+    view = keyboards.get("conjuntos", "equipos", build)
+    if view is None:
+        await edit_view(query, "No existen equipos creados.")
         return GESTION_PEDIDOS
-    message = "Equipos:\n\n"
-    buttons = []
-    for equipo in equipos:
-        # Se muestran los nombres de los integrantes en lugar de sus IDs
-        equipo_text = f"Equipo: {equipo['trabajador1']} y {equipo['trabajador2']} - {equipo['total_pendientes']} pedidos pendientes"
-        message += f"{equipo_text}\n"
-        # El callback data incluye el id del equipo para pasar al handler ver_equipo_handler.
-        buttons.append([InlineKeyboardButton(equipo_text, callback_data=f"ver_equipo_{equipo['id']}")])
-    reply_markup = InlineKeyboardMarkup(buttons)
-    await query.edit_message_text(message, reply_markup=reply_markup)
+    message, reply_markup = view
+    await edit_view(query, message, reply_markup=reply_markup)
     return VER_EQUIPOS  # Asegúrate de tener el estado VER_EQUIPOS definido.
 
 
 # Handler que muestra la información detallada de un equipo y sus conjuntos asignados.
-async def ver_equipo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def ver_equipo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, equipo_id: int) -> int:
     query = update.callback_query
     await query.answer()
-    try:
-        equipo_id = int(query.data.split("_")[2])
-    except Exception as e:
-        await query.edit_message_text("Error al procesar el equipo seleccionado.")
-        return VER_EQUIPOS
     equipo_info = get_equipo_info(equipo_id)
     if not equipo_info:
-        await query.edit_message_text("Equipo no encontrado.")
+        await edit_view(query, "Equipo no encontrado.")
         return VER_EQUIPOS
     # Recuperar los conjuntos asignados a este equipo.
     def get_conjuntos_by_equipo(equipo_id):
-        conn = connect_db()
-        cur = conn.cursor()
-        cur.execute("SELECT id, numero_conjunto FROM conjuntos WHERE equipo_id = %s", (equipo_id,))
-        rows = cur.fetchall()
-        cur.close()
-        release_db(conn)
+        with db_connection() as conn:
+            cur = conn.cursor()
+            statements.execute(cur, "conjuntos_por_equipo", (equipo_id,))
+            rows = cur.fetchall()
+            cur.close()
         conjuntos = []
         for row in rows:
             conjunto_id, numero_conjunto = row
@@ -2619,42 +6221,37 @@ async def ver_equipo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     buttons = []
     for c in conjuntos:
         btn_text = f"Conjunto {c['numero']} - {c['pendientes']} pendientes"
-        # El callback data "descargar_conjunto_<conjunto_id>" pasará al handler para descargar el PDF.
-        buttons.append([InlineKeyboardButton(btn_text, callback_data=f"descargar_conjunto_{c['id']}")])
+        # La acción "descargar_conjunto" pasa al handler que descarga el PDF.
+        buttons.append([InlineKeyboardButton(btn_text, callback_data=cb("descargar_conjunto", c['id']))])
     # Agregar botón para volver al menú de gestión
-    buttons.append([InlineKeyboardButton("Volver a Gestión de Pedidos y Equipos", callback_data="gestion_pedidos")])
+    buttons.append([InlineKeyboardButton("Volver a Gestión de Pedidos y Equipos", callback_data=cb("gestion"))])
     reply_markup = InlineKeyboardMarkup(buttons)
-    await query.edit_message_text(message, reply_markup=reply_markup)
+    await edit_view(query, message, reply_markup=reply_markup)
     return VER_EQUIPOS
 
 # Handler que genera y envía el PDF de un conjunto seleccionado.
-async def descargar_conjunto_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def descargar_conjunto_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, conjunto_id: int) -> int:
     query = update.callback_query
     await query.answer()
+    # PDF del conjunto con los códigos de confirmación (ver ConjuntoDocuments)
     try:
-        conjunto_id = int(query.data.split("_")[2])
+        document = conjunto_documents.get(conjunto_id, show_confirmation=True)
     except Exception as e:
-        await query.edit_message_text("Error al procesar el conjunto seleccionado.")
-        return VER_EQUIPOS
-    # Generar el PDF del conjunto (usa tu función existente generate_conjunto_pdf)
-    pdf_file = generate_conjunto_pdf(conjunto_id, query.from_user.id)
-    if not pdf_file:
-        await query.edit_message_text("Error al generar el PDF del conjunto.")
+        logger.error(f"Error al generar el PDF del conjunto: {e}")
+        await edit_view(query, "Error al generar el PDF del conjunto.")
         return VER_EQUIPOS
     try:
-        with open(pdf_file, "rb") as f:
-            await context.bot.send_document(chat_id=query.message.chat_id,
-                                            document=f,
-                                            filename=pdf_file,
-                                            caption=f"PDF del Conjunto {conjunto_id}")
+        await context.bot.send_document(chat_id=query.message.chat_id,
+                                        document=document,
+                                        filename=f"conjunto_{conjunto_id}.pdf",
+                                        caption=f"PDF del Conjunto {conjunto_id}")
     except Exception as e:
         logger.error(f"Error al enviar el PDF: {e}")
-        await query.edit_message_text("Error al enviar el PDF.")
+        await edit_view(query, "Error al enviar el PDF.")
         return VER_EQUIPOS
     # Botón para volver al menú de gestión
-    keyboard = [[InlineKeyboardButton("Volver a Gestión de Pedidos y Equipos", callback_data="gestion_pedidos")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("PDF enviado.", reply_markup=reply_markup)
+    reply_markup = BACK_GESTION_MARKUP
+    await edit_view(query, "PDF enviado.", reply_markup=reply_markup)
     return VER_EQUIPOS
 
 
@@ -2665,10 +6262,7 @@ def get_pending_orders(telegram_id, limit=20):
     try:
         conn = connect_db()
         cur = conn.cursor()
-        cur.execute(
-            "SELECT id, cart_id, confirmation_code, order_date FROM orders WHERE telegram_id = %s AND status = 'pendiente' ORDER BY order_date DESC LIMIT %s",
-            (telegram_id, limit)
-        )
+        statements.execute(cur, "pending_orders", (telegram_id, limit))
         orders = cur.fetchall()
         return orders
     except Exception as e:
@@ -2687,9 +6281,8 @@ async def pending_orders_handler(update: Update, context: ContextTypes.DEFAULT_T
     telegram_id = query.from_user.id
     orders = get_pending_orders(telegram_id, limit=20)
     if not orders:
-        keyboard = [[InlineKeyboardButton("Volver al Menú Principal", callback_data="back_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("No tienes pedidos pendientes.", reply_markup=reply_markup)
+        reply_markup = BACK_MAIN_MARKUP
+        await edit_view(query, "No tienes pedidos pendientes.", reply_markup=reply_markup)
         return MAIN_MENU
 
     text = "Tus pedidos pendientes:\n\n"
@@ -2700,9 +6293,8 @@ async def pending_orders_handler(update: Update, context: ContextTypes.DEFAULT_T
         else:
             order_date_str = str(order_date)
         text += f"Pedido #{order_id}: Código {confirmation_code} - Fecha {order_date_str}\n"
-    keyboard = [[InlineKeyboardButton("Volver al Menú Principal", callback_data="back_main")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text, reply_markup=reply_markup)
+    reply_markup = BACK_MAIN_MARKUP
+    await edit_view(query, text, reply_markup=reply_markup)
     return MAIN_MENU
 
 def crear_nuevo_equipo_db(trabajador1: int, trabajador2: int):
@@ -2714,66 +6306,290 @@ def crear_nuevo_equipo_db(trabajador1: int, trabajador2: int):
     cur = conn.cursor()
     try:
         cur.execute(
-            "INSERT INTO equipos (trabajador1, trabajador2) VALUES (%s, %s) RETURNING id",
-            (trabajador1, trabajador2)
+            "INSERT INTO equipos (trabajador1, trabajador2) VALUES (%s, %s) RETURNING id",
+            (trabajador1, trabajador2)
+        )
+        equipo_id = cur.fetchone()[0]
+        conn.commit()
+        keyboards.bump_on_commit("conjuntos")
+        forget_user_roles_on_commit(trabajador1, trabajador2)
+        return equipo_id
+    except Exception as e:
+        logger.error(f"Error al crear nuevo equipo: {e}")
+        conn.rollback()
+        return None
+    finally:
+        cur.close()
+        release_db(conn)
+
+
+async def crear_nuevo_equipo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handler para la opción "Crear Nuevo Equipo".  
+    Se solicita al usuario que ingrese dos IDs de Telegram (separados por un espacio o coma).  
+    Si la entrada es válida, se crea el equipo en la base de datos y se notifica el éxito junto con un botón para volver al menú de gestión.
+    """
+    # Si el handler se activa mediante callback (por ejemplo, al presionar el botón "Crear Nuevo Equipo")
+    # y no hay mensaje de texto aún, se solicita la entrada.
+    if update.callback_query:
+        await update.callback_query.answer()
+        await edit_view(update.callback_query, "Ingrese los dos IDs de Telegram separados por un espacio o coma:")
+        return CREAR_NUEVO_EQUIPO
+
+    # Si el usuario ya ingresó un mensaje (estado CREAR_NUEVO_EQUIPO)
+    message_text = update.message.text
+    # Reemplazamos comas por espacios y dividimos para obtener los dos IDs
+    ids = message_text.replace(",", " ").split()
+    if len(ids) != 2:
+        error_text = "Debe ingresar exactamente dos IDs de Telegram separados por un espacio o coma. Inténtelo nuevamente."
+        await update.message.reply_text(error_text)
+        return CREAR_NUEVO_EQUIPO
+
+    try:
+        id1 = int(ids[0])
+        id2 = int(ids[1])
+    except ValueError:
+        error_text = "Los IDs deben ser números. Inténtelo nuevamente."
+        await update.message.reply_text(error_text)
+        return CREAR_NUEVO_EQUIPO
+
+    # Crear el equipo en la base de datos
+    equipo_id = crear_nuevo_equipo_db(id1, id2)
+    if equipo_id is None:
+        error_text = "Error al crear el equipo. Por favor, intente nuevamente."
+        await update.message.reply_text(error_text)
+        return CREAR_NUEVO_EQUIPO
+
+    # Notificar éxito y agregar un botón para volver al menú de gestión de pedidos y equipos.
+    success_text = f"Equipo creado exitosamente: Equipo {equipo_id} - {id1} y {id2}."
+    reply_markup = BACK_GESTION_MARKUP
+    await update.message.reply_text(success_text, reply_markup=reply_markup)
+    return GESTION_PEDIDOS
+
+#########################################
+# DIFUSIONES (/broadcast)
+#########################################
+
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "500"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+
+# broadcast_id -> tarea que lo está enviando en este proceso
+active_broadcasts = {}
+
+
+def create_broadcast(text, created_by):
+    """Registra una difusión nueva y retorna su id."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO broadcasts (text, created_by) VALUES (%s, %s) RETURNING id",
+            (text, created_by)
+        )
+        broadcast_id = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+    return broadcast_id
+
+
+def get_broadcast(broadcast_id):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT id, text, created_by, status, last_telegram_id, sent, blocked, failed "
+            "FROM broadcasts WHERE id = %s",
+            (broadcast_id,)
+        )
+        row = cur.fetchone()
+        cur.close()
+    if row is None:
+        return None
+    keys = ("id", "text", "created_by", "status", "last_telegram_id", "sent", "blocked", "failed")
+    return dict(zip(keys, row))
+
+
+def save_broadcast_checkpoint(broadcast_id, last_telegram_id, sent, blocked_ids, failed):
+    """
+    Guarda el avance de una difusión después de cada bloque y marca a los usuarios
+    que bloquearon el bot, todo en la misma transacción.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        if blocked_ids:
+            cur.execute("UPDATE users SET blocked_at = NOW() WHERE telegram_id = ANY(%s)", (blocked_ids,))
+        cur.execute(
+            "UPDATE broadcasts SET last_telegram_id = %s, sent = sent + %s, blocked = blocked + %s, "
+            "failed = failed + %s WHERE id = %s",
+            (last_telegram_id, sent, len(blocked_ids), failed, broadcast_id)
+        )
+        conn.commit()
+        cur.close()
+
+
+def finish_broadcast(broadcast_id, status):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE broadcasts SET status = %s, finished_at = NOW() WHERE id = %s", (status, broadcast_id))
+        conn.commit()
+        cur.close()
+
+
+def get_broadcast_recipients(after_telegram_id):
+    """
+    Siguiente bloque de hasta BROADCAST_CHUNK destinatarios con telegram_id mayor al dado
+    (paginado por clave). Cada bloque es una consulta corta: la conexión vuelve al pool
+    mientras se envían los mensajes y el orden por telegram_id permite retomar desde el
+    último confirmado.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT telegram_id FROM users WHERE telegram_id > %s AND blocked_at IS NULL "
+            "ORDER BY telegram_id LIMIT %s",
+            (after_telegram_id, BROADCAST_CHUNK)
+        )
+        chat_ids = [row[0] for row in cur.fetchall()]
+        conn.commit()
+        cur.close()
+    return chat_ids
+
+
+async def _broadcast_one(bot, chat_id, text, semaphore):
+    """Envía la difusión a un usuario. Retorna 'sent', 'blocked' o 'failed'."""
+    async with semaphore:
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, rate_limit_args=PRIORITY_BULK)
+            return "sent"
+        except Forbidden:
+            return "blocked"
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                return "blocked"
+            logger.error(f"Error enviando difusión a {chat_id}: {e}")
+            return "failed"
+        except Exception as e:
+            logger.error(f"Error enviando difusión a {chat_id}: {e}")
+            return "failed"
+
+
+async def run_broadcast(bot, broadcast_id):
+    """
+    Envía una difusión desde su último checkpoint. Cada bloque de destinatarios se envía
+    en paralelo (el planificador de envíos aplica los límites de Telegram) y, al terminar
+    el bloque, se guarda el avance; si el proceso se reinicia, se retoma desde ahí.
+    """
+    # La tarea hereda el contexto del update que la creó: no debe usar su unidad de trabajo
+    _current_uow.set(None)
+    broadcast = get_broadcast(broadcast_id)
+    if broadcast is None or broadcast["status"] != "running":
+        return
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    last_telegram_id = broadcast["last_telegram_id"]
+    status = "done"
+    try:
+        while True:
+            chat_ids = get_broadcast_recipients(last_telegram_id)
+            if not chat_ids:
+                break
+            results = await asyncio.gather(
+                *(_broadcast_one(bot, chat_id, broadcast["text"], semaphore) for chat_id in chat_ids)
+            )
+            blocked_ids = [chat_id for chat_id, result in zip(chat_ids, results) if result == "blocked"]
+            save_broadcast_checkpoint(
+                broadcast_id, chat_ids[-1], results.count("sent"), blocked_ids, results.count("failed")
+            )
+            last_telegram_id = chat_ids[-1]
+    except asyncio.CancelledError:
+        # Se corta el proceso: queda en 'running' para retomarse al reiniciar
+        status = None
+        raise
+    except Exception as e:
+        logger.error(f"Error en la difusión {broadcast_id}: {e}")
+        status = "error"
+    finally:
+        active_broadcasts.pop(broadcast_id, None)
+        if status is not None:
+            finish_broadcast(broadcast_id, status)
+
+    broadcast = get_broadcast(broadcast_id)
+    logger.info(f"Difusión {broadcast_id} terminada ({status}): {broadcast['sent']} enviados, "
+                f"{broadcast['blocked']} bloqueados, {broadcast['failed']} fallidos")
+    if broadcast["created_by"]:
+        await bot.send_message(
+            chat_id=broadcast["created_by"],
+            text=f"Difusión {broadcast_id} terminada ({status}).\n"
+                 f"Enviados: {broadcast['sent']}\nBloqueados: {broadcast['blocked']}\nFallidos: {broadcast['failed']}",
+            rate_limit_args=PRIORITY_NOTIFICATION,
+        )
+
+
+def start_broadcast_task(bot, broadcast_id):
+    if broadcast_id in active_broadcasts:
+        return
+    active_broadcasts[broadcast_id] = asyncio.get_running_loop().create_task(run_broadcast(bot, broadcast_id))
+
+
+async def resume_broadcasts(bot):
+    """Retoma las difusiones que quedaron a medias (se llama al iniciar el loop del bot)."""
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+            pending = [row[0] for row in cur.fetchall()]
+            cur.close()
+    except Exception as e:
+        logger.error(f"Error al buscar difusiones pendientes: {e}")
+        return
+    for broadcast_id in pending:
+        logger.info(f"Retomando difusión {broadcast_id}")
+        start_broadcast_task(bot, broadcast_id)
+
+
+def get_recent_broadcasts(limit=5):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT id, status, sent, blocked, failed, created_at FROM broadcasts ORDER BY id DESC LIMIT %s",
+            (limit,)
         )
-        equipo_id = cur.fetchone()[0]
-        conn.commit()
-        return equipo_id
-    except Exception as e:
-        logger.error(f"Error al crear nuevo equipo: {e}")
-        conn.rollback()
-        return None
-    finally:
+        rows = cur.fetchall()
         cur.close()
-        release_db(conn)
+    return rows
 
 
-async def crear_nuevo_equipo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+@admin_only
+async def broadcast_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Handler para la opción "Crear Nuevo Equipo".  
-    Se solicita al usuario que ingrese dos IDs de Telegram (separados por un espacio o coma).  
-    Si la entrada es válida, se crea el equipo en la base de datos y se notifica el éxito junto con un botón para volver al menú de gestión.
+    Envía un mensaje a todos los usuarios que no bloquearon el bot.
+    Uso: /broadcast <mensaje>   (sin mensaje, muestra el estado de las últimas difusiones)
     """
-    # Si el handler se activa mediante callback (por ejemplo, al presionar el botón "Crear Nuevo Equipo")
-    # y no hay mensaje de texto aún, se solicita la entrada.
-    if update.callback_query:
-        await update.callback_query.answer()
-        await update.callback_query.edit_message_text("Ingrese los dos IDs de Telegram separados por un espacio o coma:")
-        return CREAR_NUEVO_EQUIPO
-
-    # Si el usuario ya ingresó un mensaje (estado CREAR_NUEVO_EQUIPO)
-    message_text = update.message.text
-    # Reemplazamos comas por espacios y dividimos para obtener los dos IDs
-    ids = message_text.replace(",", " ").split()
-    if len(ids) != 2:
-        error_text = "Debe ingresar exactamente dos IDs de Telegram separados por un espacio o coma. Inténtelo nuevamente."
-        await update.message.reply_text(error_text)
-        return CREAR_NUEVO_EQUIPO
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        try:
+            rows = get_recent_broadcasts()
+        except Exception as e:
+            logger.error(f"Error al obtener difusiones: {e}")
+            await update.message.reply_text("Error al obtener las difusiones.")
+            return
+        if not rows:
+            await update.message.reply_text("Uso: /broadcast <mensaje>\nNo hay difusiones registradas.")
+            return
+        lines = ["Uso: /broadcast <mensaje>\n\nÚltimas difusiones:"]
+        for broadcast_id, status, sent, blocked, failed, created_at in rows:
+            lines.append(f"#{broadcast_id} {created_at:%Y-%m-%d %H:%M} [{status}] "
+                         f"enviados {sent}, bloqueados {blocked}, fallidos {failed}")
+        await update.message.reply_text("\n".join(lines))
+        return
 
     try:
-        id1 = int(ids[0])
-        id2 = int(ids[1])
-    except ValueError:
-        error_text = "Los IDs deben ser números. Inténtelo nuevamente."
-        await update.message.reply_text(error_text)
-        return CREAR_NUEVO_EQUIPO
-
-    # Crear el equipo en la base de datos
-    equipo_id = crear_nuevo_equipo_db(id1, id2)
-    if equipo_id is None:
-        error_text = "Error al crear el equipo. Por favor, intente nuevamente."
-        await update.message.reply_text(error_text)
-        return CREAR_NUEVO_EQUIPO
+        broadcast_id = create_broadcast(parts[1], update.effective_user.id)
+    except Exception as e:
+        logger.error(f"Error al crear la difusión: {e}")
+        await update.message.reply_text("Error al crear la difusión.")
+        return
+    # Se arranca cuando la unidad de trabajo del comando se confirma
+    on_commit(lambda: start_broadcast_task(context.bot, broadcast_id))
+    await update.message.reply_text(f"Difusión {broadcast_id} en curso. Te aviso cuando termine.")
 
-    # Notificar éxito y agregar un botón para volver al menú de gestión de pedidos y equipos.
-    success_text = f"Equipo creado exitosamente: Equipo {equipo_id} - {id1} y {id2}."
-    keyboard = [
-        [InlineKeyboardButton("Volver a Gestión de Pedidos y Equipos", callback_data="gestion_pedidos")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(success_text, reply_markup=reply_markup)
-    return GESTION_PEDIDOS
 
 # Agrega un handler para el comando /webhookinfo
 async def webhook_info_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -2793,7 +6609,7 @@ def get_cart_owner(cart_id):
     try:
         conn = connect_db()
         cur = conn.cursor()
-        cur.execute("SELECT telegram_id FROM carts WHERE id = %s", (cart_id,))
+        statements.execute(cur, "cart_owner", (cart_id,))
         row = cur.fetchone()
         if row:
             return row[0]
@@ -2845,19 +6661,9 @@ async def new_cart_name_handler(update: Update, context: ContextTypes.DEFAULT_TY
         msg = f"Carrito *{cart_name}* creado correctamente."
 
     # Configurar el botón "Volver":
-    # Si el proceso se inició desde un carrito específico (origin == "carrito") se usa "back_cart_{cart_id}".
-    # En caso contrario se usa "back_main".
-    if context.user_data.get("origin") == "carrito":
-        back_button = InlineKeyboardButton("Volver al menú del carrito", callback_data=f"back_cart_{cart_id}")
-    else:
-        back_button = InlineKeyboardButton("Volver al Menú Principal", callback_data="back_main")
-
-    keyboard = [
-        [InlineKeyboardButton("Agregar más productos", callback_data="add_more")],
-        [InlineKeyboardButton("Pagar Carrito", callback_data="pay_cart")],
-        [back_button]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Si el proceso se inició desde un carrito específico (origin == "carrito") se vuelve al menú del carrito.
+    # En caso contrario se vuelve al menú principal.
+    reply_markup = post_adhesion_markup(cart_id if context.user_data.get("origin") == "carrito" else None)
     await update.message.reply_text(msg, parse_mode="Markdown", reply_markup=reply_markup)
     return POST_ADHESION
 
@@ -2890,10 +6696,637 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text("Operación cancelada.")
     return ConversationHandler.END
 
+#########################################
+# INVENTARIO Y RESERVAS DE STOCK
+#########################################
+
+# products.stock es la cantidad disponible para vender (gramos o unidades según sale_type;
+# NULL = sin control de stock). Al crear la preferencia de pago se reserva lo del carrito con
+# un UPDATE condicional por producto (stock >= cantidad), así dos compras simultáneas del
+# último kilo no pueden venderlo dos veces. La reserva se confirma cuando el pago se aprueba
+# (process_approved_payment) y, si vence antes, una tarea periódica devuelve el stock.
+STOCK_RESERVATION_TTL = int(os.getenv("STOCK_RESERVATION_TTL", "1800"))
+STOCK_SWEEP_INTERVAL = int(os.getenv("STOCK_SWEEP_INTERVAL", "60"))
+STOCK_SWEEP_BATCH = int(os.getenv("STOCK_SWEEP_BATCH", "500"))
+
+stock_stats = {"reserved": 0, "rejected": 0, "committed": 0, "late_commits": 0, "released": 0, "expired": 0}
+register_metrics("stock", lambda: dict(stock_stats))
+
+
+class OutOfStockError(Exception):
+    """No alcanza el stock; 'missing' es una lista de (nombre, sale_type, disponible, pedido)."""
+
+    def __init__(self, missing):
+        super().__init__(", ".join(name for name, _, _, _ in missing))
+        self.missing = missing
+
+
+def init_stock(cur):
+    cur.execute("ALTER TABLE products ADD COLUMN IF NOT EXISTS stock NUMERIC")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            cart_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity NUMERIC NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (cart_id, product_id)
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS stock_reservations_expires_idx ON stock_reservations (expires_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS stock_reservations_product_idx ON stock_reservations (product_id)")
+
+
+def release_stock(cur, cart_id):
+    """Devuelve al stock la reserva del carrito (si tiene). Retorna la cantidad de productos liberados."""
+    cur.execute(
+        "WITH released AS (DELETE FROM stock_reservations WHERE cart_id = %s RETURNING product_id, quantity) "
+        "UPDATE products p SET stock = p.stock + r.quantity FROM released r "
+        "WHERE p.id = r.product_id AND p.stock IS NOT NULL",
+        (cart_id,)
+    )
+    return cur.rowcount
+
+
+def reserve_stock(cur, cart_id, ttl=STOCK_RESERVATION_TTL):
+    """
+    Reserva el stock de los productos del carrito por 'ttl' segundos, reemplazando una reserva
+    anterior del mismo carrito. Cada producto se descuenta con un UPDATE condicional, en orden
+    de id (dos carritos con los mismos productos no se bloquean mutuamente).
+    Lanza OutOfStockError si alguno no alcanza: quien llama debe hacer rollback.
+    """
+    release_stock(cur, cart_id)
+    cur.execute(
+        "SELECT ci.product_id, p.name, p.sale_type, SUM(ci.quantity), p.stock "
+        "FROM cart_items ci JOIN products p ON p.id = ci.product_id "
+        "WHERE ci.cart_id = %s AND p.stock IS NOT NULL "
+        "GROUP BY ci.product_id, p.name, p.sale_type, p.stock ORDER BY ci.product_id",
+        (cart_id,)
+    )
+    items = cur.fetchall()
+    missing = []
+    for product_id, name, sale_type, quantity, available in items:
+        # Si lo leído ya no alcanza se rechaza sin esperar el lock de la fila (producto agotado)
+        if available < quantity:
+            missing.append((name, sale_type, max(available, 0), quantity))
+            continue
+        cur.execute(
+            "UPDATE products SET stock = stock - %s WHERE id = %s AND stock >= %s RETURNING stock",
+            (quantity, product_id, quantity)
+        )
+        if cur.fetchone() is None:
+            cur.execute("SELECT stock FROM products WHERE id = %s", (product_id,))
+            row = cur.fetchone()
+            missing.append((name, sale_type, max(row[0], 0) if row and row[0] is not None else 0, quantity))
+    if missing:
+        raise OutOfStockError(missing)
+    if items:
+        cur.execute(
+            "INSERT INTO stock_reservations (cart_id, product_id, quantity, expires_at) "
+            "SELECT %s, product_id, quantity, NOW() + make_interval(secs => %s) "
+            "FROM unnest(%s::integer[], %s::numeric[]) AS r(product_id, quantity)",
+            (cart_id, ttl, [item[0] for item in items], [item[3] for item in items])
+        )
+    return len(items)
+
+
+def commit_stock(cur, cart_id):
+    """
+    Confirma la venta del carrito (pago aprobado): borra su reserva. Si la reserva ya había
+    vencido y se devolvió, se descuenta de nuevo sin condición, porque el pedido ya está
+    pagado; el stock puede quedar negativo y se avisa en el log.
+    """
+    cur.execute("DELETE FROM stock_reservations WHERE cart_id = %s", (cart_id,))
+    if cur.rowcount:
+        stock_stats["committed"] += 1
+        return
+    cur.execute(
+        "WITH sold AS (SELECT product_id, SUM(quantity) AS quantity FROM cart_items WHERE cart_id = %s GROUP BY product_id) "
+        "UPDATE products p SET stock = p.stock - s.quantity FROM sold s "
+        "WHERE p.id = s.product_id AND p.stock IS NOT NULL RETURNING p.name, p.stock",
+        (cart_id,)
+    )
+    rows = cur.fetchall()
+    if rows:
+        stock_stats["late_commits"] += 1
+    for name, stock in rows:
+        if stock < 0:
+            logger.warning(f"Stock negativo de '{name}' ({stock}) por el pago tardío del carrito {cart_id}")
+
+
+@contextmanager
+def separate_unit_of_work():
+    """Unidad de trabajo propia aunque el bloque corra dentro de otra (se confirma al salir)."""
+    token = _current_uow.set(None)
+    try:
+        with unit_of_work() as uow:
+            yield uow
+    finally:
+        _current_uow.reset(token)
+
+
+def reserve_cart_stock(cart_id):
+    """
+    Reserva el stock del carrito en una transacción corta y propia: los productos no quedan
+    bloqueados mientras se crea la preferencia ni hasta que termine el update.
+    Lanza OutOfStockError si no alcanza.
+    """
+    try:
+        with separate_unit_of_work():
+            with db_connection() as conn:
+                cur = conn.cursor()
+                reserved = reserve_stock(cur, cart_id)
+                cur.close()
+    except OutOfStockError:
+        stock_stats["rejected"] += 1
+        raise
+    if reserved:
+        stock_stats["reserved"] += 1
+    return reserved
+
+
+def release_cart_stock(cart_id):
+    with separate_unit_of_work():
+        with db_connection() as conn:
+            cur = conn.cursor()
+            released = release_stock(cur, cart_id)
+            cur.close()
+    stock_stats["released"] += released
+    return released
+
+
+def out_of_stock_text(error):
+    lines = ["No hay stock suficiente para:"]
+    for name, sale_type, available, requested in error.missing:
+        lines.append(f"- {name}: pidió {format_picking_quantity(sale_type, requested)}, "
+                     f"quedan {format_picking_quantity(sale_type, available)}")
+    lines.append("\nModifique el carrito e intente pagar nuevamente.")
+    return "\n".join(lines)
+
+
+def sweep_expired_reservations(cur, batch_size):
+    """Devuelve al stock un lote de reservas vencidas. Retorna la cantidad de reservas liberadas."""
+    cur.execute(
+        "WITH expired AS ("
+        "DELETE FROM stock_reservations WHERE (cart_id, product_id) IN ("
+        "SELECT cart_id, product_id FROM stock_reservations WHERE expires_at < NOW() "
+        "LIMIT %s FOR UPDATE SKIP LOCKED) RETURNING product_id, quantity), "
+        "totals AS (SELECT product_id, SUM(quantity) AS quantity FROM expired GROUP BY product_id), "
+        "restored AS (UPDATE products p SET stock = p.stock + t.quantity FROM totals t "
+        "WHERE p.id = t.product_id AND p.stock IS NOT NULL) "
+        "SELECT COUNT(*) FROM expired",
+        (batch_size,)
+    )
+    return cur.fetchone()[0]
+
+
+async def run_stock_sweeper():
+    """Tarea periódica: libera las reservas de stock vencidas, un lote por transacción."""
+    total = 0
+    try:
+        while True:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                released = sweep_expired_reservations(cur, STOCK_SWEEP_BATCH)
+                conn.commit()
+                cur.close()
+            total += released
+            if released < STOCK_SWEEP_BATCH:
+                break
+            await asyncio.sleep(0.1)
+    except Exception as e:
+        logger.error(f"Error al liberar reservas de stock vencidas: {e}")
+    stock_stats["expired"] += total
+    if total:
+        logger.info(f"Se liberaron {total} reservas de stock vencidas")
+
+
+if STOCK_SWEEP_INTERVAL > 0:
+    scheduler.add_job(run_stock_sweeper, "interval", seconds=STOCK_SWEEP_INTERVAL,
+                      id="stock_sweeper", max_instances=1, coalesce=True)
+
+
+def set_product_stock(product_id, on_hand):
+    """
+    Fija el stock de un producto a partir de lo que hay físicamente ('on_hand'; None deja de
+    controlarlo): lo disponible es eso menos lo reservado. Retorna (nombre, sale_type,
+    disponible, reservado) o None si el producto no existe.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        # Con la fila bloqueada, ninguna reserva nueva del producto puede quedar a medias
+        cur.execute("SELECT name, sale_type FROM products WHERE id = %s FOR UPDATE", (product_id,))
+        row = cur.fetchone()
+        if row is None:
+            cur.close()
+            return None
+        cur.execute("SELECT COALESCE(SUM(quantity), 0) FROM stock_reservations WHERE product_id = %s", (product_id,))
+        reserved = cur.fetchone()[0]
+        if on_hand is None:
+            # Sin control de stock las reservas pendientes no tienen a dónde volver
+            cur.execute("DELETE FROM stock_reservations WHERE product_id = %s", (product_id,))
+            cur.execute("UPDATE products SET stock = NULL WHERE id = %s", (product_id,))
+            available = None
+        else:
+            cur.execute("UPDATE products SET stock = %s - %s WHERE id = %s RETURNING stock", (on_hand, reserved, product_id))
+            available = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+    return row[0], row[1], available, reserved
+
+
+def get_stock_report():
+    """(id, nombre, sale_type, disponible, reservado) de los productos con control de stock."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT p.id, p.name, p.sale_type, p.stock, COALESCE(SUM(r.quantity), 0) "
+            "FROM products p LEFT JOIN stock_reservations r ON r.product_id = p.id "
+            "WHERE p.stock IS NOT NULL GROUP BY p.id ORDER BY p.id"
+        )
+        rows = cur.fetchall()
+        cur.close()
+    return rows
+
+
+@admin_only
+async def stock_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Consulta o fija el stock.
+    Uso: /stock                     productos con control de stock
+         /stock <id> <cantidad>     hay <cantidad> (gramos o unidades) en el depósito
+         /stock <id> no             deja de controlar el stock del producto
+    """
+    args = update.message.text.split()[1:]
+    usage = ("Uso: /stock | /stock <id producto> <cantidad en gramos o unidades> | /stock <id producto> no")
+    if not args:
+        try:
+            rows = get_stock_report()
+        except Exception as e:
+            logger.error(f"Error al obtener el stock: {e}")
+            await update.message.reply_text("Error al obtener el stock.")
+            return
+        if not rows:
+            await update.message.reply_text("Ningún producto tiene control de stock.\n" + usage)
+            return
+        lines = ["Stock disponible (reservado):"]
+        for product_id, name, sale_type, available, reserved in rows:
+            lines.append(f"{product_id}. {name}: {format_picking_quantity(sale_type, available)} "
+                         f"({format_picking_quantity(sale_type, reserved)})")
+        await update.message.reply_text("\n".join(lines))
+        return
+    if len(args) != 2 or not args[0].isdigit():
+        await update.message.reply_text(usage)
+        return
+    if args[1].lower() == "no":
+        on_hand = None
+    else:
+        try:
+            on_hand = decimal.Decimal(args[1].replace(",", "."))
+        except decimal.InvalidOperation:
+            await update.message.reply_text(usage)
+            return
+        if not on_hand.is_finite() or on_hand < 0:
+            await update.message.reply_text(usage)
+            return
+    try:
+        result = set_product_stock(int(args[0]), on_hand)
+    except Exception as e:
+        logger.error(f"Error al actualizar el stock: {e}")
+        await update.message.reply_text("Error al actualizar el stock.")
+        return
+    if result is None:
+        await update.message.reply_text("Producto no encontrado.")
+        return
+    name, sale_type, available, reserved = result
+    if available is None:
+        await update.message.reply_text(f"{name}: sin control de stock.")
+    else:
+        await update.message.reply_text(
+            f"{name}: disponible {format_picking_quantity(sale_type, available)}, "
+            f"reservado {format_picking_quantity(sale_type, reserved)}."
+        )
+
+
+#########################################
+# CONCILIACIÓN DE PAGOS DE MERCADOPAGO
+#########################################
+
+# Si una notificación de /webhook se pierde o falla, el carrito pagado nunca se convierte en
+# pedido. Una tarea periódica recorre por páginas los pagos aprobados recientes con la API de
+# búsqueda de MercadoPago, busca en un solo query por página los que no tienen pedido y los
+# registra por el mismo camino que el webhook (process_approved_payment).
+MP_API_BASE_URL = os.getenv("MP_API_BASE_URL", "https://api.mercadopago.com").rstrip("/")
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "300"))
+RECONCILE_WINDOW_HOURS = int(os.getenv("RECONCILE_WINDOW_HOURS", "48"))
+# Los pagos más nuevos que esto se dejan para el webhook
+RECONCILE_GRACE = int(os.getenv("RECONCILE_GRACE", "120"))
+RECONCILE_PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", "100"))
+PAYMENT_LOCK = 7302
+
+reconcile_stats = {
+    "runs": 0, "scanned": 0, "recovered": 0, "errors": 0,
+    "last_run_ms": 0.0, "payments_per_s": 0.0, "last_lag_s": 0.0, "max_lag_s": 0.0,
+}
+register_metrics("payment_reconciliation", lambda: dict(reconcile_stats))
+
+
+def process_approved_payment(payment_id, cart_id):
+    """
+    Registra el pedido de un pago aprobado; lo usan el webhook y la conciliación.
+    Un lock por pago serializa a ambos hasta el commit, así cada pago genera un solo pedido.
+    Retorna (user_id, order_id, confirmation_code); order_id es None si el pago ya tenía pedido.
+    Lanza LookupError si el carrito no existe.
+    """
+    payment_id = str(payment_id)
+    with unit_of_work():
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", (PAYMENT_LOCK, payment_id))
+            cur.execute(
+                "SELECT 1 FROM orders WHERE payment_id = %s "
+                "UNION ALL SELECT 1 FROM orders_archive WHERE payment_id = %s LIMIT 1",
+                (payment_id, payment_id)
+            )
+            exists = cur.fetchone() is not None
+            cur.close()
+        user_id = get_cart_owner(cart_id)
+        if not user_id:
+            raise LookupError(f"No existe el carrito {cart_id}")
+        if exists:
+            return user_id, None, None
+        order_id, _, confirmation_code = insert_order_with_conjunto(cart_id, user_id, payment_id=payment_id)
+        # La venta descuenta el stock en la misma transacción que crea el pedido
+        with db_connection() as conn:
+            cur = conn.cursor()
+            commit_stock(cur, cart_id)
+            cur.close()
+    return user_id, order_id, confirmation_code
+
+
+def parse_mp_date(value):
+    """Fecha ISO 8601 de MercadoPago (con zona horaria) o None."""
+    try:
+        return datetime.datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+
+async def iter_approved_payments(client, begin, end):
+    """
+    Recorre por páginas los pagos aprobados creados entre 'begin' y 'end' (datetimes en UTC).
+    Cada página es una lista de (payment_id, cart_id, fecha_creación, fecha_aprobación); los
+    pagos sin external_reference numérico se descartan.
+    """
+    offset = 0
+    while True:
+        response = await client.get(f"{MP_API_BASE_URL}/v1/payments/search", params={
+            "status": "approved",
+            "sort": "date_created",
+            "criteria": "asc",
+            "range": "date_created",
+            "begin_date": f"{begin:%Y-%m-%dT%H:%M:%S}.000-00:00",
+            "end_date": f"{end:%Y-%m-%dT%H:%M:%S}.000-00:00",
+            "limit": RECONCILE_PAGE_SIZE,
+            "offset": offset,
+        })
+        response.raise_for_status()
+        data = response.json()
+        results = data.get("results", [])
+        page = []
+        for payment in results:
+            reference = str(payment.get("external_reference") or "")
+            created = parse_mp_date(payment.get("date_created"))
+            if not reference.isdigit() or created is None:
+                continue
+            approved = parse_mp_date(payment.get("date_approved")) or created
+            page.append((str(payment["id"]), int(reference), created, approved))
+        if page:
+            yield page
+        offset += len(results)
+        if not results or offset >= data.get("paging", {}).get("total", 0):
+            break
+
+
+def find_missing_payments(cur, payments):
+    """
+    De una página de pagos (ver iter_approved_payments), retorna los (payment_id, cart_id)
+    cuyo carrito existe y no tiene pedido: ni con ese payment_id ni, para pedidos anteriores
+    a la columna payment_id, un pedido del carrito creado después del pago.
+    """
+    if not payments:
+        return []
+    payment_ids, cart_ids, created, _ = zip(*payments)
+    cur.execute(
+        "SELECT p.payment_id, p.cart_id "
+        "FROM unnest(%s::text[], %s::integer[], %s::timestamptz[]) AS p(payment_id, cart_id, created) "
+        "WHERE EXISTS (SELECT 1 FROM carts c WHERE c.id = p.cart_id) "
+        "AND NOT EXISTS (SELECT 1 FROM orders o WHERE o.payment_id = p.payment_id) "
+        "AND NOT EXISTS (SELECT 1 FROM orders_archive a WHERE a.payment_id = p.payment_id) "
+        "AND NOT EXISTS (SELECT 1 FROM orders o WHERE o.cart_id = p.cart_id "
+        "                AND o.payment_id IS NULL AND o.order_date >= p.created)",
+        (list(payment_ids), list(cart_ids), list(created))
+    )
+    return cur.fetchall()
+
+
+async def run_payment_reconciliation():
+    """Tarea periódica: crea los pedidos de los pagos aprobados que el webhook no registró."""
+    start = time.perf_counter()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    begin = now - datetime.timedelta(hours=RECONCILE_WINDOW_HOURS)
+    end = now - datetime.timedelta(seconds=RECONCILE_GRACE)
+    scanned = 0
+    lags = []
+    context_wrapper = SimpleContext(TELEGRAM_BOT)
+    try:
+        async with httpx.AsyncClient(headers={"Authorization": f"Bearer {MP_SDK}"}, timeout=30) as client:
+            async for page in iter_approved_payments(client, begin, end):
+                scanned += len(page)
+                with db_connection() as conn:
+                    cur = conn.cursor()
+                    missing = find_missing_payments(cur, page)
+                    cur.close()
+                approved_at = {payment_id: approved for payment_id, _, _, approved in page}
+                for payment_id, cart_id in missing:
+                    try:
+                        user_id, order_id, confirmation_code = process_approved_payment(payment_id, cart_id)
+                    except Exception as e:
+                        reconcile_stats["errors"] += 1
+                        logger.error(f"Error al registrar el pedido del pago {payment_id}: {e}")
+                        continue
+                    if order_id is None:
+                        # El webhook lo registró mientras tanto
+                        continue
+                    lag = (datetime.datetime.now(datetime.timezone.utc) - approved_at[payment_id]).total_seconds()
+                    lags.append(lag)
+                    logger.info(f"Conciliación: pedido {order_id} creado para el pago {payment_id} "
+                                f"(carrito {cart_id}, {lag:.0f} s después de aprobado)")
+                    try:
+                        await send_order_notifications(cart_id, confirmation_code, context_wrapper, user_id)
+                    except Exception as e:
+                        logger.error(f"Error enviando notificaciones del pago {payment_id}: {e}")
+    except Exception as e:
+        reconcile_stats["errors"] += 1
+        logger.error(f"Error en la conciliación de pagos: {e}")
+    elapsed = time.perf_counter() - start
+    reconcile_stats["runs"] += 1
+    reconcile_stats["scanned"] += scanned
+    reconcile_stats["recovered"] += len(lags)
+    reconcile_stats["last_run_ms"] = round(elapsed * 1000, 2)
+    reconcile_stats["payments_per_s"] = round(scanned / elapsed, 1) if elapsed else 0.0
+    if lags:
+        reconcile_stats["last_lag_s"] = round(max(lags), 1)
+        reconcile_stats["max_lag_s"] = max(reconcile_stats["max_lag_s"], round(max(lags), 1))
+
+
+if MP_SDK and RECONCILE_INTERVAL > 0:
+    scheduler.add_job(run_payment_reconciliation, "interval", seconds=RECONCILE_INTERVAL,
+                      id="payment_reconciliation", max_instances=1, coalesce=True)
+
+
+#########################################
+# NOTIFICACIONES DE PAGO CONCURRENTES
+#########################################
+
+class SingleFlight:
+    """
+    Agrupa llamadas concurrentes con la misma clave: la primera (líder) ejecuta la función y
+    las demás esperan y reciben su mismo resultado (o su misma excepción). La entrada de una
+    clave existe solo mientras la llamada está en curso, y como mucho hay 'max_keys' claves en
+    vuelo; por encima de eso las llamadas se ejecutan sin agrupar.
+    """
+
+    class _Call:
+        __slots__ = ("event", "result", "error")
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, max_keys=10000, wait_timeout=60):
+        self.max_keys = max_keys
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {"calls": 0, "coalesced": 0, "uncoalesced": 0, "timeouts": 0, "max_in_flight": 0}
+
+    def do(self, key, func):
+        """Ejecuta func() una sola vez por clave en vuelo. Lanza TimeoutError si el líder no termina a tiempo."""
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                if len(self._calls) >= self.max_keys:
+                    self._stats["uncoalesced"] += 1
+                    call = None
+                else:
+                    call = self._calls[key] = self._Call()
+                    self._stats["max_in_flight"] = max(self._stats["max_in_flight"], len(self._calls))
+            else:
+                self._stats["coalesced"] += 1
+        if call is None:
+            return func()
+        if not leader:
+            if not call.event.wait(self.wait_timeout):
+                with self._lock:
+                    self._stats["timeouts"] += 1
+                raise TimeoutError(f"La llamada en curso para {key} no terminó en {self.wait_timeout} s")
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def get_stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["in_flight"] = len(self._calls)
+        return data
+
+
+# MercadoPago suele mandar payment.created y payment.updated del mismo pago casi a la vez:
+# comparten una sola consulta al SDK y un solo procesamiento
+payment_flight = SingleFlight(max_keys=int(os.getenv("PAYMENT_FLIGHT_MAX_KEYS", "1000")))
+register_metrics("payment_notifications", payment_flight.get_stats)
+
+
+def process_payment_notification(payment_id):
+    """
+    Procesa la notificación de un pago: consulta su estado y, si está aprobado, registra el
+    pedido y envía las notificaciones. Retorna (cuerpo, código HTTP) de la respuesta.
+    El pago se marca como procesado solo cuando su pedido quedó registrado, así los
+    reintentos de MercadoPago después de un error se vuelven a procesar.
+    """
+    with processed_payment_lock:
+        if payment_id in processed_payment_ids:
+            logger.info("Pago ya procesado, ignorando notificación")
+            return {"status": "ignored"}, 200
+
+    try:
+        sdk = mercadopago.SDK(MP_SDK)
+        payment_detail_response = sdk.payment().get(payment_id)
+        payment_detail = payment_detail_response.get("response", {})
+        status = payment_detail.get("status")
+        log_payload(logger, logging.INFO, "Pago %s en estado %s", payment_detail, payment_id, status)
+    except Exception as e:
+        logger.error(f"Error al obtener detalles del pago: {e}")
+        return {"error": str(e)}, 500
+
+    if status != "approved":
+        logger.info("Pago no aprobado, ignorando notificación")
+        return {"status": "ignored"}, 200
+    external_ref = payment_detail.get("external_reference")
+    if not external_ref:
+        logger.error("No se encontró external_reference en los detalles del pago")
+        return {"error": "No external_reference"}, 400
+    try:
+        cart_id = int(external_ref)
+    except ValueError:
+        logger.error("external_reference inválido")
+        return {"error": "external_reference inválido"}, 400
+    # El pedido se registra en una unidad de trabajo y se confirma antes de notificar
+    try:
+        user_id, order_id, confirmation_code = process_approved_payment(payment_id, cart_id)
+    except LookupError:
+        logger.error("No se encontró el dueño del carrito")
+        return {"error": "No se encontró el dueño del carrito"}, 404
+    except Exception as e:
+        logger.error(f"Error al insertar el pedido: {e}")
+        return {"error": str(e)}, 500
+    with processed_payment_lock:
+        processed_payment_ids[payment_id] = True
+    if order_id is None:
+        logger.info("El pago ya tiene pedido, ignorando notificación")
+        return {"status": "ignored"}, 200
+    try:
+        # Los envíos pasan por el planificador, que vive en el loop del bot
+        context_wrapper = SimpleContext(TELEGRAM_BOT)
+        asyncio.run_coroutine_threadsafe(
+            send_order_notifications(cart_id, confirmation_code, context_wrapper, user_id),
+            ensure_bot_loop(),
+        ).result()
+        logger.info("Notificaciones enviadas correctamente")
+        return {"status": "ok"}, 200
+    except Exception as e:
+        # El pedido ya está registrado: un reintento no debe duplicarlo ni re-notificar
+        logger.error(f"Error enviando notificaciones: {e}")
+        return {"error": str(e)}, 500
+
+
 @app.route("/webhook", methods=["POST"])
 def mp_webhook():
     data = request.json
-    logger.info(f"Webhook recibido: {data}")
+    log_payload(logger, logging.INFO, "Webhook recibido (%s)", data, data.get("action"))
     
     if data.get("action") in ["payment.created", "payment.updated"]:
         payment_data = data.get("data", {})
@@ -2901,58 +7334,13 @@ def mp_webhook():
         if not payment_id:
             logger.error("No se encontró el id del pago")
             return jsonify({"error": "No payment id"}), 400
-
-        global processed_payment_ids
-        if payment_id in processed_payment_ids:
-            logger.info("Pago ya procesado, ignorando notificación")
-            return jsonify({"status": "ignored"}), 200
-        else:
-            processed_payment_ids.add(payment_id)
-        
+        payment_id = str(payment_id)
         try:
-            sdk = mercadopago.SDK(MP_SDK)
-            payment_detail_response = sdk.payment().get(payment_id)
-            payment_detail = payment_detail_response.get("response", {})
-            logger.info(f"Detalles del pago: {payment_detail}")
-            status = payment_detail.get("status")
-            logger.info(f"Estado del pago: {status}")
-        except Exception as e:
-            logger.error(f"Error al obtener detalles del pago: {e}")
-            return jsonify({"error": str(e)}), 500
-
-        if status == "approved":
-            external_ref = payment_detail.get("external_reference")
-            if external_ref:
-                try:
-                    cart_id = int(external_ref)
-                except ValueError:
-                    logger.error("external_reference inválido")
-                    return jsonify({"error": "external_reference inválido"}), 400
-                confirmation_code = str(random.randint(100000, 999999))
-                user_id = get_cart_owner(cart_id)
-                if not user_id:
-                    logger.error("No se encontró el dueño del carrito")
-                    return jsonify({"error": "No se encontró el dueño del carrito"}), 404
-                order_id, conjunto_id = insert_order_with_conjunto(cart_id, user_id, confirmation_code)
-                if order_id is None:
-                    logger.error("Error al insertar el pedido")
-                try:
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    context_wrapper = SimpleContext(TELEGRAM_BOT)
-                    loop.run_until_complete(send_order_notifications(cart_id, confirmation_code, context_wrapper, user_id))
-                    loop.close()
-                    logger.info("Notificaciones enviadas correctamente")
-                    return jsonify({"status": "ok"}), 200
-                except Exception as e:
-                    logger.error(f"Error enviando notificaciones: {e}")
-                    return jsonify({"error": str(e)}), 500
-            else:
-                logger.error("No se encontró external_reference en los detalles del pago")
-                return jsonify({"error": "No external_reference"}), 400
-        else:
-            logger.info("Pago no aprobado, ignorando notificación")
-            return jsonify({"status": "ignored"}), 200
+            body, status_code = payment_flight.do(payment_id, lambda: process_payment_notification(payment_id))
+        except TimeoutError as e:
+            logger.error(f"Error esperando el procesamiento del pago {payment_id}: {e}")
+            return jsonify({"error": str(e)}), 503
+        return jsonify(body), status_code
     else:
         logger.info("Notificación no relevante")
     return jsonify({"status": "ignored"}), 200
@@ -2961,6 +7349,23 @@ def mp_webhook():
 def ping():
     return "Pong", 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Métricas internas (saturación del pool de conexiones, etc.) en formato JSON.
+    Requiere METRICS_TOKEN (encabezado 'Authorization: Bearer <token>').
+    """
+    if not bearer_token_valid(METRICS_TOKEN):
+        return jsonify({"error": "no autorizado"}), 403
+    data = {}
+    for name, provider in METRICS_PROVIDERS.items():
+        try:
+            data[name] = provider()
+        except Exception as e:
+            logger.error(f"Error obteniendo métricas de {name}: {e}")
+            data[name] = {"error": str(e)}
+    return jsonify(data), 200
+
 async def ping_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_user.id, text="Pong")
     logger.info("Comando /ping ejecutado correctamente")
@@ -2977,80 +7382,130 @@ def main() -> None:
     application.add_handler(CommandHandler("eliminar_equipo", eliminar_equipo_command_handler))
     application.add_handler(CommandHandler("asignar_conjunto", asignar_conjunto_command_handler))
     application.add_handler(CommandHandler("revocar_conjunto", revocar_conjunto_command_handler))
+    application.add_handler(CommandHandler("mover_conjuntos", mover_conjuntos_command_handler))
     application.add_handler(CommandHandler("ver_conjuntos", ver_conjuntos_no_terminados_handler))
     application.add_handler(CommandHandler("webhookinfo", webhook_info_handler))
+    application.add_handler(CommandHandler("broadcast", broadcast_command_handler))
+    application.add_handler(CommandHandler("entregados", entregados_command_handler))
+    application.add_handler(CommandHandler("stats", stats_command_handler))
+    application.add_handler(CommandHandler("exportar", exportar_command_handler))
+    application.add_handler(CommandHandler("preparacion", preparacion_command_handler))
+    application.add_handler(CommandHandler("stock", stock_command_handler))
+    application.add_handler(CommandHandler("ubicacion", ubicacion_command_handler))
+    application.add_handler(InlineQueryHandler(product_inline_query_handler))
+    application.add_handler(MessageHandler(filters.LOCATION, location_handler))
+    application.add_handler(MessageHandler(
+        filters.Document.FileExtension("txt") & filters.CaptionRegex(r"^/entregados"),
+        entregados_command_handler
+    ))
 
     application.add_handler(CommandHandler("ping", ping_handler), group=0)
 
+    # Tabla acción -> handler por estado (ver CallbackRouter)
+    router = CallbackRouter(callbacks)
+    router.add_routes(CAMBIAR_DIRECCION, {"cancelar_direccion": cancelar_cambio_direccion_handler})
+    router.add_routes(MAIN_MENU, {
+        "menu": main_menu_handler,
+        "back_main": main_menu_handler,
+        "gestion": gestion_pedidos_handler,
+        "gestion_personal": gestion_pedidos_personal_handler,
+        "cancelar_direccion": cancelar_cambio_direccion_handler,
+    })
+    router.add_routes(ORDERING, {
+        "product": product_handler,
+        "products_page": products_page_handler,
+        "back_main": main_menu_handler,
+        "cart_menu": cart_menu_handler,
+        "new_cart": new_cart_query_handler,
+    })
+    router.add_routes(SELECT_CART, {
+        "select_cart": cart_selection_handler,
+        "back_quantity": back_quantity_handler,
+        "new_cart": new_cart_query_handler,
+    })
+    router.add_routes(POST_ADHESION, {
+        "add_more": post_adhesion_add_more_handler,
+        "pay_cart": post_adhesion_pay_handler,
+        "back_main": main_menu_handler,
+        "cart_menu": cart_menu_handler,
+    })
+    router.add_routes(CARTS_LIST, {
+        "cart_menu": cart_menu_handler,
+        "back_main": main_menu_handler,
+        "show_carts": show_carts_handler,
+        "new_cart": new_cart_query_handler,
+    })
+    router.add_routes(CART_MENU, {
+        "cart_menu": cart_menu_handler,
+        "cart_details": cart_details_handler,
+        "cart_add": cart_add_handler,
+        "cart_remove": cart_remove_handler,
+        "cart_removeitem": cart_removeitem_handler,
+        "cart_delete": cart_delete_handler,
+        "cart_pay": cart_pay_handler,
+        "show_carts": show_carts_handler,
+        "back_main": main_menu_handler,
+    })
+    # Aquí se agrupan todas las opciones de gestión en un solo estado
+    router.add_routes(GESTION_PEDIDOS, {
+        "gestion": gestion_pedidos_handler,
+        "asignar_conjuntos": asignar_conjuntos_handler,
+        "revocar_conjuntos": revocar_conjuntos_handler,
+        "ver_equipos": ver_equipos_handler,
+        "crear_equipo": crear_nuevo_equipo_handler,
+        "descargar_pdf": descargar_pdf_conjunto_handler,
+        "eliminar_equipos": eliminar_equipo_command_handler,
+        "ver_no_terminados": ver_conjuntos_no_terminados_handler,
+    })
+    # Estado aparte para cuando se selecciona un conjunto y luego un equipo
+    router.add_routes(SELECCIONAR_EQUIPO, {
+        "select_conjunto": select_conjunto_handler,
+        "asignar": asignar_equipo_handler,
+        "asignar_conjuntos": asignar_conjuntos_handler,
+        "multiselect": multiselect_conjuntos_handler,
+        "toggle_conjunto": toggle_conjunto_handler,
+        "assign_selected": assign_selected_handler,
+        "asignar_seleccion": asignar_seleccion_handler,
+        "gestion_personal": gestion_pedidos_personal_handler,
+        "descargar_pdf": descargar_pdf_conjunto_handler,
+    })
+    router.add_routes(REVOCAR_CONJUNTOS, {
+        "revocar_conjuntos": revocar_conjuntos_handler,
+        "revocar_equipo": select_equipo_revocar_handler,
+        "revocar_conjunto": revocar_conjunto_handler,
+        "revocar_equipo_todos": revocar_equipo_todos_handler,
+    })
+    router.add_routes(VER_EQUIPOS, {
+        "ver_equipos": ver_equipos_handler,
+        "ver_equipo": ver_equipo_handler,
+        "descargar_conjunto": descargar_conjunto_handler,
+    })
+
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[CommandHandler("start", start), CommandHandler("producto", producto_command_handler)],
         states={
             NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, name_handler)],
             ADDRESS: [MessageHandler(filters.TEXT & ~filters.COMMAND, address_handler)],
             CAMBIAR_DIRECCION: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, procesar_cambio_direccion_handler),
-                CallbackQueryHandler(cancelar_cambio_direccion_handler, pattern="^cancelar_direccion$")
-            ],
-            MAIN_MENU: [
-                CallbackQueryHandler(main_menu_handler, pattern="^(menu_.*|back_main|gestion_pedidos|gestion_pedidos_personal)$"),
-                CallbackQueryHandler(cambiar_direccion_handler, pattern="^menu_cambiar$"),
-                CallbackQueryHandler(cancelar_cambio_direccion_handler, pattern="^cancelar_direccion$")
+                router.handler(CAMBIAR_DIRECCION)
             ],
+            MAIN_MENU: [router.handler(MAIN_MENU)],
             ORDERING: [
-                CallbackQueryHandler(product_handler, pattern="^(product_.*|menu)$"),
-                CallbackQueryHandler(back_cart_handler, pattern="^back_cart_.*"),
-                CallbackQueryHandler(new_cart_query_handler, pattern="^new_cart$")
+                router.handler(ORDERING),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, product_search_text_handler)
             ],
             ASK_QUANTITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, quantity_handler)],
-            SELECT_CART: [CallbackQueryHandler(cart_selection_handler, pattern="^(select_cart_.*|back_quantity|new_cart)$")],
+            SELECT_CART: [router.handler(SELECT_CART)],
             NEW_CART: [MessageHandler(filters.TEXT & ~filters.COMMAND, new_cart_name_handler)],
-            POST_ADHESION: [CallbackQueryHandler(post_adhesion_handler, pattern="^(add_more|pay_cart|back_main|back_cart_.*)$")],
-            CARTS_LIST: [
-                CallbackQueryHandler(cart_menu_handler, pattern="^cartmenu_\\d+$"),
-                CallbackQueryHandler(main_menu_handler, pattern="^back_main$"),
-                CallbackQueryHandler(show_carts_handler, pattern="^show_carts$"),
-                CallbackQueryHandler(new_cart_query_handler, pattern="^new_cart$")
-            ],
-            CART_MENU: [
-                CallbackQueryHandler(cart_menu_handler, pattern="^(cartmenu_.*|back_cart_.*)$"),
-                CallbackQueryHandler(cart_details_handler, pattern="^cart_details_.*"),
-                CallbackQueryHandler(cart_add_handler, pattern="^cart_add_.*"),
-                CallbackQueryHandler(cart_remove_handler, pattern="^cart_remove_\\d+$"),
-                CallbackQueryHandler(cart_removeitem_handler, pattern="^cart_removeitem_.*"),
-                CallbackQueryHandler(cart_delete_handler, pattern="^cart_delete_.*"),
-                CallbackQueryHandler(cart_pay_handler, pattern="^cart_pay_.*"),
-                CallbackQueryHandler(show_carts_handler, pattern="^show_carts$"),
-                CallbackQueryHandler(main_menu_handler, pattern="^back_main$")
-            ],
-            # Aquí se agrupan todas las opciones de gestión en un solo estado
-            GESTION_PEDIDOS: [
-                CallbackQueryHandler(gestion_pedidos_handler, pattern="^gestion_pedidos$"),
-                CallbackQueryHandler(asignar_conjuntos_handler, pattern="^asignar_conjuntos$"),
-                CallbackQueryHandler(revocar_conjuntos_handler, pattern="^revocar_conjuntos$"),
-                CallbackQueryHandler(ver_equipos_handler, pattern="^ver_equipos$"),
-                CallbackQueryHandler(crear_nuevo_equipo_handler, pattern="^crear_nuevo_equipo$"),
-                CallbackQueryHandler(descargar_pdf_conjunto_handler, pattern="^descargarpdf_\\d+$"),
-                CallbackQueryHandler(lambda u, c: eliminar_equipo_command_handler(u, c), pattern="^eliminar_equipos$"),
-                CallbackQueryHandler(lambda u, c: ver_conjuntos_no_terminados_handler(u, c), pattern="^ver_conjuntos_no_terminados$")
-            ],
-            # Y si requieres un estado aparte para cuando se selecciona un conjunto y luego un equipo:
-            SELECCIONAR_EQUIPO: [
-                CallbackQueryHandler(select_conjunto_handler, pattern="^select_conjunto_\\d+$"),
-                CallbackQueryHandler(asignar_equipo_handler, pattern="^asignar_\\d+_equipo_\\d+$"),
-                CallbackQueryHandler(gestion_pedidos_personal_handler, pattern="^gestion_pedidos_personal$"),
-                CallbackQueryHandler(descargar_pdf_conjunto_handler, pattern="^descargarpdf_\\d+$")
-            ],
+            POST_ADHESION: [router.handler(POST_ADHESION)],
+            CARTS_LIST: [router.handler(CARTS_LIST)],
+            CART_MENU: [router.handler(CART_MENU)],
+            GESTION_PEDIDOS: [router.handler(GESTION_PEDIDOS)],
+            SELECCIONAR_EQUIPO: [router.handler(SELECCIONAR_EQUIPO)],
             CHANGE_STATUS: [MessageHandler(filters.TEXT & ~filters.COMMAND, change_status_handler)],
-            REVOCAR_CONJUNTOS: [
-                CallbackQueryHandler(revocar_conjuntos_handler, pattern="^revocar_conjuntos$"),
-                CallbackQueryHandler(select_equipo_revocar_handler, pattern="^revocar_equipo_\\d+$"),
-                CallbackQueryHandler(revocar_conjunto_handler, pattern="^revocar_conjunto_\\d+$")
-            ],
-            VER_EQUIPOS: [
-                CallbackQueryHandler(ver_equipos_handler, pattern="^ver_equipos$"),
-                CallbackQueryHandler(ver_equipo_handler, pattern="^ver_equipo_\\d+$"),
-                CallbackQueryHandler(descargar_conjunto_handler, pattern="^descargar_conjunto_\\d+$")
-            ],
+            REVOCAR_CONJUNTOS: [router.handler(REVOCAR_CONJUNTOS)],
+            VER_EQUIPOS: [router.handler(VER_EQUIPOS)],
             CREAR_NUEVO_EQUIPO: [MessageHandler(filters.TEXT & ~filters.COMMAND, crear_nuevo_equipo_handler)]
         },
         fallbacks=[CommandHandler("cancel", cancel)],
@@ -3058,6 +7513,8 @@ def main() -> None:
     )
 
     application.add_handler(conv_handler)
+    for handlers in application.handlers.values():
+        log_handler_names(handlers)
 
 
     from waitress import serve
@@ -3069,23 +7526,120 @@ def main() -> None:
 #    application.runpolling()
 
 
+#########################################
+# FILTRO DE INGRESO DE UPDATES (/webhook2)
+#########################################
+
+# Antes de construir objetos de PTB se mira el JSON crudo y se descartan los updates que
+# ningún handler usa, los repetidos (Telegram reintenta si el webhook tarda o falla) y los
+# mensajes viejos que llegan después de una caída. Los callback queries de menús muy viejos
+# se responden directamente en la respuesta HTTP del webhook, sin pasar por la aplicación.
+# ALLOWED_UPDATES también se registra en Telegram (set_webhook / run_polling).
+ALLOWED_UPDATES = ["message", "callback_query", "inline_query"]
+INGEST_DEDUPE_SIZE = int(os.getenv("INGEST_DEDUPE_SIZE", "20000"))
+INGEST_MESSAGE_MAX_AGE = int(os.getenv("INGEST_MESSAGE_MAX_AGE", "3600"))
+INGEST_CALLBACK_MAX_AGE = int(os.getenv("INGEST_CALLBACK_MAX_AGE", str(7 * 24 * 3600)))
+STALE_MENU_TEXT = "Este menú ya no está disponible. Escribe /start para abrir el menú principal."
+
+
+class UpdateIngestFilter:
+    """
+    Decide qué hacer con un update crudo (dict) sin deserializarlo:
+      ("procesar", None)           pasa a Update.de_json y a la aplicación
+      ("descartar", motivo)        se responde 200 sin hacer nada
+      ("responder", método)        se responde 200 con el método de la API en el cuerpo
+    Los update_id vistos se recuerdan en un TTLCache acotado.
+    """
+
+    def __init__(self, allowed_types, dedupe_size=20000, dedupe_ttl=24 * 3600,
+                 message_max_age=3600, callback_max_age=7 * 24 * 3600):
+        self.allowed_types = frozenset(allowed_types)
+        self.message_max_age = message_max_age
+        self.callback_max_age = callback_max_age
+        self._seen = TTLCache(maxsize=dedupe_size, ttl=dedupe_ttl)
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _count(self, key):
+        self._stats[key] = self._stats.get(key, 0) + 1
+
+    def check(self, data, now=None):
+        update_id = data.get("update_id") if isinstance(data, dict) else None
+        if not isinstance(update_id, int):
+            return self._result("descartar", "sin_update_id")
+        update_type = next((key for key in data if key != "update_id"), None)
+        if update_type not in self.allowed_types:
+            return self._result("descartar", f"tipo_{update_type}")
+        with self._lock:
+            if update_id in self._seen:
+                self._count("duplicado")
+                return "descartar", "duplicado"
+            self._seen[update_id] = True
+        now = now or time.time()
+        payload = data[update_type]
+        if update_type == "message":
+            if self.message_max_age and now - payload.get("date", now) > self.message_max_age:
+                return self._result("descartar", "mensaje_viejo")
+        elif update_type == "callback_query":
+            if "data" not in payload:
+                return self._result("descartar", "callback_sin_data")
+            message_date = (payload.get("message") or {}).get("date") or now
+            if self.callback_max_age and now - message_date > self.callback_max_age:
+                return self._result("responder", {
+                    "method": "answerCallbackQuery",
+                    "callback_query_id": payload.get("id"),
+                    "text": STALE_MENU_TEXT,
+                    "show_alert": True,
+                })
+        return self._result("procesar", None)
+
+    def _result(self, action, detail):
+        with self._lock:
+            self._count(action if action != "descartar" else detail)
+        return action, detail
+
+    def forget(self, update_id):
+        """Olvida un update_id (falló su procesamiento y Telegram lo va a reintentar)."""
+        with self._lock:
+            self._seen.pop(update_id, None)
+
+    def get_stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["seen"] = len(self._seen)
+        return data
+
+
+ingest_filter = UpdateIngestFilter(
+    ALLOWED_UPDATES,
+    dedupe_size=INGEST_DEDUPE_SIZE,
+    message_max_age=INGEST_MESSAGE_MAX_AGE,
+    callback_max_age=INGEST_CALLBACK_MAX_AGE,
+)
+register_metrics("ingest", ingest_filter.get_stats)
+
+
 @app.route("/webhook2", methods=["POST"])
 def webhook():
-    data = request.get_json(force=True)
-    # Agrega logs y prints para confirmar que se recibió la actualización
-    logger.info("Webhook triggered. Data received: %s", data)
-    print("Webhook triggered. Data received:", data)
-    sys.stdout.flush()  # Forzar que se escriba inmediatamente en los logs
+    data = request.get_json(force=True, silent=True)
+    action, detail = ingest_filter.check(data)
+    if action == "descartar":
+        logger.debug("Update descartado (%s)", detail)
+        return 'ok', 200
+    if action == "responder":
+        # Telegram ejecuta el método incluido en la respuesta del webhook
+        return jsonify(detail), 200
+    log_payload(logger, logging.INFO, "Webhook triggered (update %s)", data, data["update_id"])
 
     try:
         update = Update.de_json(data, TELEGRAM_BOT)
-        logger.info("Update object creado correctamente")
         loop = ensure_bot_loop()  # Asegura que el event loop esté corriendo
         future = asyncio.run_coroutine_threadsafe(application.process_update(update), loop)
         future.result()  # Espera a que se procese la actualización (opcional)
-        logger.info("Update procesado correctamente")
+        logger.debug("Update %s procesado correctamente", update.update_id)
         return 'ok', 200
     except Exception as e:
+        ingest_filter.forget(data["update_id"])
         logger.exception("Error procesando update en /webhook2")
         return jsonify({"error": str(e)}), 500
 
@@ -3095,13 +7649,19 @@ def webhook():
 @app.before_first_request
 def setup_webhook():
     webhook_url = "https://verduleria.onrender.com/webhook2"
-    result = TELEGRAM_BOT.set_webhook(webhook_url)
+    try:
+        # set_webhook es una corrutina: se ejecuta en el loop del bot
+        result = asyncio.run_coroutine_threadsafe(
+            TELEGRAM_BOT.set_webhook(webhook_url, allowed_updates=ALLOWED_UPDATES),
+            ensure_bot_loop(),
+        ).result(timeout=30)
+    except Exception as e:
+        logger.error(f"Error configurando el webhook: {e}")
+        return
     if result:
         logger.info("Webhook configurado correctamente")
-        print("setup_webhook() se ha ejecutado: Webhook configurado correctamente")
     else:
         logger.error("Error configurando el webhook")
-        print("setup_webhook() se ha ejecutado: Error configurando el webhook")
 
 
 
@@ -3113,6 +7673,6 @@ if __name__ == "__main__":
     #else:
     #    logger.error("Error configurando el webhook")
     #main()n
-    application.run_polling()
+    application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Conciliación de pagos contra un servidor local que imita la búsqueda de pagos de MercadoPago.
+Requiere las mismas variables de entorno que el bot (TELEGRAM_TOKEN, DB_NAME, DB_USER, ...);
+sin DB_NAME se saltea. Las tablas se crean en un esquema propio que se borra al terminar,
+así que no se tocan los datos reales.
+
+Uso:
+    python -m pytest tests
+"""
+import asyncio
+import datetime
+import http.server
+import json
+import os
+import threading
+import unittest
+import urllib.parse
+
+SCHEMA = "test_reconciliation"
+
+if os.getenv("DB_NAME"):
+    # Todas las conexiones del bot (las del pool incluidas) trabajan en el esquema de prueba
+    os.environ["PGOPTIONS"] = f"{os.getenv('PGOPTIONS', '')} -c search_path={SCHEMA}".strip()
+    import psycopg2
+    import bot
+else:
+    bot = None
+
+BASE_TABLES = (
+    "CREATE TABLE users (telegram_id BIGINT PRIMARY KEY, name TEXT NOT NULL, address TEXT NOT NULL)",
+    "CREATE TABLE products (id SERIAL PRIMARY KEY, name TEXT NOT NULL, price NUMERIC NOT NULL, sale_type TEXT NOT NULL)",
+    "CREATE TABLE carts (id SERIAL PRIMARY KEY, telegram_id BIGINT NOT NULL, name TEXT NOT NULL, "
+    "total NUMERIC NOT NULL DEFAULT 0)",
+    "CREATE TABLE cart_items (id SERIAL PRIMARY KEY, cart_id INTEGER NOT NULL, product_id INTEGER NOT NULL, "
+    "quantity NUMERIC NOT NULL, subtotal NUMERIC NOT NULL)",
+    "CREATE TABLE conjuntos (id SERIAL PRIMARY KEY, numero_conjunto INTEGER NOT NULL, equipo_id INTEGER)",
+    "CREATE TABLE orders (id SERIAL PRIMARY KEY, cart_id INTEGER NOT NULL, telegram_id BIGINT NOT NULL, "
+    "confirmation_code TEXT, status TEXT NOT NULL, order_date TIMESTAMP NOT NULL DEFAULT NOW(), "
+    "entrega_date TIMESTAMP, conjunto_id INTEGER)",
+    "CREATE TABLE trabajadores (id SERIAL PRIMARY KEY, nombre TEXT NOT NULL, telegram_id BIGINT UNIQUE NOT NULL)",
+    "CREATE TABLE equipos (id SERIAL PRIMARY KEY, trabajador1 BIGINT NOT NULL, trabajador2 BIGINT NOT NULL)",
+)
+
+
+class RecordingBot:
+    """Reemplaza al bot de Telegram: guarda los mensajes en lugar de enviarlos."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id=None, text=None, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+class PaymentSearchStub(http.server.BaseHTTPRequestHandler):
+    """Responde /v1/payments/search paginando la lista 'payments' del servidor."""
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != "/v1/payments/search":
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(url.query)
+        offset, limit = int(query["offset"][0]), int(query["limit"][0])
+        payments = self.server.payments
+        body = json.dumps({"paging": {"total": len(payments), "offset": offset, "limit": limit},
+                           "results": payments[offset:offset + limit]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipIf(bot is None, "requiere la base de datos del bot (DB_NAME, DB_USER, ...)")
+class ReconciliationTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        conn = psycopg2.connect(**bot.db_pool._connect_kwargs)
+        cur = conn.cursor()
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {SCHEMA}")
+        for sql in BASE_TABLES:
+            cur.execute(sql)
+        cur.execute("INSERT INTO users VALUES (1, 'Ana', 'Calle 1'), (2, 'Beto', 'Calle 2')")
+        cur.execute("INSERT INTO products (name, price, sale_type) VALUES ('Limón', 100, 'gramos')")
+        cur.execute("INSERT INTO carts (telegram_id, name) VALUES (1, 'c'), (2, 'c')")
+        cur.execute("INSERT INTO cart_items (cart_id, product_id, quantity, subtotal) VALUES (1, 1, 100, 10), (2, 1, 100, 10)")
+        conn.commit()
+        cur.close()
+        cls.setup_conn = conn
+        bot.init_db()
+
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), PaymentSearchStub)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.saved = (bot.MP_API_BASE_URL, bot.RECONCILE_PAGE_SIZE, bot.TELEGRAM_BOT, bot.CONJUNTO_BATCHING)
+        bot.MP_API_BASE_URL = f"http://127.0.0.1:{cls.server.server_port}"
+        bot.RECONCILE_PAGE_SIZE = 1  # Una página por pago: también se prueba la paginación
+        bot.CONJUNTO_BATCHING = "secuencial"
+
+    @classmethod
+    def tearDownClass(cls):
+        bot.MP_API_BASE_URL, bot.RECONCILE_PAGE_SIZE, bot.TELEGRAM_BOT, bot.CONJUNTO_BATCHING = cls.saved
+        cls.server.shutdown()
+        cls.server.server_close()
+        bot.db_pool.closeall()
+        cur = cls.setup_conn.cursor()
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cls.setup_conn.commit()
+        cls.setup_conn.close()
+
+    def orders(self):
+        with bot.db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT cart_id, telegram_id, payment_id FROM orders ORDER BY id")
+            rows = cur.fetchall()
+            cur.close()
+        return rows
+
+    def test_missing_payment_creates_one_order(self):
+        # El pago del carrito 1 llegó por el webhook; el del carrito 2 se perdió
+        bot.process_approved_payment(2001, 1)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        ago = lambda minutes: (now - datetime.timedelta(minutes=minutes)).isoformat()
+        self.server.payments = [
+            {"id": 2001, "external_reference": "1", "date_created": ago(30), "date_approved": ago(29)},
+            {"id": 2002, "external_reference": "2", "date_created": ago(20), "date_approved": ago(19)},
+        ]
+        telegram = RecordingBot()
+        bot.TELEGRAM_BOT = telegram
+
+        asyncio.run(bot.run_payment_reconciliation())
+        self.assertEqual(self.orders(), [(1, 1, "2001"), (2, 2, "2002")])
+        self.assertIn(2, [chat_id for chat_id, _ in telegram.sent])
+
+        # Una segunda pasada no crea pedidos ni vuelve a avisar
+        sent = len(telegram.sent)
+        asyncio.run(bot.run_payment_reconciliation())
+        self.assertEqual(self.orders(), [(1, 1, "2001"), (2, 2, "2002")])
+        self.assertEqual(len(telegram.sent), sent)
+
+
+if __name__ == "__main__":
+    unittest.main()